@@ -0,0 +1,278 @@
+"""Backends for the database storing the metadata of the repository (the `db_noderepo` table).
+
+A backend creates the SQLAlchemy engine for a given URL, with the settings that work best for that database.
+The backend is chosen from the URL (see `get_backend`), and new ones can be added to `BACKENDS`.
+All backends store the same data, with the same `DbNodeRepo` model, and support the same bulk paths
+(see the `bulk` module: `copy` is only available on PostgreSQL with psycopg2).
+
+Backends can also look up single entries of a folder_meta within the DB, without retrieving all of it
+(used by the lazy `NodeRepository`). In the folder_meta, the entry of a path `a/b/c` is at
+`folder_meta['dir']['a']['dir']['b']['dir']['c']`, and is `{'obj': hashkey, 'size': size}` for files
+and `{'dir': {...}}` for directories. Nodes stored as a manifest (see the `manifest` module) are always retrieved
+and decoded whole, as manifests are small and cannot be queried by the DB.
+"""
+import functools
+import json
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.pool import QueuePool, StaticPool
+
+from .manifest import decode_manifest
+from .models import DbNodeRepo
+
+
+def _get_json_path(pieces):
+    """Return the list of keys to get the entry of a path in a folder_meta.
+
+    :param pieces: the tuple of the components of the path (empty for the root folder)
+    """
+    json_path = []
+    for piece in pieces:
+        json_path.extend(['dir', piece])
+    return json_path
+
+
+def _is_ascii(pieces):
+    """Return True if all the components of a path are ASCII."""
+    return all(piece.isascii() for piece in pieces)
+
+
+class MetadataBackend:
+    """Base class of the metadata backends."""
+
+    def create_engine(self, db_url, pool_size, max_overflow):
+        """Return a new SQLAlchemy engine for the given URL.
+
+        :param db_url: a SQLAlchemy `URL` object
+        :param pool_size: number of DB connections to keep open in the pool
+        :param max_overflow: number of DB connections that can be opened in addition to `pool_size`
+        """
+        raise NotImplementedError
+
+    def begin_node_write(self, session):
+        """Prepare the current transaction of the session to read and then change the row of a node.
+
+        This implementation does nothing: the row is then read with `SELECT ... FOR UPDATE`, that locks it
+        until the end of the transaction. Backends where that does not lock anything override it.
+        """
+
+    def get_folder_meta_entry(self, session, node_uuid, pieces):
+        """Return what is stored at a path of the folder_meta of a node.
+
+        This implementation retrieves the whole folder_meta: backends override it to look up only the entry
+        in the DB.
+
+        :param session: the SQLAlchemy session to use
+        :param node_uuid: the UUID of the node
+        :param pieces: a non-empty tuple with the components of the path
+        :return: a tuple (obj_hashkey, is_dir): (hashkey, False) for a file, (None, True) for a directory,
+            and (None, False) if the path does not exist
+        :raises sqlalchemy.orm.exc.NoResultFound: if the node does not exist
+        """
+        entry = self._get_whole_folder_meta(session, node_uuid)
+        for key in _get_json_path(pieces):
+            entry = entry.get(key) if isinstance(entry, dict) else None
+        if not isinstance(entry, dict):
+            return None, False
+        return entry.get('obj'), 'dir' in entry
+
+    def list_folder_meta_dir(self, session, node_uuid, pieces):
+        """Return the content of a directory of the folder_meta of a node.
+
+        This implementation retrieves the whole folder_meta: backends override it to list only the directory
+        in the DB.
+
+        :param session: the SQLAlchemy session to use
+        :param node_uuid: the UUID of the node
+        :param pieces: a tuple with the components of the path of the directory (empty for the root folder)
+        :return: a list of tuples (name, is_dir), in no particular order. If the path is not a directory
+            (or does not exist), the list is empty
+        :raises sqlalchemy.orm.exc.NoResultFound: if the node does not exist
+        """
+        entry = self._get_whole_folder_meta(session, node_uuid)
+        for key in _get_json_path(pieces) + ['dir']:
+            entry = entry.get(key) if isinstance(entry, dict) else None
+        if not isinstance(entry, dict):
+            return []
+        return [(name, 'dir' in metadata) for name, metadata in entry.items()]
+
+    @staticmethod
+    def _get_whole_folder_meta(session, node_uuid):
+        """Return the JSON folder_meta of a node, decoding it if stored as a manifest.
+
+        :raises sqlalchemy.orm.exc.NoResultFound: if the node does not exist
+        """
+        folder_meta, folder_manifest = session.query(DbNodeRepo).filter(
+            DbNodeRepo.node_uuid == node_uuid).with_entities(DbNodeRepo.folder_meta, DbNodeRepo.folder_manifest).one()
+        if folder_manifest is not None:
+            return decode_manifest(folder_manifest)
+        return folder_meta
+
+    @staticmethod
+    def _is_stored_as_json(session, node_uuid):
+        """Return True if the folder_meta of a node is stored as JSON, False if as a manifest.
+
+        :raises sqlalchemy.orm.exc.NoResultFound: if the node does not exist
+        """
+        result = session.query(DbNodeRepo).filter(DbNodeRepo.node_uuid == node_uuid).with_entities(
+            DbNodeRepo.folder_manifest.is_(None)).first()
+        if result is None:
+            raise NoResultFound("Node {} not found in the repository".format(node_uuid))
+        return bool(result[0])
+
+
+class PostgresqlBackend(MetadataBackend):
+    """PostgreSQL server, where `folder_meta` is stored as JSONB."""
+
+    def create_engine(self, db_url, pool_size, max_overflow):
+        kwargs = {}
+        if db_url.get_driver_name() == 'psycopg2':
+            # Return the native UUIDs as strings directly, instead of creating UUID objects that are then
+            # converted back to strings (see `models.NodeUuid`)
+            kwargs['use_native_uuid'] = False
+        return create_engine(db_url, pool_size=pool_size, max_overflow=max_overflow, **kwargs)
+
+    def get_folder_meta_entry(self, session, node_uuid, pieces):
+        # Only the hash key and a boolean are sent back, not the content of directories
+        json_path = _get_json_path(pieces)
+        result = session.execute(
+            text('SELECT folder_meta #>> CAST(:obj_path AS text[]), (folder_meta #> CAST(:path AS text[])) ? \'dir\', '
+                 'folder_manifest IS NOT NULL FROM {} WHERE node_uuid = :node_uuid'.format(DbNodeRepo.__tablename__)),
+            {'obj_path': json_path + ['obj'], 'path': json_path, 'node_uuid': node_uuid}).first()
+        if result is None:
+            raise NoResultFound("Node {} not found in the repository".format(node_uuid))
+        if result[2]:
+            return super().get_folder_meta_entry(session, node_uuid, pieces)
+        return result[0], bool(result[1])
+
+    def list_folder_meta_dir(self, session, node_uuid, pieces):
+        result = session.execute(
+            text('SELECT entry.key, entry.value ? \'dir\' '
+                 'FROM {} CROSS JOIN jsonb_each(folder_meta #> CAST(:path AS text[])) AS entry '
+                 'WHERE node_uuid = :node_uuid'.format(DbNodeRepo.__tablename__)),
+            {'path': _get_json_path(pieces) + ['dir'], 'node_uuid': node_uuid}).fetchall()
+        if not result and not self._is_stored_as_json(session, node_uuid):
+            return super().list_folder_meta_dir(session, node_uuid, pieces)
+        return [(name, is_dir) for name, is_dir in result]
+
+
+class SqliteBackend(MetadataBackend):
+    """Embedded SQLite database in a file (or in memory), where `folder_meta` is stored as JSON text.
+
+    The database is used in WAL mode, so that readers do not block the writer (and vice versa), and with
+    the other pragmas of `DEFAULT_PRAGMAS`, that are set on each new connection.
+    Connections are kept in a pool and can be used by any thread (one at a time),
+    so that each query does not need to open the file again.
+
+    The JSON is written without escaping non-ASCII characters, so that the names in the folder_meta can be
+    looked up with the JSON paths of SQLite. Rows written with the escapes (by a previous version) are still
+    found, falling back to the whole folder_meta for paths with non-ASCII characters that are not found.
+    """
+
+    DEFAULT_PRAGMAS = {
+        # Readers do not block the writer, and only the WAL file is written at commit
+        'journal_mode': 'WAL',
+        # In WAL mode the DB cannot be corrupted with NORMAL, only the last transactions can be lost on power failure
+        'synchronous': 'NORMAL',
+        # Negative values are in KiB: 64 MiB of page cache per connection
+        'cache_size': -64 * 1024,
+        # Read the DB through a memory map of up to 256 MiB, avoiding a copy for each page read
+        'mmap_size': 256 * 1024 * 1024,
+        'temp_store': 'MEMORY',
+        # Wait (in ms) if another process is writing, instead of failing immediately
+        'busy_timeout': 30000,
+    }
+
+    def __init__(self, pragmas=None):
+        """:param pragmas: a dictionary of pragmas to set on each connection, in addition to (or replacing)
+            those of `DEFAULT_PRAGMAS`. Use None as value to not set one of the default pragmas.
+        """
+        self._pragmas = dict(self.DEFAULT_PRAGMAS)
+        self._pragmas.update(pragmas or {})
+
+    def create_engine(self, db_url, pool_size, max_overflow):
+        connect_args = {'check_same_thread': False}
+        # By default non-ASCII characters are escaped (e.g. `\u00e9`), and the JSON paths do not match them
+        json_serializer = functools.partial(json.dumps, ensure_ascii=False)
+        if db_url.database in (None, '', ':memory:'):
+            # There is a different in-memory DB for each connection: use a single one for all threads.
+            # Only meant for tests, as concurrent transactions in different threads are not isolated
+            engine = create_engine(
+                db_url, connect_args=connect_args, poolclass=StaticPool, json_serializer=json_serializer)
+        else:
+            engine = create_engine(
+                db_url, connect_args=connect_args, poolclass=QueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                json_serializer=json_serializer)
+
+        pragmas = {name: value for name, value in self._pragmas.items() if value is not None}
+
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_connection, connection_record):  # pylint: disable=unused-argument
+            cursor = dbapi_connection.cursor()
+            try:
+                for name, value in pragmas.items():
+                    cursor.execute('PRAGMA {} = {}'.format(name, value))
+            finally:
+                cursor.close()
+
+        return engine
+
+    def begin_node_write(self, session):
+        # SQLite has no row locks, and ignores `FOR UPDATE`: a statement that writes nothing starts the transaction
+        # taking the lock of the whole DB, so that other writers wait (up to `busy_timeout`) until it ends
+        session.execute(text('UPDATE {} SET node_uuid = node_uuid WHERE 0'.format(DbNodeRepo.__tablename__)))
+
+    @staticmethod
+    def _get_sqlite_json_path(json_path):
+        """Return the SQLite JSON path string for a list of keys."""
+        # Keys are quoted, as file names can contain dots. SQLite does not support escaping double quotes
+        return '$' + ''.join('."{}"'.format(key) for key in json_path)
+
+    def get_folder_meta_entry(self, session, node_uuid, pieces):
+        json_path = _get_json_path(pieces)
+        if any('"' in piece for piece in pieces):
+            return super().get_folder_meta_entry(session, node_uuid, pieces)
+        result = session.execute(
+            text('SELECT json_extract(folder_meta, :obj_path), json_type(folder_meta, :dir_path), '
+                 'folder_manifest IS NOT NULL FROM {} WHERE node_uuid = :node_uuid'.format(DbNodeRepo.__tablename__)),
+            {'obj_path': self._get_sqlite_json_path(json_path + ['obj']),
+             'dir_path': self._get_sqlite_json_path(json_path + ['dir']),
+             'node_uuid': node_uuid}).first()
+        if result is None:
+            raise NoResultFound("Node {} not found in the repository".format(node_uuid))
+        if result[2] or (result[0] is None and result[1] != 'object' and not _is_ascii(pieces)):
+            return super().get_folder_meta_entry(session, node_uuid, pieces)
+        return result[0], result[1] == 'object'
+
+    def list_folder_meta_dir(self, session, node_uuid, pieces):
+        if any('"' in piece for piece in pieces):
+            return super().list_folder_meta_dir(session, node_uuid, pieces)
+        result = session.execute(
+            text('SELECT entry.key, json_type(entry.value, \'$.dir\') '
+                 'FROM {} CROSS JOIN json_each({}.folder_meta, :path) AS entry '
+                 'WHERE node_uuid = :node_uuid'.format(DbNodeRepo.__tablename__, DbNodeRepo.__tablename__)),
+            {'path': self._get_sqlite_json_path(_get_json_path(pieces) + ['dir']), 'node_uuid': node_uuid}).fetchall()
+        if not result and (not _is_ascii(pieces) or not self._is_stored_as_json(session, node_uuid)):
+            return super().list_folder_meta_dir(session, node_uuid, pieces)
+        return [(name, is_dir == 'object') for name, is_dir in result]
+
+
+BACKENDS = {
+    'postgresql': PostgresqlBackend,
+    'sqlite': SqliteBackend,
+}
+
+
+def get_backend(db_url):
+    """Return a new instance of the backend for the given URL, with the default settings.
+
+    :param db_url: a SQLAlchemy `URL` object
+    :raises ValueError: if there is no backend for the database of the URL
+    """
+    try:
+        backend_class = BACKENDS[db_url.get_backend_name()]
+    except KeyError:
+        raise ValueError("No metadata backend for database '{}', valid databases are: {}".format(
+            db_url.get_backend_name(), ', '.join(BACKENDS)))
+    return backend_class()
@@ -0,0 +1,179 @@
+"""Bulk write paths for the `db_noderepo` table.
+
+All functions get a list of rows, each being a dictionary with the column names as keys
+(all rows must have the same keys), and add them within the current transaction of the session:
+it is the responsibility of the caller to commit.
+"""
+import io
+import json
+
+from sqlalchemy import bindparam
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.types import JSON, TypeDecorator
+
+from .models import DbNodeRepo, NodeUuid, normalize_node_uuid
+
+# Maximum number of rows per multi-row INSERT statement
+_VALUES_CHUNK_SIZE = 1000
+# Maximum number of parameters in a statement on SQLite (999 before SQLite 3.32), with some margin as
+# `_IN_SQL_MAX_LENGTH` of disk-objectstore. Also used as the maximum number of node UUIDs in an `IN (...)` clause
+_MAX_SQL_VARIABLES = 950
+
+# Replacements needed to write a value in the text format of the PostgreSQL COPY command
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def insert_node_repos_orm(session, rows):
+    """Insert the rows creating one ORM `DbNodeRepo` object per row."""
+    for row in rows:
+        session.add(DbNodeRepo(**row))
+    # Make sure the INSERTs are sent, so that the timing is comparable with the other methods
+    session.flush()
+
+
+def insert_node_repos_executemany(session, rows):
+    """Insert the rows with a single Core INSERT statement, executed with the DBAPI `executemany`."""
+    if rows:
+        session.execute(DbNodeRepo.__table__.insert(), rows)
+
+
+def insert_node_repos_values(session, rows):
+    """Insert the rows with Core multi-row `INSERT ... VALUES (...), (...)` statements."""
+    if not rows:
+        return
+    table = DbNodeRepo.__table__
+    chunk_size = _VALUES_CHUNK_SIZE
+    if session.get_bind().dialect.name == 'sqlite':
+        # Each value of each row is a parameter
+        chunk_size = max(_MAX_SQL_VARIABLES // len(rows[0]), 1)
+    for idx in range(0, len(rows), chunk_size):
+        session.execute(table.insert().values(rows[idx:idx + chunk_size]))
+
+
+def _format_copy_value(value, column_type):
+    """Return the representation of a value in the text format of the PostgreSQL COPY command."""
+    if value is None:
+        return '\\N'
+    if isinstance(column_type, NodeUuid):
+        # As done by the type when values are sent to the DB by SQLAlchemy
+        value = normalize_node_uuid(value)
+    elif isinstance(column_type, JSON):
+        value = json.dumps(value, separators=(',', ':'))
+    elif isinstance(value, bool):
+        value = 't' if value else 'f'
+    elif isinstance(value, bytes):
+        value = '\\x' + value.hex()
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def insert_node_repos_copy(session, rows):
+    """Insert the rows with the PostgreSQL `COPY ... FROM STDIN` command (needs psycopg2).
+
+    Values are serialized directly to the COPY text format, bypassing the SQLAlchemy type processing
+    (except for the normalization of the node UUIDs).
+    """
+    if not rows:
+        return
+    table = DbNodeRepo.__table__
+    dialect = session.get_bind().dialect
+    column_names = list(rows[0])
+    column_types = []
+    for column_name in column_names:
+        column_type = table.c[column_name].type
+        # Get the actual type used on this DB for types like `Variant`
+        if isinstance(column_type, TypeDecorator) and not isinstance(column_type, NodeUuid):
+            column_type = column_type.load_dialect_impl(dialect)
+        column_types.append(column_type)
+
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(
+            _format_copy_value(row[column_name], column_type)
+            for column_name, column_type in zip(column_names, column_types)))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    # Use the DBAPI connection of the session, so that the COPY is part of the same transaction
+    statement = 'COPY {} ({}) FROM STDIN'.format(table.name, ', '.join(column_names))
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(statement, buffer)
+    except dialect.dbapi.Error as exc:
+        # Raise the same exceptions as SQLAlchemy (e.g. `IntegrityError` if a node UUID already exists)
+        raise DBAPIError.instance(statement, None, exc, dialect.dbapi.Error)
+    finally:
+        cursor.close()
+
+
+INSERT_METHODS = {
+    'orm': insert_node_repos_orm,
+    'executemany': insert_node_repos_executemany,
+    'values': insert_node_repos_values,
+    'copy': insert_node_repos_copy,
+}
+
+
+def get_default_insert_method(session):
+    """Return the fastest insert method available for the database the session is bound to."""
+    dialect = session.get_bind().dialect
+    if dialect.name == 'postgresql' and dialect.driver == 'psycopg2':
+        return 'copy'
+    return 'executemany'
+
+
+def bulk_insert_node_repos(session, rows, method=None):
+    """Insert many rows in the `db_noderepo` table.
+
+    :param session: the SQLAlchemy session to use. The caller needs to commit.
+    :param rows: a list of dictionaries, with column names as keys
+    :param method: one of the keys of `INSERT_METHODS`. If None, use the fastest available method
+        (COPY for PostgreSQL with psycopg2, executemany otherwise)
+    """
+    if method is None:
+        method = get_default_insert_method(session)
+    try:
+        insert_function = INSERT_METHODS[method]
+    except KeyError:
+        raise ValueError("Unknown insert method '{}', valid methods are: {}".format(
+            method, ', '.join(INSERT_METHODS)))
+    insert_function(session, rows)
+
+
+def update_node_repos(session, rows):
+    """Update existing rows of the `db_noderepo` table, identified by `node_uuid`, with a single executemany.
+
+    :param session: the SQLAlchemy session to use. The caller needs to commit.
+    :param rows: a list of dictionaries, with column names as keys. The `node_uuid` key is used to identify the row,
+        the other keys are the columns to update.
+    """
+    if not rows:
+        return
+    table = DbNodeRepo.__table__
+    column_names = [column_name for column_name in rows[0] if column_name != 'node_uuid']
+    statement = table.update().where(table.c.node_uuid == bindparam('_node_uuid')).values(
+        {column_name: bindparam(column_name) for column_name in column_names})
+    session.execute(statement, [
+        dict(((column_name, row[column_name]) for column_name in column_names), _node_uuid=row['node_uuid'])
+        for row in rows])
+
+
+def upsert_node_repos(session, rows, method=None):
+    """Write rows in the `db_noderepo` table, updating the rows of nodes that already exist and inserting the others.
+
+    If another transaction inserts a row for one of the new nodes in the meantime, the insert fails with an
+    `IntegrityError` (because of the unique index on the node UUIDs): the caller should then roll back and call
+    this function again, that will update that row (see `repository._commit_with_retry`).
+
+    :param session: the SQLAlchemy session to use. The caller needs to commit.
+    :param rows: a list of dictionaries, with column names as keys (`node_uuid` must be one of them)
+    :param method: the method to insert new rows, see `bulk_insert_node_repos`
+    """
+    existing = set()
+    # Compared in the canonical form, as returned by the DB
+    node_uuids = [normalize_node_uuid(row['node_uuid']) for row in rows]
+    for idx in range(0, len(node_uuids), _MAX_SQL_VARIABLES):
+        existing.update(res[0] for res in session.query(DbNodeRepo.node_uuid).filter(
+            DbNodeRepo.node_uuid.in_(node_uuids[idx:idx + _MAX_SQL_VARIABLES])))
+    is_existing = [node_uuid in existing for node_uuid in node_uuids]
+    update_node_repos(session, [row for row, exists in zip(rows, is_existing) if exists])
+    bulk_insert_node_repos(session, [row for row, exists in zip(rows, is_existing) if not exists], method=method)
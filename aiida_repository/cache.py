@@ -0,0 +1,158 @@
+"""In-process cache of the folder_meta of nodes."""
+import collections
+import threading
+
+from .manifest import is_manifest
+
+CacheInfo = collections.namedtuple('CacheInfo', ['hits', 'misses', 'entries', 'size', 'max_size'])
+
+# Approximate memory used by a node entry, and by each entry of its folder_meta, in addition to the names
+_NODE_OVERHEAD = 200
+_DIR_ENTRY_OVERHEAD = 300
+_FILE_ENTRY_OVERHEAD = 350
+# Maximum number of invalidated node UUIDs remembered to discard stale values, see `FolderMetaCache.put_many`
+_MAX_INVALIDATIONS = 10000
+
+
+def estimate_folder_meta_size(folder_meta):
+    """Return an approximate size, in bytes, of the memory used by a decoded folder_meta.
+
+    This does not need to be precise, it is only used to bound the total size of the cache.
+
+    :param folder_meta: a JSON folder_meta, or a manifest (that is cached as it is, and decoded only when used)
+    """
+    if is_manifest(folder_meta):
+        return _NODE_OVERHEAD + len(folder_meta)
+    size = _NODE_OVERHEAD
+    to_visit = [folder_meta['dir']]
+    while to_visit:
+        element = to_visit.pop()
+        for name, metadata in element.items():
+            if 'dir' in metadata:
+                size += _DIR_ENTRY_OVERHEAD + len(name)
+                to_visit.append(metadata['dir'])
+            else:
+                size += _FILE_ENTRY_OVERHEAD + len(name)
+    return size
+
+
+class FolderMetaCache:
+    """Thread-safe LRU cache of folder_meta dictionaries, keyed by node UUID.
+
+    The total (approximate) size of the cached entries is kept below `max_size` bytes,
+    evicting the least recently used ones.
+
+    :note: the cached folder_meta dictionaries are returned as they are, without copying them:
+        they must not be modified.
+    :note: to avoid putting back in the cache a value read from the DB before a concurrent write (and its
+        invalidation), readers get the current generation with `get_generation` before reading the DB, and
+        pass it to `put_many`: the nodes invalidated since then are skipped.
+    """
+
+    def __init__(self, max_size):
+        """:param max_size: maximum size of the cache, in bytes."""
+        self._max_size = max_size
+        # Values are tuples (folder_meta, size); the least recently used entry is the first one
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+        # Incremented at each invalidation; the invalidated node UUIDs are mapped to the generation at which
+        # they were last invalidated, the oldest first. Invalidations before `_oldest_generation` are forgotten.
+        self._generation = 0
+        self._invalidations = collections.OrderedDict()
+        self._oldest_generation = 0
+
+    def get_generation(self):
+        """Return the current generation, to be passed to `put_many` for values read from the DB after this call."""
+        with self._lock:
+            return self._generation
+
+    def get_many(self, node_uuids):
+        """Return the cached folder_meta of the given nodes.
+
+        :return: a tuple (found, missing) where `found` is a dictionary of the folder_meta of the nodes in
+            the cache, and `missing` the list of node UUIDs that are not in the cache.
+        """
+        found = {}
+        missing = []
+        with self._lock:
+            for node_uuid in node_uuids:
+                try:
+                    found[node_uuid] = self._entries[node_uuid][0]
+                except KeyError:
+                    missing.append(node_uuid)
+                else:
+                    self._entries.move_to_end(node_uuid)
+            self._hits += len(found)
+            self._misses += len(missing)
+        return found, missing
+
+    def get(self, node_uuid):
+        """Return the cached folder_meta of the given node, or None if it is not in the cache."""
+        found, _ = self.get_many([node_uuid])
+        return found.get(node_uuid)
+
+    def put_many(self, folder_metas, generation=None):
+        """Add to the cache the folder_meta of many nodes.
+
+        :param folder_metas: a dictionary with node UUIDs as keys and folder_meta dictionaries as values
+        :param generation: the value returned by `get_generation` before reading the folder_meta from the DB.
+            If given, the nodes invalidated since then are not added, as their value may be stale (all nodes are
+            skipped if it is so old that the invalidations since then are not known anymore).
+        """
+        sizes = {node_uuid: estimate_folder_meta_size(folder_meta) for node_uuid, folder_meta in folder_metas.items()}
+        with self._lock:
+            if generation is not None and generation < self._oldest_generation:
+                return
+            for node_uuid, folder_meta in folder_metas.items():
+                if generation is not None and self._invalidations.get(node_uuid, -1) > generation:
+                    continue
+                size = sizes[node_uuid]
+                if size > self._max_size:
+                    # Would evict everything else, and then be evicted itself
+                    continue
+                self._pop(node_uuid)
+                self._entries[node_uuid] = (folder_meta, size)
+                self._size += size
+            while self._size > self._max_size:
+                _, (_, size) = self._entries.popitem(last=False)
+                self._size -= size
+
+    def put(self, node_uuid, folder_meta, generation=None):
+        """Add to the cache the folder_meta of a node, see `put_many`."""
+        self.put_many({node_uuid: folder_meta}, generation=generation)
+
+    def _pop(self, node_uuid):
+        """Remove an entry, if present. Must be called with the lock acquired."""
+        entry = self._entries.pop(node_uuid, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def invalidate(self, node_uuids=None):
+        """Remove the given nodes from the cache (all nodes if `node_uuids` is None)."""
+        with self._lock:
+            self._generation += 1
+            if node_uuids is None:
+                self._entries.clear()
+                self._size = 0
+                self._invalidations.clear()
+                self._oldest_generation = self._generation
+            else:
+                for node_uuid in node_uuids:
+                    self._pop(node_uuid)
+                    self._invalidations.pop(node_uuid, None)
+                    self._invalidations[node_uuid] = self._generation
+                while len(self._invalidations) > _MAX_INVALIDATIONS:
+                    _, self._oldest_generation = self._invalidations.popitem(last=False)
+
+    def get_info(self):
+        """Return a `CacheInfo` named tuple with the statistics of the cache."""
+        with self._lock:
+            return CacheInfo(
+                hits=self._hits,
+                misses=self._misses,
+                entries=len(self._entries),
+                size=self._size,
+                max_size=self._max_size)
@@ -0,0 +1,135 @@
+"""Adaptive compression: decide for each object whether to compress it when writing it to the packs.
+
+Repositories mix very compressible files (text outputs, inputs, JSON) with files that are already compressed
+or that are essentially random binary data (`.gz`, `.h5`, `.npy`, ...). Compressing everything wastes CPU on
+the latter, compressing nothing wastes disk on the former. `AdaptiveCompression` decides per object, in order:
+
+- objects smaller than `min_size` bytes are not compressed (the saving would be negligible);
+- objects whose name has an extension of `incompressible_extensions` are not compressed, and those
+  with an extension of `compressible_extensions` are compressed, without looking at their content;
+- otherwise, the first `sample_size` bytes are compressed with the fastest zlib level, and the object is
+  compressed if the sample shrinks to at most `max_ratio` of its size.
+
+The decision is recorded in the `compressed` column of the objects in the container, and the number of objects
+compressed or not (and why), the CPU time spent deciding and compressing, and the bytes saved are accumulated
+in a `CompressionStats` object (reported as metrics by the repository, see the `metrics` module).
+"""
+import os
+import zlib
+
+# Extensions of files that are already compressed, or that are binary data that compress poorly
+INCOMPRESSIBLE_EXTENSIONS = frozenset([
+    '.gz', '.tgz', '.bz2', '.xz', '.lzma', '.zst', '.zip', '.7z', '.rar', '.h5', '.hdf5', '.nc', '.npy', '.npz',
+    '.png', '.jpg', '.jpeg', '.gif', '.pdf', '.mp4'
+])
+# Extensions of text files, that always compress well
+COMPRESSIBLE_EXTENSIONS = frozenset([
+    '.txt', '.out', '.in', '.log', '.err', '.json', '.xml', '.yaml', '.yml', '.cif', '.xyz', '.csv', '.py', '.sh',
+    '.upf', '.html'
+])
+
+# The reasons of a decision
+REASON_SIZE = 'size'
+REASON_EXTENSION = 'extension'
+REASON_SAMPLE = 'sample'
+
+
+class AdaptiveCompression:
+    """Policy deciding whether to compress each object, see the module docstring."""
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self, min_size=1024, sample_size=64 * 1024, max_ratio=0.9,
+            incompressible_extensions=INCOMPRESSIBLE_EXTENSIONS, compressible_extensions=COMPRESSIBLE_EXTENSIONS):
+        """Create the policy.
+
+        :param min_size: objects smaller than this (in bytes) are never compressed
+        :param sample_size: number of bytes at the beginning of an object that are compressed to estimate the ratio
+        :param max_ratio: compress an object if its sample compresses to at most this fraction of its size
+        :param incompressible_extensions: extensions (lower case, with the dot) of the objects never compressed
+        :param compressible_extensions: extensions (lower case, with the dot) of the objects always compressed
+        """
+        self.min_size = min_size
+        self.sample_size = sample_size
+        self.max_ratio = max_ratio
+        self.incompressible_extensions = frozenset(incompressible_extensions)
+        self.compressible_extensions = frozenset(compressible_extensions)
+
+    def decide(self, name, head, is_complete):
+        """Decide whether to compress an object.
+
+        :param name: the name (or path) of the file of the object, only used for its extension. Can be None
+        :param head: the first bytes of the object (at least `sample_size`, unless the object is shorter)
+        :param is_complete: True if `head` is the whole content of the object
+        :return: a tuple (compress, reason), where `reason` is one of `REASON_SIZE`, `REASON_EXTENSION`
+            and `REASON_SAMPLE`
+        """
+        if is_complete and len(head) < self.min_size:
+            return False, REASON_SIZE
+        extension = os.path.splitext(name)[1].lower() if name else ''
+        if extension in self.incompressible_extensions:
+            return False, REASON_EXTENSION
+        if extension in self.compressible_extensions:
+            return True, REASON_EXTENSION
+        sample = head[:self.sample_size]
+        return len(zlib.compress(sample, 1)) <= self.max_ratio * len(sample), REASON_SAMPLE
+
+
+def get_compression_policy(compress):
+    """Return the compression policy for the value of a `compress` parameter.
+
+    :param compress: True or False to compress all objects or none of them, 'auto' to decide per object with
+        the default `AdaptiveCompression`, or an `AdaptiveCompression` instance
+    :return: a boolean or an `AdaptiveCompression` instance
+    :raises ValueError: if the value is not valid
+    """
+    if isinstance(compress, (bool, AdaptiveCompression)):
+        return compress
+    if compress == 'auto':
+        return AdaptiveCompression()
+    raise ValueError("Invalid value of compress '{}': use True, False, 'auto' or an AdaptiveCompression".format(
+        compress))
+
+
+class CompressionStats:
+    """Accumulator of the decisions of an `AdaptiveCompression` policy and of their effect.
+
+    - `decisions`: a dictionary mapping (compressed, reason) tuples to the number of objects;
+    - `bytes_in`, `bytes_out`: total size of the compressed objects, before and after compression;
+    - `cpu_time`: CPU time (in seconds, of the threads doing the work) spent deciding and compressing.
+    """
+    __slots__ = ('decisions', 'bytes_in', 'bytes_out', 'cpu_time')
+
+    def __init__(self):
+        self.decisions = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_time = 0.
+
+    @property
+    def bytes_saved(self):
+        """The number of bytes saved by compression (negative if the compressed objects grew)."""
+        return self.bytes_in - self.bytes_out
+
+    def add(self, compressed, reason, size, length, cpu_time):  # pylint: disable=too-many-arguments
+        """Record the decision for an object, and its effect.
+
+        :param compressed: whether the object was compressed
+        :param reason: the reason of the decision
+        :param size: the size of the object
+        :param length: the number of bytes written to the pack
+        :param cpu_time: the CPU time spent deciding and compressing
+        """
+        self.decisions[(compressed, reason)] = self.decisions.get((compressed, reason), 0) + 1
+        if compressed:
+            self.bytes_in += size
+            self.bytes_out += length
+        self.cpu_time += cpu_time
+
+    def report(self, metrics):
+        """Report the content to a `Metrics` object, see the `metrics` module."""
+        for (compressed, reason), count in self.decisions.items():
+            metrics.count('compress.{}.{}'.format('compressed' if compressed else 'stored', reason), count)
+        metrics.count('compress.bytes_in', self.bytes_in)
+        metrics.count('compress.bytes_saved', self.bytes_saved)
+        metrics.timing('compress.cpu', self.cpu_time)
+
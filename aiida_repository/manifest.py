@@ -0,0 +1,200 @@
+"""Compact binary encoding of the folder_meta of a node (a "manifest").
+
+The JSON folder_meta spends most of its size on the structure (`{"obj": ...}`, `{"dir": ...}`) and on the
+hexadecimal hash keys. A manifest stores the same content as:
+
+- a header: the magic bytes `AFM`, the format version (1 byte) and the length in bytes of the hash keys (1 byte);
+- three little-endian unsigned 32-bit integers: the number of entries, the number of distinct names,
+  and the size of the table of names;
+- the table of names: each distinct name once, encoded in UTF-8, separated by null bytes;
+- the entries (files and directories), each directory before its content: two unsigned 32-bit integers
+  for each entry, the index of the entry of its parent directory plus one (0 for the root folder)
+  and `2 * name_index + is_dir`;
+- the hash keys of the files, as raw bytes, in the same order as the file entries;
+- (only from version 2) the sizes of the files in bytes, as little-endian unsigned 64-bit integers,
+  in the same order as the file entries.
+
+Version 2 is written when the size of every file is known (the `size` key of the file entries of the
+folder_meta), version 1 otherwise (e.g. for nodes imported by a previous version). Both are read.
+
+All the arrays are decoded with single calls into C code, and the remaining work (building the paths)
+is done only when the content of a node is first accessed, see `iter_manifest_entries`.
+
+Each manifest is decoded again when it is encoded, and compared with the folder_meta (see `check_manifest`),
+so that content that cannot be represented (e.g. names with null bytes, hash keys of different lengths)
+is rejected before being written to the DB, instead of being silently altered.
+"""
+import array
+import os
+import struct
+import sys
+
+MAGIC = b'AFM'
+# Latest version, with the sizes of the files
+VERSION = 2
+SUPPORTED_VERSIONS = (1, 2)
+
+_HEADER = struct.Struct('<3sBBIII')
+
+
+def _get_uint_array(typecode, data=b''):
+    """Return an array of unsigned integers (little-endian in `data`).
+
+    :param typecode: 'I' for 32-bit integers, 'Q' for 64-bit integers
+    """
+    values = array.array(typecode)
+    assert values.itemsize == {'I': 4, 'Q': 8}[typecode], 'Unsupported platform, wrong size of array items'
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def is_manifest(value):
+    """Return True if the value (as stored in the DB) is a manifest, False if it is a JSON folder_meta."""
+    return isinstance(value, (bytes, bytearray, memoryview))
+
+
+def encode_folder_meta(folder_meta, check=True):
+    """Return the manifest (bytes) with the same content as a JSON folder_meta.
+
+    :param check: if True, decode the manifest and check that it has the same content, see `check_manifest`
+    :raises ValueError: if the folder_meta is not valid, or cannot be represented in a manifest
+    """
+    names = {}
+    entries = _get_uint_array('I')
+    hashkeys = []
+    # Set to None at the first file without a size: then version 1 is written, without the sizes
+    sizes = _get_uint_array('Q')
+
+    # Each element of the stack is (index of the directory entry plus one, folder_meta element)
+    to_visit = [(0, folder_meta['dir'])]
+    while to_visit:
+        parent, element = to_visit.pop()
+        for name, metadata in element.items():
+            name_index = names.setdefault(name, len(names))
+            entries.append(parent)
+            if 'dir' in metadata:
+                entries.append(2 * name_index + 1)
+                # Entries are pairs of integers
+                to_visit.append((len(entries) // 2, metadata['dir']))
+            elif 'obj' in metadata:
+                entries.append(2 * name_index)
+                hashkeys.append(metadata['obj'])
+                if sizes is not None and metadata.get('size') is not None:
+                    sizes.append(metadata['size'])
+                else:
+                    sizes = None
+            else:
+                raise ValueError("Invalid object in the folder_meta, neither a folder nor a file: {}".format(element))
+
+    hashkey_length = len(hashkeys[0]) // 2 if hashkeys else 0
+    names_table = '\0'.join(names).encode('utf8')
+    if sys.byteorder == 'big':
+        entries.byteswap()
+        if sizes is not None:
+            sizes.byteswap()
+    manifest = b''.join([
+        _HEADER.pack(MAGIC, 1 if sizes is None else VERSION, hashkey_length, len(entries) // 2, len(names),
+                     len(names_table)),
+        names_table,
+        entries.tobytes(),
+        bytes.fromhex(''.join(hashkeys)),
+        sizes.tobytes() if sizes is not None else b'',
+    ])
+    if check:
+        check_manifest(folder_meta, manifest)
+    return manifest
+
+
+def _get_expected_dir(element, with_sizes):
+    """Return the content of a directory of a folder_meta as decoded from a manifest, see `check_manifest`."""
+    expected = {}
+    for name, metadata in element.items():
+        if 'dir' in metadata:
+            expected[name] = {'dir': _get_expected_dir(metadata['dir'], with_sizes)}
+        elif with_sizes:
+            expected[name] = {'obj': metadata['obj'], 'size': metadata['size']}
+        else:
+            expected[name] = {'obj': metadata['obj']}
+    return expected
+
+
+def check_manifest(folder_meta, manifest):
+    """Check that a manifest decodes to the content of a JSON folder_meta.
+
+    Only the hash keys and the sizes of the files are compared (the sizes only if the manifest has them),
+    as the other keys of the file entries are not stored in a manifest.
+
+    :raises ValueError: if the content differs, or the manifest cannot be decoded
+    """
+    with_sizes = _HEADER.unpack_from(manifest)[1] >= 2
+    if decode_manifest(manifest) != {'dir': _get_expected_dir(folder_meta['dir'], with_sizes)}:
+        raise ValueError('Invalid folder manifest: its content differs from the folder_meta it was encoded from')
+
+
+def iter_manifest_entries(manifest):
+    """Yield the entries of a manifest, each directory before its content.
+
+    :return: a generator of tuples (dir_path, name, obj_hashkey, size), where `dir_path` is the path of the parent
+        directory (the empty string for the root folder, with `os.sep` as separator), `obj_hashkey` is None
+        for directories and `size` is None for directories and in manifests of version 1. Names are interned.
+    :raises ValueError: if the data is not a manifest, or has an unsupported version
+    """
+    manifest = bytes(manifest)
+    try:
+        magic, version, hashkey_length, num_entries, num_names, names_size = _HEADER.unpack_from(manifest)
+    except struct.error:
+        raise ValueError('Invalid folder manifest: too short')
+    if magic != MAGIC:
+        raise ValueError('Invalid folder manifest: wrong magic bytes')
+    if version not in SUPPORTED_VERSIONS:
+        raise ValueError('Unsupported folder manifest version {} (supported: {})'.format(
+            version, ', '.join(str(supported) for supported in SUPPORTED_VERSIONS)))
+
+    offset = _HEADER.size
+    names = [sys.intern(name) for name in manifest[offset:offset + names_size].decode('utf8').split('\0')]
+    if len(names) != num_names and num_names:
+        raise ValueError('Invalid folder manifest: wrong number of names')
+    offset += names_size
+    entries = _get_uint_array('I', manifest[offset:offset + 8 * num_entries])
+    offset += 8 * num_entries
+    if version == 1:
+        hex_hashkeys = manifest[offset:].hex()
+        sizes = None
+    else:
+        # Each file has a hash key and a size
+        num_files = (len(manifest) - offset) // (hashkey_length + 8)
+        hex_hashkeys = manifest[offset:offset + num_files * hashkey_length].hex()
+        sizes = _get_uint_array('Q', manifest[offset + num_files * hashkey_length:])
+    hex_length = 2 * hashkey_length
+
+    # Paths of the directories, indexed by the index of their entry plus one
+    dir_paths = {0: ''}
+    file_index = 0
+    for idx in range(num_entries):
+        parent = entries[2 * idx]
+        name = names[entries[2 * idx + 1] >> 1]
+        dir_path = dir_paths[parent]
+        if entries[2 * idx + 1] & 1:
+            dir_paths[idx + 1] = dir_path + os.sep + name if dir_path else name
+            yield dir_path, name, None, None
+        else:
+            yield (dir_path, name, hex_hashkeys[file_index * hex_length:(file_index + 1) * hex_length],
+                   sizes[file_index] if sizes is not None else None)
+            file_index += 1
+
+
+def decode_manifest(manifest):
+    """Return the JSON folder_meta with the same content as a manifest."""
+    folder_meta = {'dir': {}}
+    elements = {'': folder_meta['dir']}
+    for dir_path, name, obj_hashkey, size in iter_manifest_entries(manifest):
+        if obj_hashkey is None:
+            elements[dir_path + os.sep + name if dir_path else name] = elements[dir_path].setdefault(
+                name, {'dir': {}})['dir']
+        elif size is None:
+            elements[dir_path][name] = {'obj': obj_hashkey}
+        else:
+            elements[dir_path][name] = {'obj': obj_hashkey, 'size': size}
+    return folder_meta
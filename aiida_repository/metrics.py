@@ -0,0 +1,180 @@
+"""Instrumentation of the repository: timers and counters.
+
+A `Repository` (and the `NodeRepository` objects it returns) reports its metrics to a `Metrics` object.
+By default this is `NULL_METRICS`, that discards everything and makes the repository skip the collection
+of metrics that are not free (e.g. the timing of each DB query).
+To collect them, pass a `MetricsRegistry` (that accumulates them in memory), a `CallbackMetrics`
+(that forwards each of them to a function), or an instance of a custom subclass of `Metrics`.
+
+Timers (durations in seconds, reported with `Metrics.timing`):
+
+- `import.scan`: listing the node folders of an import batch
+- `import.write_objects`: reading the files of an import batch and writing them to the packs
+- `import.commit`: writing the folder_meta of an import batch to the DB
+- `export.objects`: copying the objects of a chunk of nodes to the target container, in `export_nodes`
+- `export.commit`: writing the folder_meta of a chunk of nodes to the target DB, in `export_nodes`
+- `export_to_folder`: writing a chunk of nodes to a folder, in `export_nodes_to_folder`
+- `write.write_objects`, `write.commit`: writing the new objects, and the folder_meta to the DB,
+  when committing a `NodeTransaction`
+- `write.pack_loose`: a call to `Repository.pack_loose_objects`
+- `db.get_folder_metas`: retrieving folder_meta from the DB (only for nodes not in the cache)
+- `db.get_folder_meta_entry`, `db.list_folder_meta_dir`: looking up a path or listing a directory
+  of a folder_meta in the DB, for a `LazyNodeRepository`
+- `db.query`: each SQL statement sent to the DB
+- `verify`: a call to `Repository.verify`
+- `repack`: a call to `Repository.repack_nodes`
+- `compress.cpu`: CPU time spent deciding whether to compress the objects and compressing them, with adaptive
+  compression (see the `compression` module)
+
+Counters (reported with `Metrics.count`):
+
+- `import.nodes`, `import.objects_written`, `import.bytes_read`
+- `import.nodes_skipped`: nodes skipped by an incremental import, as they did not change
+- `export.nodes`, `export.objects_written`, `export.objects_skipped`, `export.bytes_written`
+- `export_to_folder.nodes`, `export_to_folder.files`, `export_to_folder.bytes_written`
+- `verify.nodes`, `verify.objects`, `verify.objects_hashed`, `verify.bytes_hashed`
+- `repack.nodes`, `repack.nodes_repacked`, `repack.objects_moved`, `repack.bytes_moved`, `repack.packs_deleted`
+- `compress.compressed.<reason>`, `compress.stored.<reason>`: objects compressed or not by adaptive compression,
+  for each reason of the decision (`size`, `extension` or `sample`)
+- `compress.bytes_in`, `compress.bytes_saved`: total size of the objects compressed by adaptive compression,
+  and the bytes saved by compressing them
+- `write.nodes`, `write.objects_written`, `write.bytes_written`: committed `NodeTransaction`
+- `read.objects`: objects opened for reading
+- `read.bytes`: bytes read by the methods returning the content of objects
+- `read.bytes_mapped`: size of the objects returned by `NodeRepository.get_object_buffer` as a memory map
+  of their file, without reading them
+- `cache.hits`, `cache.misses`: lookups in the folder_meta cache
+"""
+import collections
+import threading
+import time
+
+TimerStats = collections.namedtuple('TimerStats', ['count', 'total', 'max'])
+
+
+class _Timer:
+    """Context manager reporting the time spent within it to a `Metrics` object."""
+    __slots__ = ('_metrics', '_name', '_start')
+
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._metrics.timing(self._name, time.perf_counter() - self._start)
+
+
+class _NullTimer:
+    """Context manager that does nothing, returned by the timers of `NullMetrics`."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    """Base class of the objects receiving the metrics of a repository.
+
+    Subclasses override `timing` and `count`; this base class ignores all metrics.
+    """
+    # If False, the repository does not collect metrics that have a cost (e.g. does not time DB queries)
+    enabled = True
+
+    def timing(self, name, duration):
+        """Report that the operation `name` took `duration` seconds."""
+
+    def count(self, name, value=1):
+        """Increment the counter `name` by `value`."""
+
+    def timer(self, name):
+        """Return a context manager reporting the time spent within it with `timing`."""
+        return _Timer(self, name)
+
+
+class NullMetrics(Metrics):
+    """Metrics object that discards everything, as cheaply as possible."""
+    enabled = False
+
+    def timer(self, name):
+        return _NULL_TIMER
+
+
+NULL_METRICS = NullMetrics()
+
+
+class CallbackMetrics(Metrics):
+    """Forward each metric to a function, e.g. to send it to a monitoring system.
+
+    The function is called as `callback(kind, name, value)`, where `kind` is either `'timing'` (and `value` is
+    a duration in seconds) or `'count'` (and `value` is the increment of the counter).
+    It can be called from any thread that uses the repository.
+    """
+
+    def __init__(self, callback):
+        self._callback = callback
+
+    def timing(self, name, duration):
+        self._callback('timing', name, duration)
+
+    def count(self, name, value=1):
+        self._callback('count', name, value)
+
+
+class MetricsRegistry(Metrics):
+    """Thread-safe accumulator of metrics in memory."""
+
+    def __init__(self):
+        self._counters = collections.defaultdict(int)
+        # Values are lists [count, total, max]
+        self._timers = {}
+        self._lock = threading.Lock()
+
+    def timing(self, name, duration):
+        with self._lock:
+            try:
+                stats = self._timers[name]
+            except KeyError:
+                self._timers[name] = [1, duration, duration]
+            else:
+                stats[0] += 1
+                stats[1] += duration
+                if duration > stats[2]:
+                    stats[2] = duration
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def get_counters(self):
+        """Return a dictionary with the current value of each counter."""
+        with self._lock:
+            return dict(self._counters)
+
+    def get_timers(self):
+        """Return a dictionary with a `TimerStats` named tuple (count, total, max) for each timer."""
+        with self._lock:
+            return {name: TimerStats(*stats) for name, stats in self._timers.items()}
+
+    def as_dict(self):
+        """Return all metrics as a JSON-serializable dictionary, with keys `counters` and `timers`."""
+        return {
+            'counters': self.get_counters(),
+            'timers': {name: stats._asdict() for name, stats in self.get_timers().items()},
+        }
+
+    def reset(self):
+        """Discard all the metrics collected so far."""
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
@@ -1,15 +1,182 @@
-from sqlalchemy import Column, Integer, String
-from sqlalchemy.dialects.postgresql import JSONB
+import uuid
+
+from sqlalchemy import BigInteger, Column, Integer, LargeBinary, String, inspect, text
+from sqlalchemy.dialects.postgresql import JSONB, UUID
+from sqlalchemy.types import JSON, TypeDecorator
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+# Regular expression matching UUIDs in the canonical form (lowercase, with hyphens), as stored by AiiDA
+_CANONICAL_UUID_REGEX = '^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$'
+
+
+def normalize_node_uuid(node_uuid):
+    """Return a node UUID in the canonical form (lowercase, with hyphens), as returned by the DB.
+
+    :param node_uuid: a string (in any form accepted by `uuid.UUID`, e.g. uppercase or without hyphens),
+        or a `uuid.UUID`
+    :raises ValueError: if it is not a valid UUID
+    """
+    if isinstance(node_uuid, uuid.UUID):
+        return str(node_uuid)
+    return str(uuid.UUID(node_uuid))
+
+
+class NodeUuid(TypeDecorator):  # pylint: disable=abstract-method
+    """Type of the node UUIDs: the native `uuid` type (16 bytes) on PostgreSQL, a string elsewhere.
+
+    In Python, values are always strings, in the canonical form. They are sent to PostgreSQL as strings,
+    so they can also be compared with the VARCHAR column of tables created by a previous version
+    (see `migrate_node_uuid_type`). Values are normalized with `normalize_node_uuid` before being sent to the DB,
+    so that the same node is always found (and stored) with the same string on all databases.
+    """
+    impl = String(36)
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(UUID(as_uuid=False))
+        return dialect.type_descriptor(String(36))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return normalize_node_uuid(value)
+
+    def bind_processor(self, dialect):
+        if dialect.name == 'postgresql':
+            # Send plain strings, not UUID objects (that psycopg2 sends as typed UUIDs, that cannot be compared
+            # with a VARCHAR column)
+            return lambda value: self.process_bind_param(value, dialect)
+        return super().bind_processor(dialect)
+
+    def result_processor(self, dialect, coltype):
+        if dialect.name == 'postgresql':
+            # The driver can return UUID objects
+            return lambda value: str(value) if value is not None else None
+        return super().result_processor(dialect, coltype)
+
 
 class DbNodeRepo(Base):
     __tablename__ = 'db_noderepo'
 
     id = Column(Integer, primary_key=True)
-    # Will become an Integer Foreign Key
-    # Actually, we probably want to link in the other direction! A Foreign Key from Node to here
-    node_uuid = Column(String(36), index=True)
-    folder_meta = Column(JSONB)
+    # Native UUID on PostgreSQL: the index is about half the size than with strings.
+    # It can be linked to the table of the nodes with `add_node_foreign_key`.
+    # Unique, so that concurrent transactions cannot insert two rows for the same new node
+    # (tables created by a previous version are upgraded by `add_unique_node_uuid_index`)
+    node_uuid = Column(NodeUuid, index=True, unique=True)
+    # JSONB on PostgreSQL, generic JSON on other databases (e.g. SQLite).
+    # NULL if the content of the node is stored in `folder_manifest` instead
+    folder_meta = Column(JSON(none_as_null=True).with_variant(JSONB(none_as_null=True), 'postgresql'))
+    # Compact binary encoding of the folder_meta, see the `manifest` module (NULL if `folder_meta` is used)
+    folder_manifest = Column(LargeBinary, nullable=True)
+    # Digest of the names, sizes and modification times of the files of the folder the node was imported from,
+    # used to skip unchanged nodes when importing again (NULL if not imported from a folder)
+    source_digest = Column(String(64), nullable=True)
+    # Number of files of the node, and their total size in bytes (counting each file, even if many have the same
+    # object), to query e.g. the largest nodes in the DB. `total_size` is NULL if the size of some files is unknown
+    # (nodes imported by a previous version, see `Repository.add_missing_sizes`)
+    file_count = Column(Integer, nullable=True, index=True)
+    total_size = Column(BigInteger, nullable=True, index=True)
+
+
+def add_missing_columns(engine):
+    """Add to the existing tables the columns of the models that are missing (e.g. created by a previous version).
+
+    The new columns are nullable and without defaults, so existing rows get NULL. The indexes on the new columns
+    are created as well.
+    """
+    existing_tables = set(inspect(engine).get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing_columns = {column['name'] for column in inspect(engine).get_columns(table.name)}
+        new_columns = set()
+        for column in table.columns:
+            if column.name not in existing_columns:
+                with engine.begin() as connection:
+                    connection.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                        table.name, column.name, column.type.compile(dialect=engine.dialect))))
+                new_columns.add(column.name)
+        for index in table.indexes:
+            if new_columns.intersection(column.name for column in index.columns):
+                index.create(bind=engine)
+
+
+def add_unique_node_uuid_index(engine):
+    """Make unique the index on the `node_uuid` column of a table created by a previous version.
+
+    The non-unique index is replaced by a unique one with the same name, in a single transaction.
+
+    :return: True if the index was replaced, False if there was nothing to do
+    :raises ValueError: if some nodes have more than one row (they must be merged or deleted first)
+    """
+    table_name = DbNodeRepo.__tablename__
+    indexes = [index for index in inspect(engine).get_indexes(table_name) if index['column_names'] == ['node_uuid']]
+    if any(index['unique'] for index in indexes):
+        return False
+    with engine.connect() as connection:
+        duplicates = [res[0] for res in connection.execute(
+            text('SELECT node_uuid FROM {} GROUP BY node_uuid HAVING COUNT(*) > 1 LIMIT 10'.format(table_name)))]
+    if duplicates:
+        raise ValueError('Cannot add a unique index on the node UUIDs, some nodes have more than one row, e.g.: '
+                         '{}'.format(', '.join(str(node_uuid) for node_uuid in duplicates)))
+    with engine.begin() as connection:
+        for index in indexes:
+            connection.execute(text('DROP INDEX {}'.format(index['name'])))
+        for index in DbNodeRepo.__table__.indexes:
+            if [column.name for column in index.columns] == ['node_uuid']:
+                index.create(bind=connection)
+    return True
+
+
+def _get_column_type(engine, table_name, column_name):
+    """Return the SQLAlchemy type of a column of a table, as it exists in the DB."""
+    return {column['name']: column['type'] for column in inspect(engine).get_columns(table_name)}[column_name]
+
+
+def migrate_node_uuid_type(engine):
+    """Convert the `node_uuid` column of a table created by a previous version to the native UUID type.
+
+    This is only done on PostgreSQL (other databases have no UUID type). The whole table is rewritten
+    and its index rebuilt, in a single transaction that locks the table.
+
+    :return: True if the column was converted, False if there was nothing to do
+    :raises ValueError: if some node UUIDs are not in the canonical form (they would be changed by the conversion)
+    """
+    table_name = DbNodeRepo.__tablename__
+    if engine.dialect.name != 'postgresql' or isinstance(_get_column_type(engine, table_name, 'node_uuid'), UUID):
+        return False
+    with engine.connect() as connection:
+        invalid = [res[0] for res in connection.execute(
+            text('SELECT node_uuid FROM {} WHERE node_uuid !~ :regex LIMIT 10'.format(table_name)),
+            {'regex': _CANONICAL_UUID_REGEX})]
+    if invalid:
+        raise ValueError('Cannot convert the node UUIDs to the native UUID type, some are not valid lowercase '
+                         'UUIDs, e.g.: {}'.format(', '.join(repr(node_uuid) for node_uuid in invalid)))
+    with engine.begin() as connection:
+        connection.execute(
+            text('ALTER TABLE {} ALTER COLUMN node_uuid TYPE uuid USING node_uuid::uuid'.format(table_name)))
+    return True
+
+
+def add_node_foreign_key(engine, node_table='db_dbnode', node_column='uuid', on_delete='CASCADE'):
+    """Add a foreign key from the `node_uuid` column to the table of the nodes (e.g. of AiiDA), if not present.
+
+    The referenced column must be unique and have the same type as `node_uuid` (see `migrate_node_uuid_type`).
+
+    :param on_delete: the action when a node is deleted, e.g. 'CASCADE' (delete its repository entry as well),
+        'RESTRICT' or 'SET NULL'
+    :return: True if the foreign key was added, False if it was already there
+    """
+    table_name = DbNodeRepo.__tablename__
+    for foreign_key in inspect(engine).get_foreign_keys(table_name):
+        if foreign_key['constrained_columns'] == ['node_uuid'] and foreign_key['referred_table'] == node_table:
+            return False
+    with engine.begin() as connection:
+        connection.execute(
+            text('ALTER TABLE {table} ADD CONSTRAINT {table}_node_uuid_fkey FOREIGN KEY (node_uuid) '
+                 'REFERENCES {node_table} ({node_column}) ON DELETE {on_delete}'.format(
+                     table=table_name, node_table=node_table, node_column=node_column, on_delete=on_delete)))
+    return True
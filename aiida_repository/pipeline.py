@@ -0,0 +1,175 @@
+"""Parallel writing of many objects to the packs of a container.
+
+`Container.add_streamed_objects_to_pack` reads, hashes and (optionally) compresses every object in the calling
+thread, so it uses a single core. Here, that work is done by a pool of threads: both `hashlib` and `zlib`
+release the GIL while processing a chunk of data, so the threads run in parallel on multiple cores without
+having to send the data to other processes. A single writer (the calling thread) appends the processed objects
+to the packs, in the same order as the input streams, so that the returned hash keys are in the same order as
+the streams and the objects are laid out in the packs as with the serial method.
+
+The content of the objects processed but not written yet is kept in memory up to `_SPOOL_MAX_SIZE` bytes
+per object, and in a temporary file in the sandbox of the container above that size. At most `max_pending`
+objects are being processed or waiting to be written at any given time.
+
+Unlike in the container, whether to compress can be decided for each object by an `AdaptiveCompression` policy
+(see the `compression` module), from the name of its file and from its first chunk.
+
+Whether the pool of threads is faster than the serial method depends on the number of cores and on the storage:
+on a single core it is slower (measure it with `benchmarks/parallel_write.py` before using it). This is why
+`create_repo_for_nodes` is serial unless `write_workers` is specified.
+
+The writer uses internals of disk-objectstore 0.4 that are not part of its public API (`_COMPRESSLEVEL`,
+`_get_sandbox_folder`, `_get_pack_id_to_write_to`, `lock_pack` and the `Obj` table), reproducing what
+`Container.add_streamed_objects_to_pack` does: this is why the dependency is pinned to `disk-objectstore<0.5`
+(see `setup.py`), and this module must be checked against any new version.
+"""
+import collections
+import os
+import shutil
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from disk_objectstore.models import Obj
+from disk_objectstore.utils import get_hash, safe_flush_to_disk
+
+# Size of the chunks in which objects are read, hashed and compressed
+_CHUNK_SIZE = 1024 * 1024
+# Objects (after compression, if any) larger than this are kept in a temporary file until they are written
+_SPOOL_MAX_SIZE = 1024 * 1024
+
+
+def _process_stream(opener, compress, hash_type, compress_level, sandbox_folder, name=None):  # pylint: disable=too-many-arguments,too-many-locals
+    """Read an object, computing its hash key and compressing it.
+
+    :param opener: a context manager returning the stream of the object, e.g. a `LazyOpener`
+    :param compress: True or False, or an `AdaptiveCompression` deciding whether to compress the object
+    :param name: the name of the file of the object, passed to the `AdaptiveCompression` policy
+    :return: a tuple (hashkey, size, data, compressed, reason, cpu_time), where `size` is the uncompressed size,
+        `data` is a file-like object with the content to write to the pack (compressed, if requested) at position 0,
+        `reason` is the reason of the decision of the policy (None if `compress` is a boolean), and `cpu_time`
+        is the CPU time spent deciding and compressing
+    """
+    hasher = get_hash(hash_type=hash_type)()
+    data = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE, dir=sandbox_folder)  # pylint: disable=consider-using-with
+    size = 0
+    reason = None
+    cpu_time = 0.
+    try:
+        with opener as stream:
+            if isinstance(compress, bool):
+                chunk = stream.read(_CHUNK_SIZE)
+            else:
+                head_size = max(_CHUNK_SIZE, compress.sample_size)
+                chunk = stream.read(head_size)
+                start = time.thread_time()
+                compress, reason = compress.decide(name, chunk, len(chunk) < head_size)
+                cpu_time += time.thread_time() - start
+            compressobj = zlib.compressobj(level=compress_level) if compress else None
+            while chunk:
+                size += len(chunk)
+                hasher.update(chunk)
+                if compress:
+                    start = time.thread_time()
+                    chunk = compressobj.compress(chunk)
+                    cpu_time += time.thread_time() - start
+                data.write(chunk)
+                chunk = stream.read(_CHUNK_SIZE)
+        if compress:
+            start = time.thread_time()
+            data.write(compressobj.flush())
+            cpu_time += time.thread_time() - start
+        data.seek(0)
+    except Exception:
+        data.close()
+        raise
+    return hasher.hexdigest(), size, data, compress, reason, cpu_time
+
+
+def _iter_processed_streams(container, streams, compress, workers, max_pending, names=None):  # pylint: disable=too-many-arguments
+    """Process the streams in a pool of threads (or in the current thread if `workers` is 0), and yield the results
+    of `_process_stream` in the input order."""
+    # pylint: disable=protected-access
+    process = lambda opener, name: _process_stream(opener, compress, container.hash_type, container._COMPRESSLEVEL,
+                                                   container._get_sandbox_folder(), name)
+    streams = zip(streams, names) if names is not None else ((opener, None) for opener in streams)
+    if workers == 0:
+        for opener, name in streams:
+            yield process(opener, name)
+        return
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for opener, name in streams:
+                pending.append(executor.submit(process, opener, name))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # If stopped early (or because of an error), do not process the remaining objects,
+            # and release the content of the objects that were already processed
+            for future in pending:
+                if not future.cancel() and future.exception() is None:
+                    future.result()[2].close()
+
+
+def add_streamed_objects_to_pack_parallel(  # pylint: disable=too-many-arguments,too-many-locals
+        container, streams, compress=False, workers=None, max_pending=None, names=None, stats=None):
+    """Add objects to the packs of a container, hashing and compressing them in parallel.
+
+    This is equivalent to `container.add_streamed_objects_to_pack(streams, compress=compress, open_streams=True)`
+    (with `no_holes=False`), except that an object whose content appears more than once in `streams` is written
+    to the packs only once. Like that method, it must be called only by one process at a time.
+
+    :param container: the `Container` to write to
+    :param streams: an iterable of context managers returning the streams to read, e.g. `LazyOpener` objects
+    :param compress: if True, compress objects before storing them. If an `AdaptiveCompression`, decide
+        for each object
+    :param workers: number of threads reading, hashing and compressing the objects.
+        If None, use the default of the `ThreadPoolExecutor`; if 0, do everything in the current thread
+    :param max_pending: maximum number of objects being processed or waiting to be written.
+        If None, twice the number of workers
+    :param names: if specified, an iterable with the names of the files of the objects, in the same order as
+        `streams`, used by an `AdaptiveCompression` policy
+    :param stats: if specified, a `CompressionStats` where the decisions of an `AdaptiveCompression` policy
+        for the objects written are recorded
+    :return: a list of object hash keys, in the same order as `streams`
+    """
+    # pylint: disable=protected-access
+    if max_pending is None:
+        max_pending = 2 * (workers or min(32, (os.cpu_count() or 1) + 4))
+    hashkeys = []
+    written = set()
+    session = container._get_cached_session()
+    processed = _iter_processed_streams(container, streams, compress, workers, max_pending, names)
+    try:
+        next_object = next(processed, None)
+        # Outer loop: a new iteration is needed each time the current pack is full
+        while next_object is not None:
+            pack_int_id = container._get_pack_id_to_write_to()
+            with container.lock_pack(str(pack_int_id)) as pack_handle:
+                while next_object is not None and container._get_pack_id_to_write_to() == pack_int_id:
+                    hashkey, size, data, compressed, reason, cpu_time = next_object
+                    with data:
+                        if hashkey not in written:
+                            offset = pack_handle.tell()
+                            shutil.copyfileobj(data, pack_handle, _CHUNK_SIZE)
+                            length = pack_handle.tell() - offset
+                            # As in the container, rely on the unique constraint: if the object already exists,
+                            # the new copy is left unreferenced in the pack
+                            session.execute(Obj.__table__.insert().prefix_with('OR IGNORE').values(
+                                hashkey=hashkey, compressed=compressed, size=size, offset=offset,
+                                length=length, pack_id=pack_int_id))
+                            written.add(hashkey)
+                            if stats is not None and reason is not None:
+                                stats.add(compressed, reason, size, length, cpu_time)
+                    hashkeys.append(hashkey)
+                    next_object = next(processed, None)
+                safe_flush_to_disk(pack_handle, os.path.realpath(pack_handle.name), use_fullsync=True)
+            # Commit once per pack, after it was synced to disk
+            session.commit()
+    finally:
+        processed.close()
+    return hashkeys
@@ -0,0 +1,191 @@
+"""Repacking of the objects of a container, so that the objects of each node are stored next to each other.
+
+The objects are laid out in the packs in the order in which they were written: after many incremental imports
+and writes, the objects of a node can end up in many packs and loose objects, and reading a whole node needs
+many seeks. The layout of a node is measured by the number of its "fragments", i.e. the contiguous ranges
+of the packs in which its objects are stored (each loose object is a fragment of its own); see `count_fragments`.
+
+`Repository.repack_nodes` copies the objects of the nodes with too many fragments to the end of the pack currently
+being written (see `move_objects`), each node after the other, and points the metadata of the container to the new
+copies. The old copies are never overwritten, so readers that already retrieved the metadata of an object can
+still read it. The space they use in the old packs is only recovered by `compact_packs`, that moves the remaining
+objects out of the packs that are mostly unused and deletes them: this must be done when nobody is using
+the container.
+
+disk-objectstore 0.4 has no API to move objects between packs, so this module writes to the packs and updates
+the `Obj` table of the container directly, with internals that are not part of its public API
+(`_get_pack_id_to_write_to`, `lock_pack`, `_list_packs`, `_get_pack_path_from_pack_id`,
+`_get_loose_path_from_hashkey` and `_get_cached_session`), in the same way as the container writes packs.
+This is why the dependency is pinned to `disk-objectstore<0.5` (see `setup.py`): this module must be checked
+against any new version, and replaced by the repacking API of the container once there is one.
+"""
+import collections
+import os
+
+from sqlalchemy import func
+from disk_objectstore.container import ObjectType
+from disk_objectstore.models import Obj
+from disk_objectstore.utils import safe_flush_to_disk
+
+# Size of the chunks in which objects are copied
+_CHUNK_SIZE = 1024 * 1024
+# Packs where the objects use less than this fraction of the size of the file are compacted by `compact_packs`
+_COMPACT_MAX_USED_FRACTION = 0.5
+
+
+class RepackReport(
+        collections.namedtuple('RepackReport', [
+            'num_nodes', 'num_repacked', 'num_objects_moved', 'bytes_moved', 'fragments_before', 'fragments_after',
+            'last_node_uuid', 'is_complete', 'num_packs_deleted'
+        ])):
+    """Result of `Repository.repack_nodes`.
+
+    - `num_nodes`: number of nodes whose layout was checked;
+    - `num_repacked`: number of nodes whose objects were moved;
+    - `num_objects_moved`, `bytes_moved`: number of objects moved, and the number of bytes they use in the packs;
+    - `fragments_before`, `fragments_after`: total number of fragments of the repacked nodes, before and after;
+    - `last_node_uuid`: the UUID of the last node that was checked (None if no node was checked): to continue
+      from there, pass `iter_node_uuids(start_after=last_node_uuid)` to the next call;
+    - `is_complete`: False if the call stopped because of its time or size budget, before checking all nodes;
+    - `num_packs_deleted`: number of packs deleted by `compact_packs` (only with `clean=True`).
+    """
+    __slots__ = ()
+
+
+def get_stored_length(meta):
+    """Return the number of bytes used by an object in the container (in its pack, or the loose file)."""
+    if meta['type'] == ObjectType.PACKED:
+        return meta['pack_length']
+    return meta['size']
+
+
+def count_fragments(metas):
+    """Return the number of contiguous ranges in which the given objects are stored.
+
+    :param metas: an iterable of metadata dictionaries of distinct objects, as returned by `Container.get_objects_meta`.
+        Loose objects count as one fragment each, missing objects are ignored. An object at the start of a pack
+        continues a fragment that ends in the previous pack (objects written one after the other can span two packs)
+    """
+    extents = []
+    fragments = 0
+    for meta in metas:
+        if meta['type'] == ObjectType.PACKED:
+            extents.append((meta['pack_id'], meta['pack_offset'], meta['pack_length']))
+        elif meta['type'] == ObjectType.LOOSE:
+            fragments += 1
+    end = None
+    for pack_id, offset, length in sorted(extents):
+        if end is None or ((pack_id, offset) != end and (pack_id - 1, offset) != (end[0], 0)):
+            fragments += 1
+        end = (pack_id, offset + length)
+    return fragments
+
+
+def move_objects(container, objects):
+    """Copy objects to the end of the pack currently being written, one after the other, and point the metadata
+    of the container to the new copies.
+
+    The content is copied as it is stored (i.e. compressed objects stay compressed), and loose objects are added
+    to the packs uncompressed (the loose files are left in place, see `Container.clean_storage`).
+    This must be called only by one process at a time, and not while objects are written to the packs.
+
+    :param container: the `Container` of the objects
+    :param objects: a list of tuples (hashkey, meta), where `meta` is the metadata dictionary of the object
+        as returned by `Container.get_objects_meta`
+    :return: the number of bytes written
+    """
+    # pylint: disable=protected-access
+    session = container._get_cached_session()
+    sources = {}
+    num_bytes = 0
+    objects = iter(objects)
+    try:
+        next_object = next(objects, None)
+        # Outer loop: a new iteration is needed each time the current pack is full
+        while next_object is not None:
+            pack_int_id = container._get_pack_id_to_write_to()
+            with container.lock_pack(str(pack_int_id)) as pack_handle:
+                while next_object is not None and container._get_pack_id_to_write_to() == pack_int_id:
+                    hashkey, meta = next_object
+                    offset = pack_handle.tell()
+                    if meta['type'] == ObjectType.PACKED:
+                        if meta['pack_id'] not in sources:
+                            sources[meta['pack_id']] = open(  # pylint: disable=consider-using-with
+                                container._get_pack_path_from_pack_id(meta['pack_id']), 'rb')
+                        source = sources[meta['pack_id']]
+                        source.seek(meta['pack_offset'])
+                        _copy(source, pack_handle, meta['pack_length'])
+                        session.execute(Obj.__table__.update().where(Obj.hashkey == hashkey).values(
+                            pack_id=pack_int_id, offset=offset, length=meta['pack_length']))
+                    else:
+                        with open(container._get_loose_path_from_hashkey(hashkey), 'rb') as source:
+                            _copy(source, pack_handle, meta['size'])
+                        session.execute(Obj.__table__.insert().values(hashkey=hashkey,
+                                                                      compressed=False,
+                                                                      size=meta['size'],
+                                                                      offset=offset,
+                                                                      length=meta['size'],
+                                                                      pack_id=pack_int_id))
+                    num_bytes += pack_handle.tell() - offset
+                    next_object = next(objects, None)
+                safe_flush_to_disk(pack_handle, os.path.realpath(pack_handle.name), use_fullsync=True)
+            # Commit once per pack, after it was synced to disk
+            session.commit()
+    finally:
+        for source in sources.values():
+            source.close()
+    return num_bytes
+
+
+def _copy(source, destination, length):
+    """Copy exactly `length` bytes from the current position of `source` to `destination`, in chunks."""
+    while length > 0:
+        chunk = source.read(min(length, _CHUNK_SIZE))
+        if not chunk:
+            raise IOError('Unexpected end of file while copying an object from {}'.format(source.name))
+        destination.write(chunk)
+        length -= len(chunk)
+
+
+def compact_packs(container, max_used_fraction=_COMPACT_MAX_USED_FRACTION):
+    """Move the objects out of the packs that are mostly unused, and delete the packs left without objects.
+
+    The objects of each pack to compact are moved in the order in which they are stored, so objects that are
+    next to each other stay so. The pack currently being written is never compacted nor deleted.
+    This must be done only when nobody is using the container: a reader could still be reading an old copy
+    of an object from the deleted packs.
+
+    :param max_used_fraction: the packs where the objects use less than this fraction of the size of the file
+        are compacted
+    :return: a tuple (bytes_moved, deleted_pack_ids)
+    """
+    # pylint: disable=protected-access
+    session = container._get_cached_session()
+    current = container._get_pack_id_to_write_to()
+    used_sizes = dict(session.query(Obj).with_entities(Obj.pack_id, func.sum(Obj.length)).group_by(Obj.pack_id))
+    bytes_moved = 0
+    for pack_id in sorted(int(pack_id) for pack_id in container._list_packs()):
+        if pack_id == current or not used_sizes.get(pack_id):
+            continue
+        if used_sizes[pack_id] >= max_used_fraction * os.path.getsize(container._get_pack_path_from_pack_id(pack_id)):
+            continue
+        objects = [(hashkey, {
+            'type': ObjectType.PACKED,
+            'size': size,
+            'pack_id': pack_id,
+            'pack_compressed': compressed,
+            'pack_offset': offset,
+            'pack_length': length
+        }) for hashkey, size, compressed, offset, length in session.query(Obj).filter(
+            Obj.pack_id == pack_id).order_by(Obj.offset).with_entities(Obj.hashkey, Obj.size, Obj.compressed,
+                                                                       Obj.offset, Obj.length)]
+        bytes_moved += move_objects(container, objects)
+
+    used = {res[0] for res in session.query(Obj).with_entities(Obj.pack_id).distinct()}
+    current = container._get_pack_id_to_write_to()
+    deleted = []
+    for pack_id in list(container._list_packs()):
+        if int(pack_id) not in used and int(pack_id) != current:
+            os.remove(container._get_pack_path_from_pack_id(pack_id))
+            deleted.append(pack_id)
+    return bytes_moved, deleted
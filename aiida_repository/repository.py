@@ -1,14 +1,50 @@
+import asyncio
 import collections
+import contextlib
+import copy
 import enum
+import functools
+import hashlib
+import io
+import itertools
+import json
+import mmap
 import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm.exc import NoResultFound
 from disk_objectstore import Container
+from disk_objectstore.container import ObjectType
+from disk_objectstore.exceptions import NotExistent
 from disk_objectstore.utils import LazyOpener
 
-from .models import DbNodeRepo, Base
+from .backends import get_backend
+from .bulk import bulk_insert_node_repos, update_node_repos, upsert_node_repos
+from .cache import FolderMetaCache
+from .compression import CompressionStats, get_compression_policy
+from .manifest import decode_manifest, encode_folder_meta, is_manifest, iter_manifest_entries
+from .metrics import NULL_METRICS
+from .models import (DbNodeRepo, Base, add_missing_columns, add_node_foreign_key, add_unique_node_uuid_index,
+                     migrate_node_uuid_type, normalize_node_uuid)
+from .pipeline import add_streamed_objects_to_pack_parallel
+from .repack import RepackReport, compact_packs, count_fragments, get_stored_length, move_objects
+from .verify import ObjectChecker, ObjectProblem, VerifyReport
+
+try:
+    import asyncpg
+except ImportError:
+    # Optional: without it, the async API runs the DB queries in the pool of threads as well
+    asyncpg = None
 
 
 class FileType(enum.Enum):
@@ -19,11 +55,284 @@ class FileType(enum.Enum):
 
 File = collections.namedtuple('File', ['name', 'type'])
 
+# Result of `NodeRepository.stat`: the size (in bytes) is None for directories
+FileStat = collections.namedtuple('FileStat', ['name', 'type', 'size'])
+
+
+class _ContainerCloser:
+    """Close a container when this object is garbage collected.
+
+    Stored in a `threading.local`, so that the container is closed by its own thread when the thread ends
+    (SQLite connections cannot be closed from another thread).
+    """
+
+    def __init__(self, container):
+        self.container = container
+
+    def __del__(self):
+        self.container.close()
+
+
+class _ThreadLocalContainer:
+    """Proxy to a disk-objectstore `Container`, using a different `Container` instance in each thread.
+
+    The SQLite session of a container cannot be shared between threads, so each thread
+    that accesses the container gets its own instance, created on first access.
+    """
+
+    def __init__(self, folder):
+        self._folder = folder
+        self._local = threading.local()
+
+    def _get_container(self):
+        try:
+            return self._local.closer.container
+        except AttributeError:
+            self._local.closer = _ContainerCloser(Container(folder=self._folder))
+            return self._local.closer.container
+
+    def __getattr__(self, name):
+        return getattr(self._get_container(), name)
+
+
+class _MemoryBudget:
+    """Track the memory used by data in transit between threads, blocking when a maximum is reached."""
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        """Wait until `size` bytes can be used, and reserve them.
+
+        A single request larger than the maximum is granted when nothing else is in use.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._used == 0 or self._used + size <= self._max_size)
+            self._used += size
+
+    def release(self, size):
+        """Release `size` bytes that were reserved with `acquire`."""
+        with self._condition:
+            self._used -= size
+            self._condition.notify_all()
+
+
+class _AsyncRunner:
+    """Run blocking functions from coroutines, in a bounded pool of threads created on first use.
+
+    It also provides, for each event loop, a semaphore limiting the number of objects that are
+    streamed at the same time (each one keeping a file open).
+    """
+
+    def __init__(self, max_workers=None, max_open_streams=64):
+        self._max_workers = max_workers
+        self._max_open_streams = max_open_streams
+        self._executor = None
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._max_workers, thread_name_prefix='aiida-repository-async')
+            return self._executor
+
+    async def run(self, func, *args, **kwargs):
+        """Run `func(*args, **kwargs)` in the pool of threads, and return its result."""
+        return await asyncio.get_event_loop().run_in_executor(
+            self._get_executor(), functools.partial(func, *args, **kwargs))
+
+    def get_stream_semaphore(self):
+        """Return the semaphore limiting the number of open streams in the current event loop."""
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            try:
+                return self._semaphores[loop]
+            except KeyError:
+                # Forget the loops that were closed (e.g. at the end of each `asyncio.run`), not to keep them alive.
+                # Weak keys would not be enough, as the semaphores can reference their loop
+                for closed_loop in [other_loop for other_loop in self._semaphores if other_loop.is_closed()]:
+                    del self._semaphores[closed_loop]
+                self._semaphores[loop] = asyncio.Semaphore(self._max_open_streams)
+                return self._semaphores[loop]
+
+    def shutdown(self):
+        """Shut down the pool of threads (a new one is created if needed again)."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+            self._semaphores = {}
+
+
+# Used by `NodeRepository` objects created directly, without a `Repository`
+_DEFAULT_ASYNC_RUNNER = _AsyncRunner()
+
+
+async def _init_asyncpg_connection(connection):
+    """Decode JSONB values as Python objects, as SQLAlchemy does."""
+    await connection.set_type_codec('jsonb', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+def _rewrite_folder_meta(folder_meta, old_new_obj_hashkey_mapping):
+    """Return a copy of a folder_meta, replacing the object hash keys according to the given mapping.
+
+    :param folder_meta: a JSON folder_meta or a manifest. The copy is always a JSON folder_meta
+    """
+    if is_manifest(folder_meta):
+        folder_meta = decode_manifest(folder_meta)
+
+    def rewrite_dir(element):
+        new_element = {}
+        for name, metadata in element.items():
+            if 'dir' in metadata:
+                new_element[name] = {'dir': rewrite_dir(metadata['dir'])}
+            else:
+                new_element[name] = dict(metadata, obj=old_new_obj_hashkey_mapping[metadata['obj']])
+        return new_element
+
+    return {'dir': rewrite_dir(folder_meta['dir'])}
+
+
+def _iter_file_entries(folder_meta):
+    """Yield the entries (`{'obj': hashkey, 'size': size}` dictionaries) of all files of a JSON folder_meta."""
+    to_visit = [folder_meta['dir']]
+    while to_visit:
+        for metadata in to_visit.pop().values():
+            if 'dir' in metadata:
+                to_visit.append(metadata['dir'])
+            else:
+                yield metadata
+
+
+def _iter_file_sizes(folder_meta):
+    """Yield the size of each file of a folder_meta, or None if it is not known.
+
+    :param folder_meta: a JSON folder_meta or a manifest
+    """
+    if is_manifest(folder_meta):
+        return (size for _, _, obj_hashkey, size in iter_manifest_entries(folder_meta) if obj_hashkey is not None)
+    return (metadata.get('size') for metadata in _iter_file_entries(folder_meta))
+
+
+def _apply_change(folder_meta, node_uuid, operation, pieces, entry=None):
+    """Apply a change to a JSON folder_meta, in place.
+
+    The folder_meta is only modified if the change is valid.
+
+    :param operation: 'put' (store `entry`, a `{'obj': hashkey, 'size': size}` dictionary, as the file at the path,
+        creating the missing parent directories), 'mkdir' (create the directory and its parents, if they do not
+        exist) or 'delete' (remove the file or the directory, with all its content)
+    :param pieces: the tuple of the components of the path (non-empty, except for 'mkdir')
+    :raises IOError: if the change is not possible, e.g. a parent is a file or the path to delete does not exist
+    """
+    element = folder_meta['dir']
+    dir_pieces = pieces if operation == 'mkdir' else pieces[:-1]
+    for idx, piece in enumerate(dir_pieces):
+        metadata = element.get(piece)
+        if metadata is None:
+            if operation == 'delete':
+                raise IOError("{} not found in node {}".format(os.sep.join(pieces), node_uuid))
+            # The following pieces do not exist either: they are all created, so nothing can fail after this point
+            metadata = element[piece] = {'dir': {}}
+        elif 'dir' not in metadata:
+            raise IOError("{} is not a directory in node {}".format(os.sep.join(pieces[:idx + 1]), node_uuid))
+        element = metadata['dir']
+    if operation == 'put':
+        if 'dir' in element.get(pieces[-1], {}):
+            raise IOError("{} is a directory in node {}".format(os.sep.join(pieces), node_uuid))
+        element[pieces[-1]] = entry
+    elif operation == 'delete':
+        if pieces[-1] not in element:
+            raise IOError("{} not found in node {}".format(os.sep.join(pieces), node_uuid))
+        del element[pieces[-1]]
+
+
+def _get_node_repo_row(node_uuid, folder_meta, folder_meta_format):
+    """Return the row of the `db_noderepo` table for a node.
+
+    :param folder_meta: a JSON folder_meta or a manifest
+    :param folder_meta_format: the format in which to store the folder_meta, 'json' or 'compact'
+    :return: a dictionary with the `node_uuid`, `folder_meta`, `folder_manifest`, `file_count`
+        and `total_size` columns
+    """
+    sizes = list(_iter_file_sizes(folder_meta))
+    if folder_meta_format == 'compact':
+        row = {
+            'node_uuid': node_uuid,
+            'folder_meta': None,
+            'folder_manifest': bytes(folder_meta) if is_manifest(folder_meta) else encode_folder_meta(folder_meta)
+        }
+    else:
+        row = {
+            'node_uuid': node_uuid,
+            'folder_meta': decode_manifest(folder_meta) if is_manifest(folder_meta) else folder_meta,
+            'folder_manifest': None
+        }
+    row['file_count'] = len(sizes)
+    row['total_size'] = None if None in sizes else sum(sizes)
+    return row
+
 
 class Repository:
 
-    def __init__(self, db_user, db_name, db_password, folder, db_port=5432, db_host="localhost", pack_size_target=4*1024*1024*1024): # pylint: disable=too-many-arguments
-        self._container = Container(folder=folder)
+    # Valid values of the `folder_meta_format` parameter
+    FOLDER_META_FORMATS = ('json', 'compact')
+    # Number of nodes whose folders are scanned (and, when resuming, checked in the DB) together
+    _SCAN_CHUNK_SIZE = 1000
+    # Number of nodes exported together to a folder
+    _EXPORT_CHUNK_SIZE = 1000
+    # Number of node UUIDs fetched together by `iter_node_uuids`, and nodes retrieved together
+    # by `iter_node_repositories`
+    _ITER_CHUNK_SIZE = 1000
+    # Maximum number of node UUIDs in a single `IN (...)` clause (SQLite limits the number of parameters to 999
+    # before version 3.32, see `bulk._MAX_SQL_VARIABLES`)
+    _IN_CHUNK_SIZE = 950
+    # Objects moved by `repack_nodes` are copied in batches of about this size (in bytes), between which
+    # the time budget is checked
+    _REPACK_BATCH_SIZE = 64 * 1024 * 1024
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self, db_user, db_name, db_password, folder, db_port=5432, db_host="localhost",
+            pack_size_target=4*1024*1024*1024, pool_size=5, max_overflow=10, cache_max_size=None, db_url=None,
+            metrics=None, async_max_workers=None, async_max_open_streams=64, backend=None, folder_meta_format='json'):
+        """Create a repository object.
+
+        No connection to the DB is made until it is actually needed. Note that the DB schema is not
+        created automatically: call `create_schema` once, when setting up a new DB.
+
+        The object can be shared between threads: each thread gets its own DB session and its own
+        instance of the container.
+
+        :param pool_size: number of DB connections to keep open in the pool
+        :param max_overflow: number of DB connections that can be opened in addition to `pool_size`
+            when needed (e.g. when more threads are accessing the DB)
+        :param cache_max_size: if specified, keep in memory the folder_meta of the most recently used nodes,
+            up to this (approximate) total size in bytes. The cache is only valid if all changes to the DB are
+            done through this object.
+        :param db_url: if specified, the SQLAlchemy URL of the DB to use (e.g. `sqlite:////path/to/file.sqlite`),
+            instead of the PostgreSQL DB defined by `db_user`, `db_name`, `db_password`, `db_host` and `db_port`
+            (that are then ignored). With a SQLite file, the repository does not need any DB server:
+            see `backends.SqliteBackend`.
+        :param metrics: a `Metrics` object (see the `metrics` module) to which timings and counters are reported.
+            If None, metrics are not collected.
+        :param async_max_workers: maximum number of threads running the blocking operations of the async API
+            (methods starting with `a`). If None, use the default of the `ThreadPoolExecutor`
+        :param async_max_open_streams: maximum number of objects streamed at the same time with
+            `NodeRepository.aiter_object_chunks`, in each event loop. This bounds the number of open files
+        :param backend: the `backends.MetadataBackend` creating the connections to the DB. If None, use the backend
+            for the database of the URL, with the default settings (see `backends.get_backend`)
+        :param folder_meta_format: how the folder_meta of the nodes written by this object is stored in the DB:
+            'json' (in the `folder_meta` column) or 'compact' (in the `folder_manifest` column, see the `manifest`
+            module). Nodes in both formats can always be read. See `migrate_folder_meta` to convert existing nodes
+        """
+        if folder_meta_format not in self.FOLDER_META_FORMATS:
+            raise ValueError("Unknown folder_meta format '{}', valid formats are: {}".format(
+                folder_meta_format, ', '.join(self.FOLDER_META_FORMATS)))
+        self._container = _ThreadLocalContainer(folder=folder)
         if not self._container.is_initialised:
             self._container.init_container(pack_size_target=pack_size_target, loose_prefix_len=2, hash_type='sha256')
         self._db_user = db_user
@@ -31,84 +340,1047 @@ class Repository:
         self._db_password = db_password
         self._db_host = db_host
         self._db_port = db_port
-        self._session = None
-        self._initialize_db()
+        self._db_url = db_url
+        self._pool_size = pool_size
+        self._max_overflow = max_overflow
+        self._folder_meta_cache = FolderMetaCache(max_size=cache_max_size) if cache_max_size else None
+        self._metrics = metrics if metrics is not None else NULL_METRICS
+        self._async_runner = _AsyncRunner(max_workers=async_max_workers, max_open_streams=async_max_open_streams)
+        # asyncpg pools, one per event loop (or rather a future resolving to it)
+        self._asyncpg_pools = {}
+        self._use_asyncpg = asyncpg is not None and self._get_db_url().get_backend_name() == 'postgresql'
+        self._backend = backend if backend is not None else get_backend(self._get_db_url())
+        self._folder_meta_format = folder_meta_format
+        self._engine = None
+        self._session_factory = None
+        self._scoped_session = None
+        self._engine_lock = threading.Lock()
+
+    def create_schema(self):
+        """Create the tables in the DB, if they do not exist yet.
 
-    def _initialize_db(self):
-        self._get_session(create=True)
+        The tables created by a previous version are upgraded, adding the missing columns and making unique
+        the index on the node UUIDs (see `models.add_unique_node_uuid_index`).
+        """
+        # Create all tables in the engine. This is equivalent to "Create Table"
+        # statements in raw SQL.
+        Base.metadata.create_all(self._get_engine())
+        add_missing_columns(self._get_engine())
+        add_unique_node_uuid_index(self._get_engine())
 
     def drop_db(self):
         session = self._get_cached_session()
         session.query(DbNodeRepo).delete()
         session.commit()
+        self.invalidate_cache()
 
-    def _get_session(self, create=False):
-        """Return a new session to connect to the pack-index SQLite DB."""
-        engine = create_engine('postgresql://{}:{}@{}:{}/{}'.format(
-            self._db_user, self._db_password, self._db_host, self._db_port, self._db_name
-        ))
+    def get_cache_info(self):
+        """Return a `CacheInfo` named tuple with the statistics of the folder_meta cache, or None if disabled."""
+        if self._folder_meta_cache is None:
+            return None
+        return self._folder_meta_cache.get_info()
 
-        if create:
-            # Create all tables in the engine. This is equivalent to "Create Table"
-            # statements in raw SQL.
-            Base.metadata.create_all(engine)
+    def invalidate_cache(self, node_uuids=None):
+        """Remove the given nodes (all nodes if `node_uuids` is None) from the folder_meta cache, if enabled.
+
+        This is needed only if the DB is modified without using this object.
+        """
+        if self._folder_meta_cache is not None:
+            if node_uuids is not None:
+                node_uuids = [normalize_node_uuid(node_uuid) for node_uuid in node_uuids]
+            self._folder_meta_cache.invalidate(node_uuids)
+
+    def _get_engine(self):
+        """Return the SQLAlchemy engine (with its pool of connections), creating it on first use."""
+        if self._engine is None:
+            with self._engine_lock:
+                # Check again: another thread might have created it while waiting for the lock
+                if self._engine is None:
+                    engine = self._backend.create_engine(
+                        self._get_db_url(), pool_size=self._pool_size, max_overflow=self._max_overflow)
+                    if self._metrics.enabled:
+                        self._add_query_timer(engine)
+                    ## See e.g.
+                    ##http://pythoncentral.io/introductory-tutorial-python-sqlalchemy/
+
+                    # A session establishes all conversations with the database
+                    # and represents a "staging zone" for all the objects loaded into the
+                    # database session object. Any change made against the objects in the
+                    # session won't be persisted into the database until you call
+                    # session.commit(). If you're not happy about the changes, you can
+                    # revert all of them back to the last commit by calling
+                    # session.rollback()
+                    self._session_factory = sessionmaker(bind=engine)
+                    # The scoped_session registry returns a different session for each thread.
+                    self._scoped_session = scoped_session(self._session_factory)
+                    self._engine = engine
+        return self._engine
+
+    def _get_db_url(self):
+        """Return the SQLAlchemy URL of the DB."""
+        return make_url(self._db_url or 'postgresql://{}:{}@{}:{}/{}'.format(
+            self._db_user, self._db_password, self._db_host, self._db_port, self._db_name))
+
+    def _add_query_timer(self, engine):
+        """Report the time spent by each SQL statement executed by the engine as the `db.query` timing."""
+        metrics = self._metrics
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument,too-many-arguments
+            conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):  # pylint: disable=unused-argument,too-many-arguments
+            metrics.timing('db.query', time.perf_counter() - conn.info['query_start_time'].pop())
+
+    def close(self):
+        """Close the session of the current thread and all connections to the DB.
+
+        The repository can still be used afterwards: a new engine will be created when needed.
+        This also stops the threads of the async API; to close its asyncpg connections, use `aclose`.
+        """
+        self._container.close()
+        self._async_runner.shutdown()
+        with self._engine_lock:
+            if self._engine is not None:
+                self._scoped_session.remove()
+                self._engine.dispose()
+                self._engine = None
+                self._session_factory = None
+                self._scoped_session = None
 
-        # Bind the engine to the metadata of the Base class so that the
-        # declaratives can be accessed through a DBSession instance
-        Base.metadata.bind = engine
-        
-        ## See e.g.
-        ##http://pythoncentral.io/introductory-tutorial-python-sqlalchemy/
-
-        DBSession = sessionmaker(bind=engine)
-        # A DBSession() instance establishes all conversations with the database
-        # and represents a "staging zone" for all the objects loaded into the
-        # database session object. Any change made against the objects in the
-        # session won't be persisted into the database until you call
-        # session.commit(). If you're not happy about the changes, you can
-        # revert all of them back to the last commit by calling
-        # session.rollback()
-        session = DBSession()
-
-        return session
-    
     @property
     def container(self):
         return self._container
 
+    @property
+    def metrics(self):
+        """The `Metrics` object to which timings and counters are reported."""
+        return self._metrics
+
     def _get_cached_session(self):
-        """Return the SQLAlchemy session to access the SQLite file,
-        reusing the same one."""
-        if self._session is None:
-            self._session = self._get_session(create=False)
-        return self._session
+        """Return the SQLAlchemy session to access the DB, reusing the same one within each thread."""
+        self._get_engine()
+        return self._scoped_session()
+
+    @contextlib.contextmanager
+    def _get_read_session(self):
+        """Return a context manager yielding a new, short-lived SQLAlchemy session for read-only queries.
+
+        The session is closed at the end, so that its connection goes back to the pool immediately
+        instead of staying idle in a transaction (that would exhaust the pool when many threads read).
+        """
+        self._get_engine()
+        session = self._session_factory()
+        try:
+            yield session
+        finally:
+            session.close()
 
-    def get_node_repository(self, node_uuid):
+    async def aclose(self):
+        """Close the asyncpg connections of the current event loop, if any, and then everything else, see `close`."""
+        pool_future = self._asyncpg_pools.pop(asyncio.get_event_loop(), None)
+        if pool_future is not None:
+            await (await pool_future).close()
+        self.close()
+
+    def get_node_repository(self, node_uuid, lazy=False):
+        """Return the `NodeRepository` of a node.
+
+        :param lazy: if True and the folder_meta of the node is not in the cache, return a `LazyNodeRepository`,
+            that looks up in the DB only the paths that are accessed instead of retrieving the whole folder_meta.
+            This is faster to access a few files of nodes with many files
+        :raises sqlalchemy.orm.exc.NoResultFound: if the node is not in the DB (for a `LazyNodeRepository`,
+            when accessing its content)
+        """
+        node_uuid = normalize_node_uuid(node_uuid)
+        if lazy:
+            folder_metas, _ = self._get_cached_folder_metas([node_uuid])
+            if node_uuid not in folder_metas:
+                return LazyNodeRepository(node_uuid=node_uuid, repository=self)
+            return NodeRepository(
+                node_uuid=node_uuid,
+                container=self._container,
+                folder_meta=folder_metas[node_uuid],
+                metrics=self._metrics,
+                async_runner=self._async_runner)
         return NodeRepository(
             node_uuid=node_uuid,
             container=self._container,
-            folder_meta=self._get_folder_meta(node_uuid))
+            folder_meta=self._get_folder_meta(node_uuid),
+            metrics=self._metrics,
+            async_runner=self._async_runner)
+
+    def begin_node_transaction(self, node_uuid, loose=False, compress=False):
+        """Return a `NodeTransaction` to change the content of a node (created on commit, if it does not exist).
+
+        :param loose: if True, the new objects are written as loose objects on commit, which is faster for a few
+            objects, and can be done by many processes at the same time (writing to the packs must be done by one
+            process at a time, as in `create_repo_for_nodes`). They can be packed later with `pack_loose_objects`
+        :param compress: if True, compress the new objects (only when writing them to the packs); 'auto' or an
+            `AdaptiveCompression` to decide for each object (see the `compression` module)
+        """
+        node_uuid = normalize_node_uuid(node_uuid)
+        folder_meta = self._get_folder_metas([node_uuid]).get(node_uuid)
+        return NodeTransaction(self, node_uuid, folder_meta, loose=loose, compress=get_compression_policy(compress))
+
+    def _commit_node_changes(self, node_uuid, changes):
+        """Apply changes to the folder_meta of a node, as currently in the DB, and store it with a single statement.
+
+        The row of the node is locked until the end of the transaction (the whole DB on SQLite, see
+        `MetadataBackend.begin_node_write`), so that concurrent changes to the same node are not lost. If the node is new and another transaction creates it in the
+        meantime, the unique index on the node UUIDs makes the insert fail: the changes are then applied again
+        to the row created by the other transaction.
+
+        :param changes: a list of tuples (operation, pieces, entry), see `_apply_change`
+        :return: the `NodeRepository` of the node, with its new content
+        :raises IOError: if a change is not possible (the DB is then left unchanged)
+        """
+
+        def write(session):
+            self._backend.begin_node_write(session)
+            result = session.query(DbNodeRepo).filter(DbNodeRepo.node_uuid == node_uuid).with_entities(
+                DbNodeRepo.folder_meta, DbNodeRepo.folder_manifest).with_for_update().first()
+            if result is None:
+                folder_meta = {'dir': {}}
+            elif result[1] is not None:
+                folder_meta = decode_manifest(result[1])
+            else:
+                # Copied, as it is changed in place and could be retried
+                folder_meta = copy.deepcopy(result[0])
+            for operation, pieces, entry in changes:
+                _apply_change(folder_meta, node_uuid, operation, pieces, entry)
+            row = _get_node_repo_row(node_uuid, folder_meta, self._folder_meta_format)
+            if result is None:
+                bulk_insert_node_repos(session, [row])
+            else:
+                update_node_repos(session, [row])
+            return folder_meta
+
+        folder_meta = _commit_with_retry(self._get_cached_session(), write)
+        self.invalidate_cache([node_uuid])
+        return NodeRepository(node_uuid=node_uuid,
+                              container=self._container,
+                              folder_meta=folder_meta,
+                              metrics=self._metrics,
+                              async_runner=self._async_runner)
+
+    def pack_loose_objects(self, compress=False, clean=False):
+        """Move the loose objects (e.g. written by a `NodeTransaction` with `loose=True`) to the packs.
+
+        This is a maintenance operation of the container, to be run by one process at a time.
+
+        :param compress: if True, compress the objects in the packs
+        :param clean: if True, also delete the loose copies of the objects that are now packed
+            (with `Container.clean_storage`): this must only be done when nobody else is using the repository
+        """
+        with self._metrics.timer('write.pack_loose'):
+            self._container.pack_all_loose(compress=compress)
+            if clean:
+                self._container.clean_storage()
 
     def get_all_node_uuids(self):
-        session = self._get_cached_session()
-        all_uuids = []
-        for res in session.query(DbNodeRepo).with_entities(DbNodeRepo.node_uuid):
-            all_uuids.append(res[0])
-        return all_uuids
+        """Return a list with the UUIDs of all nodes in the repository, see also `iter_node_uuids`."""
+        return list(self.iter_node_uuids())
+
+    def iter_node_uuids(self, chunk_size=None, start_after=None):
+        """Yield the UUIDs of all nodes in the repository, in the order in which they were added.
+
+        The UUIDs are fetched from the DB `chunk_size` at a time with a server-side cursor (on PostgreSQL),
+        so the memory used does not depend on the number of nodes. A DB connection is used until
+        the generator is exhausted or closed.
+
+        :param chunk_size: number of UUIDs fetched at a time. If None, use `_ITER_CHUNK_SIZE`
+        :param start_after: if specified, only yield the nodes added after the node with this UUID
+            (all nodes, if it is not in the repository anymore), e.g. to continue an operation that was stopped
+        """
+        with self._get_read_session() as session:
+            query = session.query(DbNodeRepo).with_entities(DbNodeRepo.node_uuid).order_by(DbNodeRepo.id)
+            if start_after is not None:
+                start_id = session.query(DbNodeRepo).filter(DbNodeRepo.node_uuid == start_after).with_entities(
+                    DbNodeRepo.id).scalar()
+                if start_id is not None:
+                    query = query.filter(DbNodeRepo.id > start_id)
+            # `yield_per` also enables `stream_results`, i.e. a server-side cursor on PostgreSQL with psycopg2
+            for res in query.yield_per(chunk_size or self._ITER_CHUNK_SIZE):
+                yield res[0]
+
+    def get_largest_nodes(self, limit=100):
+        """Return the nodes whose files have the largest total size, with a single query using the index of the DB.
+
+        Nodes whose total size is not known (imported by a previous version, see `add_missing_sizes`) are ignored.
+
+        :param limit: maximum number of nodes to return
+        :return: a list of tuples (node_uuid, file_count, total_size), sorted by decreasing total size
+        """
+        with self._get_read_session() as session:
+            return [
+                tuple(res) for res in session.query(DbNodeRepo).filter(DbNodeRepo.total_size.isnot(None)).order_by(
+                    DbNodeRepo.total_size.desc()).with_entities(DbNodeRepo.node_uuid, DbNodeRepo.file_count,
+                                                                DbNodeRepo.total_size).limit(limit)
+            ]
+
+    def iter_node_repositories(self, node_uuids=None, chunk_size=None):
+        """Yield the `NodeRepository` of the given nodes, retrieving them `chunk_size` at a time.
+
+        Only the folder_meta of one chunk of nodes are kept in memory (in addition to the cache, if enabled).
+
+        :param node_uuids: an iterable of node UUIDs. If None, yield all nodes of the repository,
+            in the order of `iter_node_uuids`
+        :param chunk_size: number of nodes retrieved with each query. If None, use `_ITER_CHUNK_SIZE`
+        """
+        chunk_size = chunk_size or self._ITER_CHUNK_SIZE
+        if node_uuids is None:
+            node_uuids = self.iter_node_uuids(chunk_size=chunk_size)
+        node_uuids = map(normalize_node_uuid, node_uuids)
+        while True:
+            chunk = list(itertools.islice(node_uuids, chunk_size))
+            if not chunk:
+                return
+            yield from self.get_node_repositories(chunk)
 
     def get_node_repositories(self, node_uuids):
+        node_uuids = [normalize_node_uuid(node_uuid) for node_uuid in node_uuids]
         folder_metas = self._get_folder_metas(node_uuids)
 
         return [NodeRepository(node_uuid=node_uuid,
             container=self._container,
-            folder_meta=folder_metas[node_uuid]) for node_uuid in node_uuids]
+            folder_meta=folder_metas[node_uuid],
+            metrics=self._metrics,
+            async_runner=self._async_runner) for node_uuid in node_uuids]
+
+    async def aget_node_repository(self, node_uuid):
+        """Async version of `get_node_repository`.
+
+        The folder_meta is retrieved with asyncpg if it is installed and the DB is PostgreSQL,
+        otherwise in the pool of threads of the async API.
+
+        :raises sqlalchemy.orm.exc.NoResultFound: if the node is not in the DB
+        """
+        node_uuid = normalize_node_uuid(node_uuid)
+        folder_metas = await self._aget_folder_metas([node_uuid])
+        try:
+            folder_meta = folder_metas[node_uuid]
+        except KeyError:
+            raise NoResultFound("Node {} not found in the repository".format(node_uuid))
+        return NodeRepository(
+            node_uuid=node_uuid,
+            container=self._container,
+            folder_meta=folder_meta,
+            metrics=self._metrics,
+            async_runner=self._async_runner)
+
+    async def aget_node_repositories(self, node_uuids):
+        """Async version of `get_node_repositories`, see `aget_node_repository`."""
+        node_uuids = [normalize_node_uuid(node_uuid) for node_uuid in node_uuids]
+        folder_metas = await self._aget_folder_metas(node_uuids)
+
+        return [NodeRepository(node_uuid=node_uuid,
+            container=self._container,
+            folder_meta=folder_metas[node_uuid],
+            metrics=self._metrics,
+            async_runner=self._async_runner) for node_uuid in node_uuids]
+
+    @contextlib.contextmanager
+    def get_objects_stream(self, keys_by_node):
+        """Return a context manager yielding a generator of triplets (node_uuid, key, stream) for objects of many nodes.
+
+        All objects are retrieved with a single call to the container, so they are yielded in the order
+        in which they are stored, and each pack is opened only once, see `NodeRepository.get_objects_stream`.
+        Each stream must be consumed before moving to the next triplet, as it is then closed.
+
+        :param keys_by_node: a dictionary where keys are node UUIDs, and values iterables of keys in that node
+        :raises IOError: if any of the keys does not exist, or is not a file
+        """
+        keys_by_node = {normalize_node_uuid(node_uuid): keys for node_uuid, keys in keys_by_node.items()}
+        targets_by_hashkey = collections.defaultdict(list)
+        for node_repo in self.get_node_repositories(list(keys_by_node)):
+            for obj_hashkey, keys in node_repo._get_keys_by_hashkey(keys_by_node[node_repo.node_uuid]).items():  # pylint: disable=protected-access
+                targets_by_hashkey[obj_hashkey].extend((node_repo.node_uuid, key) for key in keys)
+
+        self._metrics.count('read.objects', sum(len(targets) for targets in targets_by_hashkey.values()))
+        with self._container.get_objects_stream_and_meta(list(targets_by_hashkey), skip_if_missing=False) as triplets:
+            yield ((node_uuid, key, stream)
+                   for (node_uuid, key), stream, _ in _iter_target_streams(triplets, targets_by_hashkey))
+
+    def get_objects_content(self, keys_by_node):
+        """Return the content of objects of many nodes, see `get_objects_stream`.
+
+        :param keys_by_node: a dictionary where keys are node UUIDs, and values iterables of keys in that node
+        :return: a dictionary where keys are node UUIDs (in the canonical form, see `models.normalize_node_uuid`),
+            and values dictionaries with the content of the objects of that node, with their keys as keys
+        """
+        contents = collections.defaultdict(dict)
+        num_bytes = 0
+        with self.get_objects_stream(keys_by_node) as triplets:
+            for node_uuid, key, stream in triplets:
+                contents[node_uuid][key] = stream.read()
+                num_bytes += len(contents[node_uuid][key])
+        self._metrics.count('read.bytes', num_bytes)
+        return dict(contents)
+
+    async def aget_objects_content(self, keys_by_node):
+        """Async version of `get_objects_content`, run in the pool of threads of the async API."""
+        return await self._async_runner.run(self.get_objects_content, keys_by_node)
+
+    def export_nodes_to_folder(  # pylint: disable=too-many-locals,too-many-arguments
+            self, node_uuids, dest, workers=None, max_open_files=64, chunk_size=1024 * 1024):
+        """Write the content of the given nodes to files in `dest`, using the layout of the legacy repository.
+
+        The folder of each node is `dest/xx/yy/zzzz...`, where `xxyyzzzz...` is the node UUID, and it must not exist.
+        Nodes are processed `_EXPORT_CHUNK_SIZE` at a time: the directories of all nodes of a chunk
+        are created first, and then the objects are read in the order in which they are stored in the container.
+        Objects up to `chunk_size` bytes are read in memory and written by a pool of threads; larger objects are
+        copied in chunks of `chunk_size` bytes.
+
+        :param node_uuids: an iterable of node UUIDs
+        :param dest: the folder in which to create the node folders
+        :param workers: number of threads writing files. If None, use the default of the `ThreadPoolExecutor`
+        :param max_open_files: maximum number of files being written at the same time. This also limits
+            the memory used, to about `max_open_files * chunk_size` bytes
+        :param chunk_size: size of the chunks in which large objects are copied
+        """
+        node_uuids = map(normalize_node_uuid, node_uuids)
+        write_slots = threading.BoundedSemaphore(max_open_files)
+        errors = []
+
+        def write_file(path, content):
+            try:
+                with open(path, 'wb') as fhandle:
+                    fhandle.write(content)
+            finally:
+                write_slots.release()
+
+        def check_errors(future):
+            if future.exception() is not None:
+                errors.append(future.exception())
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while not errors:
+                chunk = list(itertools.islice(node_uuids, self._EXPORT_CHUNK_SIZE))
+                if not chunk:
+                    break
+                chunk_start = time.perf_counter()
+                num_files = 0
+                num_bytes = 0
+
+                # Create all directories, and collect the destination paths of each object
+                paths_by_hashkey = collections.defaultdict(list)
+                for node_repo in self.get_node_repositories(chunk):
+                    node_folder = os.path.join(dest, node_repo.node_uuid[:2], node_repo.node_uuid[2:4],
+                                               node_repo.node_uuid[4:])
+                    os.makedirs(node_folder)
+                    index = node_repo._get_index()  # pylint: disable=protected-access
+                    # Sorting guarantees that each directory comes after its parent
+                    for dir_path in sorted(index.children):
+                        if dir_path:
+                            os.mkdir(os.path.join(node_folder, dir_path))
+                    for path, obj_hashkey in index.objects.items():
+                        paths_by_hashkey[obj_hashkey].append(os.path.join(node_folder, path))
+
+                with self._container.get_objects_stream_and_meta(
+                        list(paths_by_hashkey), skip_if_missing=False) as triplets:
+                    for path, stream, meta in _iter_target_streams(triplets, paths_by_hashkey):
+                        if errors:
+                            break
+                        num_files += 1
+                        num_bytes += meta['size']
+                        write_slots.acquire()
+                        if meta['size'] <= chunk_size:
+                            future = executor.submit(write_file, path, stream.read())
+                            future.add_done_callback(check_errors)
+                        else:
+                            try:
+                                with open(path, 'wb') as fhandle:
+                                    shutil.copyfileobj(stream, fhandle, chunk_size)
+                            finally:
+                                write_slots.release()
+
+                self._metrics.timing('export_to_folder', time.perf_counter() - chunk_start)
+                self._metrics.count('export_to_folder.nodes', len(chunk))
+                self._metrics.count('export_to_folder.files', num_files)
+                self._metrics.count('export_to_folder.bytes_written', num_bytes)
+
+        if errors:
+            raise errors[0]
+
+    def export_nodes(  # pylint: disable=too-many-locals,too-many-statements
+            self, target_repository, node_uuids, max_memory=100 * 1024 * 1024, compress=False):
+        """Export the given nodes, with their objects, to another repository.
+
+        Nodes are processed `_EXPORT_CHUNK_SIZE` at a time. For each chunk:
+
+        - objects that are already in the target container are skipped (if both containers use the same hash type);
+        - the other objects are read from this container by a producer thread, in the order in which they are
+          stored, and written in bulk to the packs of the target container by a consumer thread (the current one).
+          The content of objects in transit is kept within `max_memory` bytes; objects larger than `max_memory`
+          are not read by the producer, but streamed directly by the consumer;
+        - the folder_meta of the nodes, rewritten with the hash keys of the target container, are written to the DB
+          of the target repository in bulk. Nodes already present in the target repository are updated.
+
+        :param target_repository: the `Repository` to export to
+        :param node_uuids: an iterable of node UUIDs
+        :param max_memory: maximum size, in bytes, of the object content kept in memory
+        :param compress: if True, compress objects when writing them to the target container; 'auto' or an
+            `AdaptiveCompression` to decide for each object (see the `compression` module)
+        :raises sqlalchemy.orm.exc.NoResultFound: if some nodes are not in this repository. The nodes of the previous
+            chunks are already exported, those of the chunk of the missing nodes are not
+        """
+        compress = get_compression_policy(compress)
+        # The decisions of an adaptive policy, if any
+        stats = None if isinstance(compress, bool) else CompressionStats()
+        node_uuids = map(normalize_node_uuid, node_uuids)
+        target_container = target_repository.container
+        same_hash_type = self._container.hash_type == target_container.hash_type
+
+        while True:
+            chunk = list(itertools.islice(node_uuids, self._EXPORT_CHUNK_SIZE))
+            if not chunk:
+                break
+            folder_metas = self._get_folder_metas(chunk)
+            missing = [node_uuid for node_uuid in chunk if node_uuid not in folder_metas]
+            if missing:
+                raise NoResultFound("Nodes not found in the repository: {}".format(', '.join(missing)))
+            chunk_start = time.perf_counter()
+            obj_hashkeys = set()
+            # The name of one of the files of each object, for an adaptive compression policy
+            names = {}
+            for node_uuid in chunk:
+                if stats is None:
+                    node_repo = NodeRepository(
+                        node_uuid=node_uuid, container=self._container, folder_meta=folder_metas[node_uuid])
+                    obj_hashkeys.update(node_repo.get_all_obj_hashkeys())
+                else:
+                    for path, obj_hashkey in _FolderIndex(folder_metas[node_uuid]).objects.items():
+                        names.setdefault(obj_hashkey, os.path.basename(path))
+                    obj_hashkeys.update(names)
+            obj_hashkeys = list(obj_hashkeys)
+            old_new_obj_hashkey_mapping = {}
+
+            if same_hash_type:
+                for obj_hashkey, exists in zip(obj_hashkeys, target_container.has_objects(obj_hashkeys)):
+                    if exists:
+                        old_new_obj_hashkey_mapping[obj_hashkey] = obj_hashkey
+                obj_hashkeys = [
+                    obj_hashkey for obj_hashkey in obj_hashkeys if obj_hashkey not in old_new_obj_hashkey_mapping]
+            self._metrics.count('export.objects_skipped', len(old_new_obj_hashkey_mapping))
+            self._metrics.count('export.objects_written', len(obj_hashkeys))
+
+            budget = _MemoryBudget(max_memory)
+            # Items are (old_hashkey, content, size), with content None for objects to stream directly;
+            # the producer puts a None item when done, or an exception if it fails
+            transit = queue.Queue()
+            stop_producer = threading.Event()
+            # Total size of the objects read by the producer, as a one-element list so that the producer can update it
+            read_bytes = [0]
+
+            def produce(obj_hashkeys=obj_hashkeys, budget=budget, transit=transit, stop_producer=stop_producer,
+                        read_bytes=read_bytes):
+                try:
+                    with self._container.get_objects_stream_and_meta(obj_hashkeys, skip_if_missing=False) as triplets:
+                        for obj_hashkey, stream, meta in triplets:
+                            if stop_producer.is_set():
+                                break
+                            if stream is None:
+                                raise IOError("Object {} not found in the container".format(obj_hashkey))
+                            read_bytes[0] += meta['size']
+                            if meta['size'] > max_memory:
+                                transit.put((obj_hashkey, None, 0))
+                            else:
+                                budget.acquire(meta['size'])
+                                transit.put((obj_hashkey, stream.read(), meta['size']))
+                    transit.put(None)
+                except Exception as exc:  # pylint: disable=broad-except
+                    transit.put(exc)
+
+            producer = threading.Thread(target=produce)
+            producer.start()
+            try:
+                done = False
+                while not done:
+                    # Wait for at least one item, then take all those that are ready
+                    items = [transit.get()]
+                    while True:
+                        try:
+                            items.append(transit.get_nowait())
+                        except queue.Empty:
+                            break
+                    batch = []
+                    for item in items:
+                        if item is None:
+                            done = True
+                        elif isinstance(item, Exception):
+                            raise item
+                        elif item[1] is None:
+                            # Large object: stream it directly from this container, in this thread
+                            if stats is None:
+                                with self._container.get_object_stream(item[0]) as stream:
+                                    new_obj_hashkeys = target_container.add_streamed_objects_to_pack(
+                                        [stream], compress=compress)
+                            else:
+                                new_obj_hashkeys = add_streamed_objects_to_pack_parallel(
+                                    target_container, [self._container.get_object_stream(item[0])],
+                                    compress=compress, workers=0, names=[names[item[0]]], stats=stats)
+                            old_new_obj_hashkey_mapping[item[0]] = new_obj_hashkeys[0]
+                        else:
+                            batch.append(item)
+                    if batch:
+                        if stats is None:
+                            new_obj_hashkeys = target_container.add_objects_to_pack(
+                                [content for _, content, _ in batch], compress=compress)
+                        else:
+                            # Objects with different decisions are written in the same call, keeping their order
+                            new_obj_hashkeys = add_streamed_objects_to_pack_parallel(
+                                target_container,
+                                [contextlib.nullcontext(io.BytesIO(content)) for _, content, _ in batch],
+                                compress=compress,
+                                workers=0,
+                                names=[names[obj_hashkey] for obj_hashkey, _, _ in batch],
+                                stats=stats)
+                        for (old_obj_hashkey, _, _), new_obj_hashkey in zip(batch, new_obj_hashkeys):
+                            old_new_obj_hashkey_mapping[old_obj_hashkey] = new_obj_hashkey
+                        budget.release(sum(size for _, _, size in batch))
+            finally:
+                stop_producer.set()
+                # Unblock the producer, if it is waiting for memory
+                budget.release(max_memory)
+                producer.join()
+            self._metrics.count('export.bytes_written', read_bytes[0])
+            self._metrics.timing('export.objects', time.perf_counter() - chunk_start)
+
+            with self._metrics.timer('export.commit'):
+                rows = [
+                    _get_node_repo_row(node_uuid, _rewrite_folder_meta(folder_meta, old_new_obj_hashkey_mapping),
+                                       target_repository.folder_meta_format)
+                    for node_uuid, folder_meta in folder_metas.items()]
+                _commit_with_retry(target_repository._get_cached_session(),  # pylint: disable=protected-access
+                                   lambda session, rows=rows: upsert_node_repos(session, rows))
+            target_repository.invalidate_cache(list(folder_metas))
+            self._metrics.count('export.nodes', len(folder_metas))
+        if stats is not None:
+            stats.report(self._metrics)
+
+    def verify(self, node_uuids=None, mode='full', workers=None, sample_fraction=0.01, seed=None):  # pylint: disable=too-many-arguments,too-many-locals
+        """Check that the objects of the given nodes exist in the container and are not corrupt.
+
+        Nodes are processed `_EXPORT_CHUNK_SIZE` at a time, reading their folder_meta from the DB (not from
+        the cache). Each object is checked once, even if referenced by many nodes; see the `verify` module for
+        the checks done in each mode. Objects are never loaded whole in memory.
+
+        :param node_uuids: an iterable of node UUIDs. If None, verify all nodes in the repository
+        :param mode: 'full' (hash again the content of all objects), 'sampled' (hash again the content of
+            a random fraction `sample_fraction` of the objects) or 'sizes' (only check the metadata)
+        :param workers: number of threads hashing objects. If None, use the default of the `ThreadPoolExecutor`
+        :param sample_fraction: fraction of the objects hashed in the 'sampled' mode
+        :param seed: random seed used to choose the objects to hash in the 'sampled' mode: the same seed hashes
+            the same objects, also in different processes
+        :return: a `verify.VerifyReport` named tuple
+        :raises ValueError: if the mode is not valid
+        """
+        if node_uuids is None:
+            node_uuids = self.iter_node_uuids()
+        node_uuids = map(normalize_node_uuid, node_uuids)
+        num_nodes = 0
+        missing_nodes = []
+        problems = []
+
+        with self._metrics.timer('verify'), ObjectChecker(
+                self._container, mode=mode, workers=workers, sample_fraction=sample_fraction, seed=seed) as checker:
+            while True:
+                chunk = list(itertools.islice(node_uuids, self._EXPORT_CHUNK_SIZE))
+                if not chunk:
+                    break
+                folder_metas = self._query_folder_metas(chunk)
+                indexes = {}
+                for node_uuid in chunk:
+                    if node_uuid in folder_metas:
+                        indexes[node_uuid] = _FolderIndex(folder_metas[node_uuid])
+                    else:
+                        missing_nodes.append(node_uuid)
+                chunk_problems = checker.check(
+                    obj_hashkey for index in indexes.values() for obj_hashkey in index.objects.values())
+                for node_uuid, index in indexes.items():
+                    problems.extend(
+                        ObjectProblem(node_uuid, path, obj_hashkey, chunk_problems[obj_hashkey])
+                        for path, obj_hashkey in sorted(index.objects.items())
+                        if obj_hashkey in chunk_problems)
+                num_nodes += len(indexes)
+                self._metrics.count('verify.nodes', len(indexes))
+
+        self._metrics.count('verify.objects', checker.num_checked)
+        self._metrics.count('verify.objects_hashed', checker.num_hashed)
+        self._metrics.count('verify.bytes_hashed', checker.bytes_hashed)
+        return VerifyReport(num_nodes=num_nodes,
+                            num_objects=checker.num_checked,
+                            num_hashed=checker.num_hashed,
+                            bytes_hashed=checker.bytes_hashed,
+                            missing_nodes=missing_nodes,
+                            problems=problems)
+
+    def repack_nodes(self, node_uuids=None, max_fragments=1, max_seconds=None, max_bytes=None, clean=False):  # pylint: disable=too-many-arguments,too-many-locals,too-many-statements
+        """Move the objects of the nodes whose content is scattered in the packs, so that each node is contiguous.
+
+        See the `repack` module. Nodes are processed `_EXPORT_CHUNK_SIZE` at a time, in the given order, and the
+        objects of each repacked node are written in the order of their paths, right after those of the previous
+        repacked node: to keep close the nodes that are read together, pass them one after the other. An object
+        used by more than one node belongs to the first of them that is checked: it is neither moved nor counted
+        in the fragments of the following ones (otherwise, it would be moved back and forth by each call). Calls that
+        continue from where a previous one stopped do not know the objects of the nodes checked before, and can move
+        again an object shared with them: a complete call leaves a layout that the next complete call keeps.
+
+        This is a maintenance operation of the container, to be run by one process at a time and not while objects
+        are written to the packs (e.g. by `create_repo_for_nodes`). The repository can be read in the meantime.
+
+        :param node_uuids: an iterable of node UUIDs. If None, all nodes in the order of `iter_node_uuids`;
+            use `iter_node_uuids(start_after=...)` to continue from where a previous call stopped
+        :param max_fragments: nodes whose objects are stored in more fragments than this are repacked
+        :param max_seconds: if specified, stop after about this time (at most one more batch of
+            `_REPACK_BATCH_SIZE` bytes is copied after it is reached)
+        :param max_bytes: if specified, stop before moving more than this number of bytes (except for the first
+            node to repack, that is always moved)
+        :param clean: if True, at the end delete the loose objects that are now packed, and compact the packs
+            that are mostly unused (see `repack.compact_packs`) to recover their space. This must only be done
+            when nobody else is using the repository
+        :return: a `RepackReport`
+        """
+        start = time.monotonic()
+        if node_uuids is None:
+            node_uuids = self.iter_node_uuids()
+        node_uuids = map(normalize_node_uuid, node_uuids)
+        # Raw digests of the objects of the nodes already checked
+        seen = set()
+        num_nodes = 0
+        repacked = []
+        num_objects_moved = 0
+        bytes_moved = 0
+        fragments_before = 0
+        fragments_after = 0
+        last_node_uuid = None
+        is_complete = True
+        deleted_packs = []
+
+        def move(to_move, obj_hashkeys_by_node):
+            """Move the objects, and return the total number of fragments of the given nodes afterwards."""
+            move_objects(self._container, to_move)
+            metas = dict(self._container.get_objects_meta(
+                list({obj_hashkey for obj_hashkeys in obj_hashkeys_by_node for obj_hashkey in obj_hashkeys})))
+            return sum(
+                count_fragments(metas[obj_hashkey] for obj_hashkey in obj_hashkeys if obj_hashkey in metas)
+                for obj_hashkeys in obj_hashkeys_by_node)
+
+        with self._metrics.timer('repack'):
+            while is_complete:
+                chunk = list(itertools.islice(node_uuids, self._EXPORT_CHUNK_SIZE))
+                if not chunk:
+                    break
+                obj_hashkeys = {}
+                for node_uuid, folder_meta in self._query_folder_metas(chunk).items():
+                    objects = _FolderIndex(folder_meta).objects
+                    # In the order of the paths, without duplicates
+                    obj_hashkeys[node_uuid] = list(dict.fromkeys(objects[path] for path in sorted(objects)))
+                metas = dict(self._container.get_objects_meta(
+                    list({obj_hashkey for node_obj_hashkeys in obj_hashkeys.values()
+                          for obj_hashkey in node_obj_hashkeys})))
+
+                own_obj_hashkeys = {}
+                to_move = []
+                to_move_size = 0
+                batch_nodes = []
+                for node_uuid in chunk:
+                    if max_seconds is not None and time.monotonic() - start > max_seconds:
+                        is_complete = False
+                        break
+                    # The objects of this node, except those of the nodes already checked
+                    node_obj_hashkeys = own_obj_hashkeys[node_uuid] = [
+                        obj_hashkey for obj_hashkey in obj_hashkeys.get(node_uuid, [])
+                        if obj_hashkey in metas and bytes.fromhex(obj_hashkey) not in seen
+                    ]
+                    fragments = count_fragments(metas[obj_hashkey] for obj_hashkey in node_obj_hashkeys)
+                    if fragments > max_fragments:
+                        size = sum(get_stored_length(metas[obj_hashkey]) for obj_hashkey in node_obj_hashkeys)
+                        if max_bytes is not None and bytes_moved and bytes_moved + size > max_bytes:
+                            is_complete = False
+                            break
+                        to_move.extend((obj_hashkey, metas[obj_hashkey]) for obj_hashkey in node_obj_hashkeys)
+                        to_move_size += size
+                        num_objects_moved += len(node_obj_hashkeys)
+                        bytes_moved += size
+                        fragments_before += fragments
+                        batch_nodes.append(node_uuid)
+                    seen.update(bytes.fromhex(obj_hashkey) for obj_hashkey in node_obj_hashkeys)
+                    if node_uuid in obj_hashkeys:
+                        num_nodes += 1
+                    last_node_uuid = node_uuid
+                    if to_move_size >= self._REPACK_BATCH_SIZE:
+                        fragments_after += move(to_move, [own_obj_hashkeys[batch_node] for batch_node in batch_nodes])
+                        repacked.extend(batch_nodes)
+                        to_move, to_move_size, batch_nodes = [], 0, []
+                if to_move:
+                    fragments_after += move(to_move, [own_obj_hashkeys[batch_node] for batch_node in batch_nodes])
+                    repacked.extend(batch_nodes)
+
+            if clean:
+                self._container.clean_storage()
+                _, deleted_packs = compact_packs(self._container)
+
+        self._metrics.count('repack.nodes', num_nodes)
+        self._metrics.count('repack.nodes_repacked', len(repacked))
+        self._metrics.count('repack.objects_moved', num_objects_moved)
+        self._metrics.count('repack.bytes_moved', bytes_moved)
+        self._metrics.count('repack.packs_deleted', len(deleted_packs))
+        return RepackReport(num_nodes=num_nodes,
+                            num_repacked=len(repacked),
+                            num_objects_moved=num_objects_moved,
+                            bytes_moved=bytes_moved,
+                            fragments_before=fragments_before,
+                            fragments_after=fragments_after,
+                            last_node_uuid=last_node_uuid,
+                            is_complete=is_complete,
+                            num_packs_deleted=len(deleted_packs))
+
+    @property
+    def folder_meta_format(self):
+        """The format in which the folder_meta of the nodes written by this object is stored, 'json' or 'compact'."""
+        return self._folder_meta_format
+
+    def migrate_folder_meta(self, folder_meta_format=None, chunk_size=1000):
+        """Convert the folder_meta of all nodes in the DB to the given format.
+
+        Nodes are converted `chunk_size` at a time, committing after each chunk: the migration can be interrupted
+        and run again, and the repository can be used in the meantime (both formats can be read).
+
+        :param folder_meta_format: the target format, one of `FOLDER_META_FORMATS`.
+            If None, use the format of this repository
+        :param chunk_size: number of nodes converted in each transaction
+        :return: the number of nodes that were converted
+        """
+        if folder_meta_format is None:
+            folder_meta_format = self._folder_meta_format
+        if folder_meta_format not in self.FOLDER_META_FORMATS:
+            raise ValueError("Unknown folder_meta format '{}', valid formats are: {}".format(
+                folder_meta_format, ', '.join(self.FOLDER_META_FORMATS)))
+        if folder_meta_format == 'compact':
+            to_convert = DbNodeRepo.folder_manifest.is_(None)
+        else:
+            to_convert = DbNodeRepo.folder_manifest.isnot(None)
+
+        session = self._get_cached_session()
+        num_converted = 0
+        last_id = 0
+        while True:
+            # Paginate on the primary key, so that each query only reads the next chunk
+            results = session.query(DbNodeRepo).filter(to_convert, DbNodeRepo.id > last_id).order_by(
+                DbNodeRepo.id).with_entities(DbNodeRepo.id, DbNodeRepo.node_uuid, DbNodeRepo.folder_meta,
+                                             DbNodeRepo.folder_manifest).limit(chunk_size).all()
+            if not results:
+                break
+            update_node_repos(session, [
+                _get_node_repo_row(
+                    node_uuid, folder_manifest if folder_manifest is not None else folder_meta, folder_meta_format)
+                for _, node_uuid, folder_meta, folder_manifest in results])
+            session.commit()
+            self.invalidate_cache([result[1] for result in results])
+            num_converted += len(results)
+            last_id = results[-1][0]
+        return num_converted
+
+    def add_missing_sizes(self, chunk_size=1000):
+        """Add the sizes of the files, and the totals of the nodes, to the nodes imported by a previous version.
+
+        The sizes are read from the metadata of the container, without reading the objects. Nodes are updated
+        `chunk_size` at a time, keeping their format and committing after each chunk: this can be interrupted
+        and run again, and the repository can be used in the meantime. Files whose object is not in the container
+        are left without a size (and the total size of their node unknown).
+
+        :param chunk_size: number of nodes updated in each transaction
+        :return: the number of nodes that were updated
+        """
+        session = self._get_cached_session()
+        num_updated = 0
+        last_id = 0
+        while True:
+            # Paginate on the primary key, so that each query only reads the next chunk
+            results = session.query(DbNodeRepo).filter(
+                DbNodeRepo.total_size.is_(None), DbNodeRepo.id > last_id).order_by(DbNodeRepo.id).with_entities(
+                    DbNodeRepo.id, DbNodeRepo.node_uuid, DbNodeRepo.folder_meta,
+                    DbNodeRepo.folder_manifest).limit(chunk_size).all()
+            if not results:
+                break
+            rows = []
+            file_entries = []
+            for _, node_uuid, folder_meta, folder_manifest in results:
+                if folder_manifest is not None:
+                    folder_meta = decode_manifest(folder_manifest)
+                file_entries.extend(_iter_file_entries(folder_meta))
+                rows.append((node_uuid, folder_meta, 'json' if folder_manifest is None else 'compact'))
+            sizes = {
+                obj_hashkey: meta['size'] for obj_hashkey, meta in self._container.get_objects_meta(
+                    list({metadata['obj'] for metadata in file_entries}))
+            }
+            for metadata in file_entries:
+                if metadata['obj'] in sizes:
+                    metadata['size'] = sizes[metadata['obj']]
+            update_node_repos(session, [_get_node_repo_row(*row) for row in rows])
+            session.commit()
+            self.invalidate_cache([result[1] for result in results])
+            num_updated += len(results)
+            last_id = results[-1][0]
+        return num_updated
+
+    def migrate_node_uuid_type(self):
+        """Convert the node UUIDs of a DB created by a previous version to the native UUID type of PostgreSQL.
+
+        See `models.migrate_node_uuid_type`: this locks and rewrites the whole table.
+
+        :return: True if the column was converted, False if there was nothing to do
+        """
+        # End the transaction of the session of this thread, that would otherwise block the ALTER TABLE
+        self._get_cached_session().close()
+        return migrate_node_uuid_type(self._get_engine())
+
+    def add_node_foreign_key(self, node_table='db_dbnode', node_column='uuid', on_delete='CASCADE'):
+        """Link the entries of the repository to the table of the nodes, see `models.add_node_foreign_key`.
+
+        :return: True if the foreign key was added, False if it was already there
+        """
+        return add_node_foreign_key(
+            self._get_engine(), node_table=node_table, node_column=node_column, on_delete=on_delete)
+
+    def _get_cache_generation(self):
+        """Return the generation of the folder_meta cache (None if disabled), to get before reading from the DB."""
+        if self._folder_meta_cache is None:
+            return None
+        return self._folder_meta_cache.get_generation()
+
+    def _get_cached_folder_metas(self, node_uuids):
+        """Return a tuple (found, missing) with the folder_meta of the nodes in the cache, and the other node UUIDs."""
+        if self._folder_meta_cache is None:
+            return {}, list(node_uuids)
+        found, missing = self._folder_meta_cache.get_many(node_uuids)
+        self._metrics.count('cache.hits', len(found))
+        self._metrics.count('cache.misses', len(missing))
+        return found, missing
+
+    def _query_folder_metas(self, node_uuids):
+        """Return a dictionary with the folder_meta of the given nodes, retrieved from the DB.
+
+        Values are JSON folder_meta or manifests, depending on how each node is stored.
+        """
+        node_uuids = list(node_uuids)
+        folder_metas = {}
+        with self._metrics.timer('db.get_folder_metas'), self._get_read_session() as session:
+            for idx in range(0, len(node_uuids), self._IN_CHUNK_SIZE):
+                folder_metas.update(
+                    (node_uuid, folder_manifest if folder_manifest is not None else folder_meta)
+                    for node_uuid, folder_meta, folder_manifest in session.query(DbNodeRepo).filter(
+                        DbNodeRepo.node_uuid.in_(node_uuids[idx:idx + self._IN_CHUNK_SIZE])).with_entities(
+                            DbNodeRepo.node_uuid, DbNodeRepo.folder_meta, DbNodeRepo.folder_manifest))
+        return folder_metas
 
     def _get_folder_metas(self, node_uuids):
-        return dict(self._get_cached_session().query(DbNodeRepo).filter(
-            DbNodeRepo.node_uuid.in_(node_uuids)).with_entities(DbNodeRepo.node_uuid, DbNodeRepo.folder_meta))
+        # Only query the DB for the nodes that are not in the cache
+        folder_metas, missing = self._get_cached_folder_metas(node_uuids)
+        if not missing:
+            return folder_metas
+
+        generation = self._get_cache_generation()
+        retrieved = self._query_folder_metas(missing)
+        if self._folder_meta_cache is not None:
+            self._folder_meta_cache.put_many(retrieved, generation=generation)
+        folder_metas.update(retrieved)
+        return folder_metas
+
+    async def _get_asyncpg_pool(self):
+        """Return the asyncpg pool of connections of the current event loop, creating it on first use."""
+        loop = asyncio.get_event_loop()
+        try:
+            pool_future = self._asyncpg_pools[loop]
+        except KeyError:
+            db_url = self._get_db_url()
+            # Store a future, so that concurrent coroutines wait for the same pool instead of creating more
+            pool_future = asyncio.ensure_future(asyncpg.create_pool(
+                host=db_url.host, port=db_url.port, user=db_url.username, password=db_url.password,
+                database=db_url.database, min_size=0, max_size=self._pool_size + self._max_overflow,
+                init=_init_asyncpg_connection))
+            self._asyncpg_pools[loop] = pool_future
+        try:
+            return await pool_future
+        except Exception:
+            # Try again next time, e.g. if the DB was not reachable
+            if self._asyncpg_pools.get(loop) is pool_future:
+                del self._asyncpg_pools[loop]
+            raise
+
+    async def _aquery_folder_metas(self, node_uuids):
+        """Async version of `_query_folder_metas`, using asyncpg if possible."""
+        if not self._use_asyncpg:
+            return await self._async_runner.run(self._query_folder_metas, node_uuids)
+
+        with self._metrics.timer('db.get_folder_metas'):
+            pool = await self._get_asyncpg_pool()
+            with self._metrics.timer('db.query'):
+                rows = await pool.fetch(
+                    # No cast of the parameter, so that it works both with native UUIDs and strings
+                    'SELECT node_uuid::text, folder_meta, folder_manifest FROM {} WHERE node_uuid = ANY($1)'.format(
+                        DbNodeRepo.__tablename__), node_uuids)
+        return {
+            row['node_uuid']: row['folder_manifest'] if row['folder_manifest'] is not None else row['folder_meta']
+            for row in rows
+        }
+
+    async def _aget_folder_metas(self, node_uuids):
+        """Async version of `_get_folder_metas`."""
+        folder_metas, missing = self._get_cached_folder_metas(node_uuids)
+        if not missing:
+            return folder_metas
+
+        generation = self._get_cache_generation()
+        retrieved = await self._aquery_folder_metas(missing)
+        if self._folder_meta_cache is not None:
+            self._folder_meta_cache.put_many(retrieved, generation=generation)
+        folder_metas.update(retrieved)
+        return folder_metas
 
     def _get_folder_meta(self, node_uuid):
-        return self._get_cached_session().query(DbNodeRepo).filter(DbNodeRepo.node_uuid==node_uuid).one().folder_meta
+        if self._folder_meta_cache is not None:
+            folder_meta = self._folder_meta_cache.get(node_uuid)
+            if folder_meta is not None:
+                self._metrics.count('cache.hits')
+                return folder_meta
+            self._metrics.count('cache.misses')
+
+        generation = self._get_cache_generation()
+        with self._metrics.timer('db.get_folder_metas'), self._get_read_session() as session:
+            folder_meta, folder_manifest = session.query(DbNodeRepo).filter(
+                DbNodeRepo.node_uuid==node_uuid).with_entities(DbNodeRepo.folder_meta, DbNodeRepo.folder_manifest).one()
+        if folder_manifest is not None:
+            folder_meta = folder_manifest
+        if self._folder_meta_cache is not None:
+            self._folder_meta_cache.put(node_uuid, folder_meta, generation=generation)
+        return folder_meta
+
+    def _get_folder_meta_entry(self, node_uuid, pieces):
+        """Look up a path in the folder_meta of a node in the DB, see `MetadataBackend.get_folder_meta_entry`."""
+        with self._metrics.timer('db.get_folder_meta_entry'), self._get_read_session() as session:
+            return self._backend.get_folder_meta_entry(session, node_uuid, pieces)
+
+    def _list_folder_meta_dir(self, node_uuid, pieces):
+        """List a directory of the folder_meta of a node in the DB, see `MetadataBackend.list_folder_meta_dir`."""
+        with self._metrics.timer('db.list_folder_meta_dir'), self._get_read_session() as session:
+            return self._backend.list_folder_meta_dir(session, node_uuid, pieces)
+
+    @staticmethod
+    def _get_source_digest(source_entries):
+        """Return the digest of the entries of a node folder collected by `_prepare_for_node_addition`.
+
+        The digest does not depend on the order in which the entries were listed.
+        """
+        digest = hashlib.sha256()
+        for source_entry in sorted(source_entries):
+            # File names that are not valid UTF-8 are kept as surrogates by `os.scandir`
+            digest.update(source_entry.encode('utf8', 'surrogateescape'))
+            digest.update(b'\n')
+        return digest.hexdigest()
 
     def _prepare_for_node_addition(self, folder_path):
         folder_meta = {'dir': {}}
@@ -116,55 +1388,258 @@ class Repository:
         # keys will be (tuple_of_dir_pieces, filename) and value will be a LazyOpener object, pointing
         # to the correct object
         files_to_write = {}
+        # total size of the files, used to split the import in batches
+        node_size = 0
+        # one string per file and directory with its path (and for files size and modification time),
+        # to compute the source digest. The stats are the ones needed anyway, so this costs no additional syscall
+        source_entries = []
 
         # Create the "template" for the folder_meta JSON (using None instead of the object ID,
-        # but tracking which files need to be stored as objects in `files_to_write`)
-        for dirpath, dirnames, filenames in os.walk(folder_path):
-            this_dir = os.path.relpath(dirpath, start=folder_path)
-            element = folder_meta['dir']
-            dir_pieces = []
-            if this_dir:
-                dir_pieces = this_dir.split(os.path.sep)
-                for piece in dir_pieces:
-                    if this_dir == os.curdir:
-                        continue
-                    element = element[piece]['dir']
-            for dirname in dirnames:
-                element[dirname] = {'dir': {}}
-            for filename in filenames:
-                original_path = os.path.join(dirpath, filename)
-                element[filename] = {
-                    'obj': None}
-                files_to_write[(tuple(dir_pieces), filename)] = LazyOpener(original_path)
+        # but tracking which files need to be stored as objects in `files_to_write`).
+        # Folders are visited depth-first with `os.scandir`, in the same order as `os.walk` (top-down),
+        # but without having to recompute the relative path of every directory.
+        # Each element of the stack is (absolute_path, tuple_of_dir_pieces, folder_meta_element)
+        to_visit = [(folder_path, (), folder_meta['dir'])]
+        while to_visit:
+            dirpath, dir_pieces, element = to_visit.pop()
+            subdirs = []
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    relpath = os.sep.join(dir_pieces + (entry.name,))
+                    if entry.is_dir():
+                        element[entry.name] = {'dir': {}}
+                        source_entries.append('{}\0'.format(relpath))
+                        # Like `os.walk`, do not recurse into symlinks to directories
+                        if not entry.is_symlink():
+                            subdirs.append((entry.path, dir_pieces + (entry.name,), element[entry.name]['dir']))
+                    else:
+                        element[entry.name] = {'obj': None}
+                        files_to_write[(dir_pieces, entry.name)] = LazyOpener(entry.path)
+                        stat = entry.stat()
+                        node_size += stat.st_size
+                        source_entries.append('{}\0{}\0{}'.format(relpath, stat.st_size, stat.st_mtime_ns))
+            # Reversed, so that the first subfolder is the next one to be popped
+            to_visit.extend(reversed(subdirs))
+
+        return folder_meta, files_to_write, node_size, self._get_source_digest(source_entries)
+
+    def _prepare_for_nodes_addition(self, folder_paths, scan_workers=None):
+        """Scan the folders of many nodes, possibly in parallel.
 
-        return folder_meta, files_to_write
+        Listing folders is dominated by the latency of the filesystem (especially on network filesystems),
+        so the scan of different nodes is distributed over a pool of threads.
+
+        :param folder_paths: a dictionary where keys are node UUIDs and values the path to the node folder
+        :param scan_workers: number of threads to use. If None, use the default of the `ThreadPoolExecutor`;
+            if 1, scan serially in the current thread
+        :return: a tuple (folder_metas, files_to_write, node_sizes, source_digests) of four dictionaries with
+            node UUIDs as keys, and as values the four elements returned by `_prepare_for_node_addition` for that node.
+            The order of the keys is the same as in `folder_paths`.
+        """
+        node_uuids = list(folder_paths)
+        node_folders = [folder_paths[node_uuid] for node_uuid in node_uuids]
+
+        if scan_workers == 1:
+            results = [self._prepare_for_node_addition(node_folder) for node_folder in node_folders]
+        else:
+            with ThreadPoolExecutor(max_workers=scan_workers) as executor:
+                # `map` returns results in the same order as the inputs
+                results = list(executor.map(self._prepare_for_node_addition, node_folders))
 
-    def create_repo_for_nodes(self, folder_paths, compress):  # pylint: disable=too-many-locals
         folder_metas = {}
         files_to_write = {}
+        node_sizes = {}
+        source_digests = {}
+        for node_uuid, (folder_meta, node_files_to_write, node_size, source_digest) in zip(node_uuids, results):
+            folder_metas[node_uuid] = folder_meta
+            files_to_write[node_uuid] = node_files_to_write
+            node_sizes[node_uuid] = node_size
+            source_digests[node_uuid] = source_digest
+        return folder_metas, files_to_write, node_sizes, source_digests
 
-        start = time.time()
-        for node_uuid, folder_path in folder_paths.items():
-            # Write all files in `files_to_write` in a bulk operation
-            folder_metas[node_uuid], files_to_write[node_uuid] = self._prepare_for_node_addition(folder_path)
+    def _get_existing_node_uuids(self, node_uuids):
+        """Return the set of the given node UUIDs that already have an entry in the DB."""
+        existing = set()
+        with self._get_read_session() as session:
+            for idx in range(0, len(node_uuids), self._IN_CHUNK_SIZE):
+                existing.update(res[0] for res in session.query(DbNodeRepo).filter(
+                    DbNodeRepo.node_uuid.in_(node_uuids[idx:idx + self._IN_CHUNK_SIZE])).with_entities(
+                        DbNodeRepo.node_uuid))
+        return existing
+
+    def _get_source_digests(self, node_uuids):
+        """Return a dictionary with the source digest of the given nodes that have an entry in the DB.
+
+        The value is None for nodes that were not imported from a folder (or by a previous version).
+        """
+        source_digests = {}
+        with self._get_read_session() as session:
+            for idx in range(0, len(node_uuids), self._IN_CHUNK_SIZE):
+                source_digests.update(session.query(DbNodeRepo).filter(
+                    DbNodeRepo.node_uuid.in_(node_uuids[idx:idx + self._IN_CHUNK_SIZE])).with_entities(
+                        DbNodeRepo.node_uuid, DbNodeRepo.source_digest))
+        return source_digests
 
+    def _iter_nodes_to_add(self, folder_paths, scan_workers=None, resume=False, incremental=False):
+        """Scan the node folders `_SCAN_CHUNK_SIZE` nodes at a time, and yield them one by one.
+
+        Only one chunk of nodes is kept in memory at any given time.
+
+        :param folder_paths: a dictionary, or an iterable of (node_uuid, folder_path) pairs
+        :param scan_workers: number of threads to use to scan each chunk, see `_prepare_for_nodes_addition`
+        :param resume: if True, skip nodes that already have an entry in the DB
+        :param incremental: if True, skip nodes that already have an entry in the DB with the same source digest
+        :return: a generator of tuples (node_uuid, folder_meta, files_to_write, node_size, source_digest)
+        """
+        if hasattr(folder_paths, 'items'):
+            folder_paths = folder_paths.items()
+        folder_paths = iter(folder_paths)
+        while True:
+            chunk = {
+                normalize_node_uuid(node_uuid): folder_path
+                for node_uuid, folder_path in itertools.islice(folder_paths, self._SCAN_CHUNK_SIZE)
+            }
+            if not chunk:
+                return
+            if resume:
+                for node_uuid in self._get_existing_node_uuids(list(chunk)):
+                    chunk.pop(node_uuid)
+            folder_metas, files_to_write, node_sizes, source_digests = self._prepare_for_nodes_addition(
+                chunk, scan_workers=scan_workers)
+            if incremental:
+                existing_digests = self._get_source_digests(list(chunk))
+                num_skipped = 0
+                for node_uuid, source_digest in source_digests.items():
+                    if existing_digests.get(node_uuid, None) == source_digest:
+                        folder_metas.pop(node_uuid)
+                        num_skipped += 1
+                self._metrics.count('import.nodes_skipped', num_skipped)
+            for node_uuid, folder_meta in folder_metas.items():
+                yield (node_uuid, folder_meta, files_to_write[node_uuid], node_sizes[node_uuid],
+                       source_digests[node_uuid])
+
+    def create_repo_for_nodes(  # pylint: disable=too-many-arguments,too-many-locals
+            self, folder_paths, compress, scan_workers=None, batch_max_files=None, batch_max_bytes=None,
+            resume=False, incremental=False, write_workers=None):
+        """Import the content of the given node folders into the repository.
+
+        Nodes are imported in batches: the files of each batch are written to the packs with a single
+        bulk operation, and the folder_meta of the nodes of the batch are then committed to the DB.
+        Only one batch is kept in memory at any given time.
+        If neither `batch_max_files` nor `batch_max_bytes` is specified, all nodes are imported in a single batch.
+
+        Since the DB entries of a batch are committed only after all its objects have been written,
+        an interrupted import can be continued with `resume=True`: nodes of the batches that were committed
+        are skipped. Objects of the interrupted batch that were already written to the packs are written
+        again, leaving unreferenced space in the packs that can be reclaimed by repacking.
+
+        With `incremental=True`, the import can be run again on folders that changed since the previous import
+        (e.g. to sync a legacy repository that is still in use). For each node, a digest of the paths, sizes and
+        modification times of its files is stored in the DB: nodes whose digest did not change are skipped
+        after listing their folder, without reading any file. The other nodes are imported again, and
+        their existing entry in the DB is updated. As for rsync, a file modified without changing its
+        size nor its modification time is not detected. The objects that are no longer referenced
+        by the updated nodes are left in the packs, and nodes whose folder was removed are not deleted.
+        An interrupted incremental import can be continued by running it again.
+
+        :param folder_paths: a dictionary where keys are node UUIDs and values the path to the node folder,
+            or an iterable of (node_uuid, folder_path) pairs
+        :param compress: if True, compress objects when writing them to the packs; 'auto' or an `AdaptiveCompression`
+            to decide for each object from the name of its file and its content (see the `compression` module)
+        :param scan_workers: number of threads to scan the node folders, see `_prepare_for_nodes_addition`
+        :param batch_max_files: start a new batch before the number of files in it exceeds this value
+        :param batch_max_bytes: start a new batch before the total size of the files in it exceeds this value
+        :param resume: if True, skip nodes that are already present in the DB
+        :param incremental: if True, skip nodes that did not change since they were imported, and update the others
+        :param write_workers: if specified, read, hash and compress the files with this number of threads, and write
+            them to the packs in the current thread (see the `pipeline` module). Otherwise, do everything serially
+            in the current thread
+        """
+        if resume and incremental:
+            raise ValueError('Only one of resume and incremental can be specified '
+                             '(an incremental import can be continued by running it again)')
+        compress = get_compression_policy(compress)
+        batch_folder_metas = {}
+        batch_files_to_write = {}
+        batch_source_digests = {}
+        batch_num_files = 0
+        batch_num_bytes = 0
+
+        start = time.perf_counter()
+        for node_uuid, folder_meta, node_files_to_write, node_size, source_digest in self._iter_nodes_to_add(
+                folder_paths, scan_workers=scan_workers, resume=resume, incremental=incremental):
+            # A node is never split across batches: a node larger than the limits will be alone in its batch
+            if batch_folder_metas and (
+                    (batch_max_files is not None and batch_num_files + len(node_files_to_write) > batch_max_files) or
+                    (batch_max_bytes is not None and batch_num_bytes + node_size > batch_max_bytes)):
+                self._metrics.timing('import.scan', time.perf_counter() - start)
+                self._add_nodes_batch(batch_folder_metas, batch_files_to_write, batch_source_digests,
+                                      compress=compress, num_bytes=batch_num_bytes, update=incremental,
+                                      write_workers=write_workers)
+                batch_folder_metas = {}
+                batch_files_to_write = {}
+                batch_source_digests = {}
+                batch_num_files = 0
+                batch_num_bytes = 0
+                start = time.perf_counter()
+            batch_folder_metas[node_uuid] = folder_meta
+            batch_files_to_write[node_uuid] = node_files_to_write
+            batch_source_digests[node_uuid] = source_digest
+            batch_num_files += len(node_files_to_write)
+            batch_num_bytes += node_size
+
+        if batch_folder_metas:
+            self._metrics.timing('import.scan', time.perf_counter() - start)
+            self._add_nodes_batch(batch_folder_metas, batch_files_to_write, batch_source_digests,
+                                  compress=compress, num_bytes=batch_num_bytes, update=incremental,
+                                  write_workers=write_workers)
+
+    def _add_nodes_batch(  # pylint: disable=too-many-arguments,too-many-locals
+            self, folder_metas, files_to_write, source_digests, compress, num_bytes, update=False, write_workers=None):
+        """Write the files of a batch of nodes to the packs, and commit their folder_meta to the DB.
+
+        :param folder_metas: a dictionary of folder_meta templates, as returned by `_prepare_for_nodes_addition`
+        :param files_to_write: a dictionary of files to write, as returned by `_prepare_for_nodes_addition`
+        :param source_digests: a dictionary of source digests, as returned by `_prepare_for_nodes_addition`
+        :param compress: if True, compress objects when writing them to the packs. If an `AdaptiveCompression`,
+            decide for each object (with the `pipeline` module, even if `write_workers` is not specified)
+        :param num_bytes: total size of the files of this batch, only used to report metrics
+        :param update: if True, update the entries of the nodes that are already in the DB, instead of
+            inserting new ones
+        :param write_workers: if specified, number of threads to read, hash and compress the files
+        """
         paths = []
         streams = []
         for node_uuid, node_files_to_write in files_to_write.items():
             for path, stream in node_files_to_write.items():
                 paths.append((node_uuid, path))
                 streams.append(stream)
-        tot_time = time.time() - start
-        print("Time to list all files to import ({} nodes): {:.3f} s".format(
-            len(folder_metas), tot_time))
 
-        start = time.time()
-        obj_hashkeys = self._container.add_streamed_objects_to_pack(
-            streams, compress=compress, open_streams=True)
-        tot_time = time.time() - start
-        print("Time to read {} files and then store them directly to packs: {:.3f} s".format(len(obj_hashkeys), tot_time))
+        with self._metrics.timer('import.write_objects'):
+            if isinstance(compress, bool) and write_workers is None:
+                obj_hashkeys = self._container.add_streamed_objects_to_pack(
+                    streams, compress=compress, open_streams=True)
+            elif isinstance(compress, bool):
+                obj_hashkeys = add_streamed_objects_to_pack_parallel(
+                    self._container, streams, compress=compress, workers=write_workers)
+            else:
+                stats = CompressionStats()
+                obj_hashkeys = add_streamed_objects_to_pack_parallel(
+                    self._container,
+                    streams,
+                    compress=compress,
+                    workers=0 if write_workers is None else write_workers,
+                    names=[filename for _, (_, filename) in paths],
+                    stats=stats)
+                stats.report(self._metrics)
+        self._metrics.count('import.objects_written', len(obj_hashkeys))
+        self._metrics.count('import.bytes_read', num_bytes)
 
-        start = time.time()
+        commit_start = time.perf_counter()
+        # The sizes of the objects as written (the files may have changed since they were scanned)
+        sizes = {
+            obj_hashkey: meta['size'] for obj_hashkey, meta in self._container.get_objects_meta(list(set(obj_hashkeys)))
+        }
         paths_for_node = collections.defaultdict(dict)
 
         # Regroup by node UUID
@@ -179,78 +1654,220 @@ class Repository:
                 for piece in dir_pieces:
                     element = element[piece]['dir']
                 element[filename]['obj'] = obj_hashkey
+                element[filename]['size'] = sizes[obj_hashkey]
 
         # Store the folder_meta to the postgres DB
+        # If something breaks, the files will be in the object store,
+        # but one can have a clean-up step
         session = self._get_cached_session()
-        for node_uuid, folder_meta in folder_metas.items():
-            # Store the JSON in the DBNodeRepo table
-            # If something breaks, the files will be in the object store,
-            # but one can have a clean-up step
-            db_node_repo = DbNodeRepo(
-                node_uuid=node_uuid,
-                folder_meta=folder_meta)
-            session.add(db_node_repo)
-        # Nodes with no files 
-        #Single commit, at the end
-        session.commit()
-        tot_time = time.time() - start
-        print("Time to commit folder_meta for {} nodes (note: only {} with files) to postgres: {:.3f} s".format(
-            len(folder_metas), len(paths_for_node), tot_time))
+        rows = [
+            dict(_get_node_repo_row(node_uuid, folder_meta, self._folder_meta_format),
+                 source_digest=source_digests[node_uuid]) for node_uuid, folder_meta in folder_metas.items()]
+        # Single commit per batch, at the end: this is what allows to resume an interrupted import
+        if update:
+            _commit_with_retry(session, lambda session: upsert_node_repos(session, rows))
+        else:
+            bulk_insert_node_repos(session, rows)
+            session.commit()
+        self.invalidate_cache(list(folder_metas))
+        self._metrics.timing('import.commit', time.perf_counter() - commit_start)
+        self._metrics.count('import.nodes', len(folder_metas))
+
+class _FolderIndex:
+    """Flat index of the content of a folder_meta, to resolve paths without walking the nested dictionaries.
+
+    - `objects` maps the full path of each file (with `os.sep` as separator) to its object hash key;
+    - `children` maps the full path of each directory (the empty string for the root) to a tuple
+      of `File` named tuples, sorted by name;
+    - `sizes` maps the full path of each file whose size is known to its size in bytes.
+    """
+    __slots__ = ('objects', 'children', 'sizes')
+
+    def __init__(self, folder_meta):
+        self.objects = {}
+        self.children = {}
+        self.sizes = {}
+
+        if is_manifest(folder_meta):
+            self._add_manifest(folder_meta)
+            return
+
+        # Each element of the stack is (dir_path, folder_meta_element)
+        to_visit = [('', folder_meta['dir'])]
+        while to_visit:
+            dir_path, element = to_visit.pop()
+            children = []
+            for name, metadata in element.items():
+                # Names (e.g. `aiida.out`) are repeated in many nodes: intern them to save memory
+                name = sys.intern(name)
+                path = os.path.join(dir_path, name) if dir_path else name
+                if 'dir' in metadata:
+                    children.append(File(name, FileType.DIRECTORY))
+                    to_visit.append((path, metadata['dir']))
+                elif 'obj' in metadata:
+                    children.append(File(name, FileType.FILE))
+                    self.objects[path] = metadata['obj']
+                    if metadata.get('size') is not None:
+                        self.sizes[path] = metadata['size']
+                else:
+                    raise RuntimeError(
+                        "Invalid object in the folder_meta, neither a folder nor a file: {}".format(element))
+            self.children[dir_path] = tuple(sorted(children, key=lambda child: child.name))
+
+    def _add_manifest(self, manifest):
+        """Fill the index with the content of a manifest."""
+        children = {'': []}
+        for dir_path, name, obj_hashkey, size in iter_manifest_entries(manifest):
+            path = dir_path + os.sep + name if dir_path else name
+            if obj_hashkey is None:
+                children[dir_path].append(File(name, FileType.DIRECTORY))
+                children[path] = []
+            else:
+                children[dir_path].append(File(name, FileType.FILE))
+                self.objects[path] = obj_hashkey
+                if size is not None:
+                    self.sizes[path] = size
+        for dir_path, dir_children in children.items():
+            self.children[dir_path] = tuple(sorted(dir_children, key=lambda child: child.name))
+
+
+def _iter_target_streams(triplets, targets_by_hashkey):
+    """Yield triplets (target, stream, meta) from the triplets of `Container.get_objects_stream_and_meta`.
+
+    :param triplets: the generator returned by `get_objects_stream_and_meta` (called with `skip_if_missing=False`)
+    :param targets_by_hashkey: a dictionary where keys are hash keys, and values the list of targets
+        (e.g. the keys in a node) whose content is the object with that hash key. If there is more than one target
+        for the same object, the same stream is yielded again for each of them, after seeking it back to the start.
+    :raises IOError: if an object does not exist in the container
+    """
+    for obj_hashkey, stream, meta in triplets:
+        if stream is None:
+            raise IOError("Object {} not found in the container (needed for: {})".format(
+                obj_hashkey, ', '.join(str(target) for target in targets_by_hashkey[obj_hashkey])))
+        for idx, target in enumerate(targets_by_hashkey[obj_hashkey]):
+            if idx:
+                stream.seek(0)
+            yield target, stream, meta
+
+
+def _commit_with_retry(session, write, max_attempts=3):
+    """Call `write(session)` and commit, retrying if a concurrent transaction inserted a row for one of the nodes.
+
+    Writes that insert the rows of new nodes (e.g. `upsert_node_repos`) fail with an `IntegrityError` (because of
+    the unique index on the node UUIDs) if another transaction inserts a row for the same node in the meantime:
+    the transaction is then rolled back and `write` is called again, so that it finds the row.
+
+    :param write: a function getting the session and writing to the DB, without committing
+    :return: the value returned by the last call to `write`
+    """
+    for attempt in range(max_attempts):
+        try:
+            result = write(session)
+            session.commit()
+            return result
+        except IntegrityError:
+            session.rollback()
+            if attempt == max_attempts - 1:
+                raise
+        except Exception:
+            session.rollback()
+            raise
+    return None
+
+
+def _map_file_region(path, offset, length):
+    """Return a read-only `memoryview` of a region of a file, backed by a `mmap` of the file.
+
+    The file can be closed, deleted or replaced afterwards: the memory stays mapped as long as the `memoryview`
+    (or any object created from it without copying) exists.
+    """
+    if not length:
+        return memoryview(b'')
+    # The offset of a mapping must be a multiple of the allocation granularity
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with open(path, 'rb') as fhandle:
+        mapping = mmap.mmap(fhandle.fileno(), offset + length - start, access=mmap.ACCESS_READ, offset=start)
+    return memoryview(mapping)[offset - start:]
+
+
+def _normalize_key(key):
+    """Return the normalized version of a key, where the root folder is represented by the empty string."""
+    key = os.path.normpath(key or '')
+    return '' if key == os.curdir else key
+
 
 class NodeRepository:
-    def __init__(self, node_uuid, container, folder_meta):
+    __slots__ = ('_node_uuid', '_container', '_folder_meta', '_index', '_metrics', '_async_runner')
+
+    def __init__(self, node_uuid, container, folder_meta, metrics=NULL_METRICS, async_runner=None):
         self._node_uuid = node_uuid
         self._container = container
         self._folder_meta = folder_meta
+        self._metrics = metrics
+        self._async_runner = async_runner if async_runner is not None else _DEFAULT_ASYNC_RUNNER
+        # Built on first use by `_get_index`
+        self._index = None
 
     @property
     def node_uuid(self):
         return self._node_uuid
 
-    def _get_obj_hashkeys_for_meta_dir(self, meta_dir):
-        obj_hashkeys = []
-        for subelement in meta_dir.values():
-            if 'obj' in subelement:
-                obj_hashkeys.append(subelement['obj'])
-            else:
-                obj_hashkeys += self._get_obj_hashkeys_for_meta_dir(subelement['dir'])
-        return obj_hashkeys
+    def _get_index(self):
+        if self._index is None:
+            self._index = _FolderIndex(self._folder_meta)
+        return self._index
+
+    def _get_obj_hashkey(self, key):
+        """Return the hash key of the object stored under the given key.
+
+        :raises IOError: if the key does not exist, or is not a file
+        """
+        objects = self._get_index().objects
+        try:
+            # Fast path, for keys that are already normalized
+            return objects[key]
+        except KeyError:
+            pass
+        this_dir = _normalize_key(key)
+        try:
+            return objects[this_dir]
+        except KeyError:
+            if this_dir in self._get_index().children:
+                raise IOError("{} is not a file in node {}".format(this_dir or os.curdir, self.node_uuid))
+            raise IOError("{} not found in node {}".format(this_dir, self.node_uuid))
 
     def get_all_obj_hashkeys(self):
-        return self._get_obj_hashkeys_for_meta_dir(self._folder_meta['dir'])
+        return list(self._get_index().objects.values())
+
+    def _get_keys_by_hashkey(self, keys):
+        """Return a dictionary mapping each object hash key to the list of the given keys that point to it.
+
+        :raises IOError: if any of the keys does not exist, or is not a file
+        """
+        keys_by_hashkey = collections.defaultdict(list)
+        for key in keys:
+            keys_by_hashkey[self._get_obj_hashkey(key)].append(key)
+        return keys_by_hashkey
 
     def list_objects(self, key=None):
         """Return a list of the objects contained in this repository, optionally in the given sub directory.
 
         :param key: fully qualified identifier for the object within the repository
-        :return: a list of `File` named tuples representing the objects present in directory with the given key
+        :return: a list of `File` named tuples representing the objects present in directory with the given key,
+            sorted by name
         """
-        objects = []
-
-        this_dir = key or ''
-        this_dir = os.path.normpath(this_dir)
-        element = self._folder_meta['dir']
-        dir_pieces = []
+        children = self._get_index().children
         try:
-            if this_dir:
-                dir_pieces = this_dir.split(os.path.sep)
-                for piece in dir_pieces:
-                    if this_dir == os.curdir:
-                        continue
-                    element = element[piece]['dir']
+            # Fast path, for keys that are already normalized
+            return list(children[key or ''])
+        except KeyError:
+            pass
+        this_dir = _normalize_key(key)
+        try:
+            return list(children[this_dir])
         except KeyError:
             raise IOError("{} not found in node {}".format(this_dir, self.node_uuid))
 
-        for name, metadata in element.items():
-            if 'dir' in metadata:
-                objects.append(File(name, FileType.DIRECTORY))
-            elif 'obj' in metadata:
-                objects.append(File(name, FileType.FILE))
-            else:
-                raise RuntimeError("Invalid object in the folder_meta, neither a folder nor a file: {}".format(element))
-        
-        return objects
-
     def list_object_names(self, key=None):
         """Return a list of the object names contained in this repository, optionally in the given sub directory.
 
@@ -268,30 +1885,10 @@ class NodeRepository:
         :param key: fully qualified identifier for the object within the repository
         :param mode: the mode under which to open the handle
         """
-        this_dir = key or ''
-        this_dir = os.path.normpath(this_dir)
-        element = self._folder_meta['dir']
-        lastobj_name = '/'
-        lastobj_meta = element
-        if this_dir:
-            dir_pieces = this_dir.split(os.path.sep)
-            dir_pieces, lastobj_name = dir_pieces[:-1], dir_pieces[-1]
-            try:
-                for piece in dir_pieces:
-                    if this_dir == os.curdir:
-                        continue
-                    element = element[piece]['dir']
-                lastobj_meta = element[lastobj_name]
-            except KeyError:
-                raise IOError("{} not found in node {}".format(this_dir, self.node_uuid))
-
-        if 'obj' not in lastobj_meta:
-            raise IOError("{} is not a file in node {}".format(this_dir, self.node_uuid))
-
-        obj_hashkey = lastobj_meta['obj']
+        obj_hashkey = self._get_obj_hashkey(key)
+        self._metrics.count('read.objects')
         return self._container.get_object_stream(obj_hashkey)
 
-
     def get_object(self, key):
         """Return the object identified by key.
 
@@ -299,29 +1896,64 @@ class NodeRepository:
         :return: a `File` named tuple representing the object located at key
         :raises IOError: if no object with the given key exists
         """
-        this_dir = key or ''
-        this_dir = os.path.normpath(this_dir)
-        element = self._folder_meta['dir']
-        lastobj_name = '/'
-        lastobj_meta = element
-        if this_dir:
-            dir_pieces = this_dir.split(os.path.sep)
-            dir_pieces, lastobj_name = dir_pieces[:-1], dir_pieces[-1]
+        index = self._get_index()
+        this_dir = _normalize_key(key)
+        if not this_dir:
+            return File('/', FileType.DIRECTORY)
+        if this_dir in index.objects:
+            return File(os.path.basename(this_dir), FileType.FILE)
+        if this_dir in index.children:
+            return File(os.path.basename(this_dir), FileType.DIRECTORY)
+        raise IOError("{} not found in node {}".format(this_dir, self.node_uuid))
+
+    def _get_sizes(self, paths):
+        """Return a dictionary with the sizes of the files at the given (normalized) paths.
+
+        The sizes are read from the folder_meta. Only those that are not stored there (nodes imported by a previous
+        version, see `Repository.add_missing_sizes`) are read from the metadata of the container.
+
+        :raises IOError: if the size is not known and the object does not exist in the container
+        """
+        index = self._get_index()
+        sizes = {}
+        paths_by_hashkey = collections.defaultdict(list)
+        for path in paths:
             try:
-                for piece in dir_pieces:
-                    if this_dir == os.curdir:
-                        continue
-                    element = element[piece]['dir']
-                lastobj_meta = element[lastobj_name]
+                sizes[path] = index.sizes[path]
             except KeyError:
-                raise IOError("{} not found in node {}".format(this_dir, self.node_uuid))
+                paths_by_hashkey[index.objects[path]].append(path)
+        if paths_by_hashkey:
+            for obj_hashkey, meta in self._container.get_objects_meta(list(paths_by_hashkey), skip_if_missing=False):
+                if meta['size'] is None:
+                    raise IOError("Object {} not found in the container (needed for: {})".format(
+                        obj_hashkey, ', '.join(paths_by_hashkey[obj_hashkey])))
+                for path in paths_by_hashkey[obj_hashkey]:
+                    sizes[path] = meta['size']
+        return sizes
+
+    def stat(self, key):
+        """Return the type and the size of the object identified by key, without reading its content.
 
-        if 'dir' in lastobj_meta:
-            return File(lastobj_name, FileType.DIRECTORY)
-        if 'obj' in lastobj_meta:
-            return File(lastobj_name, FileType.FILE)
-        raise RuntimeError("Invalid object in the folder_meta, neither a folder nor a file: {}, {}, {}, {}".format(
-            lastobj_meta, dir_pieces, lastobj_name, self._folder_meta))
+        :param key: fully qualified identifier for the object within the repository
+        :return: a `FileStat` named tuple. The size is in bytes, and None for directories
+        :raises IOError: if no object with the given key exists
+        """
+        index = self._get_index()
+        this_dir = _normalize_key(key)
+        if this_dir in index.objects:
+            return FileStat(os.path.basename(this_dir), FileType.FILE, self._get_sizes([this_dir])[this_dir])
+        if not this_dir:
+            return FileStat('/', FileType.DIRECTORY, None)
+        if this_dir in index.children:
+            return FileStat(os.path.basename(this_dir), FileType.DIRECTORY, None)
+        raise IOError("{} not found in node {}".format(this_dir, self.node_uuid))
+
+    def get_total_size(self):
+        """Return the total size in bytes of the files of this node, without reading their content.
+
+        Each file is counted, even if many files have the same content (as in the `total_size` column of the DB).
+        """
+        return sum(self._get_sizes(self._get_index().objects).values())
 
     def get_object_content(self, key):
         """Return the content of a object identified by key.
@@ -332,4 +1964,425 @@ class NodeRepository:
         :param mode: the mode under which to open the handle
         """
         with self.open(key) as fhandle:
-            return fhandle.read()
+            content = fhandle.read()
+        self._metrics.count('read.bytes', len(content))
+        return content
+
+    def get_object_buffer(self, key):
+        """Return the content of an object identified by key as a read-only `memoryview`, without copying it
+        if possible.
+
+        For objects stored uncompressed (packed or loose), the buffer is backed by a read-only `mmap` of the region
+        of the file where the object is stored: pages are read from disk only when accessed, and are shared with
+        the page cache (and with other processes mapping the same object). E.g. `numpy.frombuffer(buffer, dtype)`
+        wraps it without copying. Compressed objects are decompressed in memory, as with `get_object_content`.
+
+        The buffer is only guaranteed to be valid until the next maintenance operation that moves or deletes
+        objects in the container: `repack_nodes`, `pack_loose_objects` and `Container.clean_storage` (the file
+        it maps can be deleted; on POSIX systems the mapping keeps the old content, on others it is not
+        guaranteed). Release it (and any array created from it) before, or copy what is still needed.
+        The paths of the files are built with internals of disk-objectstore 0.4 (`_get_loose_path_from_hashkey`,
+        `_get_pack_path_from_pack_id`), see the note on the pinned version in the `pipeline` module.
+
+        :param key: fully qualified identifier for the object within the repository
+        :raises IOError: if the key does not exist, or is not a file
+        """
+        obj_hashkey = self._get_obj_hashkey(key)
+        self._metrics.count('read.objects')
+        meta = self._container.get_object_meta(obj_hashkey)
+        # pylint: disable=protected-access
+        if meta['type'] == ObjectType.LOOSE:
+            try:
+                buffer = _map_file_region(self._container._get_loose_path_from_hashkey(obj_hashkey), 0, meta['size'])
+                self._metrics.count('read.bytes_mapped', meta['size'])
+                return buffer
+            except FileNotFoundError:
+                # Packed and removed from the loose objects in the meantime, otherwise the loose object was deleted
+                try:
+                    meta = self._container.get_object_meta(obj_hashkey)
+                except NotExistent:
+                    meta = None
+                if meta is None or meta['type'] != ObjectType.PACKED:
+                    raise
+        if not meta['pack_compressed']:
+            buffer = _map_file_region(self._container._get_pack_path_from_pack_id(meta['pack_id']),
+                                      meta['pack_offset'], meta['pack_length'])
+            self._metrics.count('read.bytes_mapped', meta['size'])
+            return buffer
+        with self._container.get_object_stream(obj_hashkey) as fhandle:
+            content = fhandle.read()
+        self._metrics.count('read.bytes', len(content))
+        return memoryview(content)
+
+    async def aget_object_content(self, key):
+        """Async version of `get_object_content`, reading the object in the pool of threads of the async API."""
+        return await self._async_runner.run(self.get_object_content, key)
+
+    def _open_stream(self, obj_hashkey):
+        """Open the stream of an object, returning a tuple (context_manager, stream).
+
+        To be called in the thread that will use the container: the context manager must be exited
+        with `context_manager.__exit__(None, None, None)` when done.
+        """
+        context_manager = self._container.get_object_stream(obj_hashkey)
+        return context_manager, context_manager.__enter__()  # pylint: disable=no-member
+
+    async def aiter_object_chunks(self, key, chunk_size=1024 * 1024):
+        """Return an async generator yielding the content of an object in chunks of at most `chunk_size` bytes.
+
+        To use it, do something like the following::
+
+            async for chunk in node_repo.aiter_object_chunks(key):
+                await response.write(chunk)
+
+        The number of objects streamed at the same time is limited (see the `async_max_open_streams`
+        parameter of `Repository`): further calls wait for a stream to be closed.
+
+        :param key: fully qualified identifier for the object within the repository
+        :param chunk_size: maximum size of each chunk, in bytes
+        :raises IOError: if the key does not exist, or is not a file
+        """
+        # In the pool of threads, as it queries the DB for a `LazyNodeRepository`
+        obj_hashkey = await self._async_runner.run(self._get_obj_hashkey, key)
+        self._metrics.count('read.objects')
+        async with self._async_runner.get_stream_semaphore():
+            context_manager, stream = await self._async_runner.run(self._open_stream, obj_hashkey)
+            try:
+                while True:
+                    chunk = await self._async_runner.run(stream.read, chunk_size)
+                    if not chunk:
+                        break
+                    self._metrics.count('read.bytes', len(chunk))
+                    yield chunk
+            finally:
+                await self._async_runner.run(context_manager.__exit__, None, None, None)
+
+    @contextlib.contextmanager
+    def get_objects_stream(self, keys):
+        """Return a context manager yielding a generator of pairs (key, stream) for many objects of this node.
+
+        All objects are retrieved with a single call to the container, so they are yielded in the order
+        in which they are stored (e.g. sorted by offset within each pack) and each pack is opened only once.
+        This means that the order is in general different from the order of `keys`.
+        Each stream must be consumed before moving to the next pair, as it is then closed.
+
+        To use it, do something like the following::
+
+            with node_repo.get_objects_stream(keys) as pairs:
+                for key, stream in pairs:
+                    data = stream.read()
+
+        :param keys: an iterable of fully qualified identifiers of objects within the repository
+        :raises IOError: if any of the keys does not exist, or is not a file
+        """
+        keys_by_hashkey = self._get_keys_by_hashkey(keys)
+        self._metrics.count('read.objects', sum(len(keys) for keys in keys_by_hashkey.values()))
+        with self._container.get_objects_stream_and_meta(list(keys_by_hashkey), skip_if_missing=False) as triplets:
+            yield ((key, stream) for key, stream, _ in _iter_target_streams(triplets, keys_by_hashkey))
+
+    def get_objects_content(self, keys):
+        """Return the content of many objects of this node, see `get_objects_stream`.
+
+        :param keys: an iterable of fully qualified identifiers of objects within the repository
+        :return: a dictionary where keys are the given keys, and values the content of the corresponding objects
+        :raises IOError: if any of the keys does not exist, or is not a file
+        """
+        contents = {}
+        num_bytes = 0
+        with self.get_objects_stream(keys) as pairs:
+            for key, stream in pairs:
+                contents[key] = stream.read()
+                num_bytes += len(contents[key])
+        self._metrics.count('read.bytes', num_bytes)
+        return contents
+
+    async def aget_objects_content(self, keys):
+        """Async version of `get_objects_content`, reading the objects in the pool of threads of the async API."""
+        return await self._async_runner.run(self.get_objects_content, keys)
+
+
+class LazyNodeRepository(NodeRepository):
+    """A `NodeRepository` that looks up single paths in the DB, retrieving the whole folder_meta only when needed.
+
+    Opening a file, getting an object or listing a directory sends a query to the DB that only returns
+    the hash key of the file or the names in the directory, and not the whole folder_meta of the node.
+    Methods that need the whole content of the node (e.g. `get_all_obj_hashkeys`, `stat` and `get_total_size`)
+    retrieve the whole folder_meta (through the cache of the repository, if enabled); after that, all lookups
+    are done in memory.
+    """
+    __slots__ = ('_repository',)
+
+    def __init__(self, node_uuid, repository):
+        super().__init__(
+            node_uuid=node_uuid,
+            container=repository.container,
+            folder_meta=None,
+            metrics=repository.metrics,
+            async_runner=repository._async_runner)  # pylint: disable=protected-access
+        self._repository = repository
+
+    def _get_index(self):
+        if self._folder_meta is None:
+            self._folder_meta = self._repository._get_folder_meta(self.node_uuid)  # pylint: disable=protected-access
+        return super()._get_index()
+
+    @staticmethod
+    def _get_pieces(normalized_key):
+        """Return the tuple of the components of a normalized key."""
+        return tuple(normalized_key.split(os.sep)) if normalized_key else ()
+
+    def _get_obj_hashkey(self, key):
+        if self._index is not None:
+            return super()._get_obj_hashkey(key)
+        this_dir = _normalize_key(key)
+        if not this_dir:
+            raise IOError("{} is not a file in node {}".format(os.curdir, self.node_uuid))
+        obj_hashkey, is_dir = self._repository._get_folder_meta_entry(  # pylint: disable=protected-access
+            self.node_uuid, self._get_pieces(this_dir))
+        if obj_hashkey is not None:
+            return obj_hashkey
+        if is_dir:
+            raise IOError("{} is not a file in node {}".format(this_dir, self.node_uuid))
+        raise IOError("{} not found in node {}".format(this_dir, self.node_uuid))
+
+    def list_objects(self, key=None):
+        if self._index is not None:
+            return super().list_objects(key)
+        this_dir = _normalize_key(key)
+        pieces = self._get_pieces(this_dir)
+        entries = self._repository._list_folder_meta_dir(self.node_uuid, pieces)  # pylint: disable=protected-access
+        if not entries and pieces:
+            # Either an empty directory, or not a directory
+            _, is_dir = self._repository._get_folder_meta_entry(  # pylint: disable=protected-access
+                self.node_uuid, pieces)
+            if not is_dir:
+                raise IOError("{} not found in node {}".format(this_dir, self.node_uuid))
+        return sorted((File(sys.intern(name), FileType.DIRECTORY if is_dir else FileType.FILE)
+                       for name, is_dir in entries),
+                      key=lambda child: child.name)
+
+    def get_object(self, key):
+        if self._index is not None:
+            return super().get_object(key)
+        this_dir = _normalize_key(key)
+        if not this_dir:
+            return File('/', FileType.DIRECTORY)
+        obj_hashkey, is_dir = self._repository._get_folder_meta_entry(  # pylint: disable=protected-access
+            self.node_uuid, self._get_pieces(this_dir))
+        if obj_hashkey is not None:
+            return File(os.path.basename(this_dir), FileType.FILE)
+        if is_dir:
+            return File(os.path.basename(this_dir), FileType.DIRECTORY)
+        raise IOError("{} not found in node {}".format(this_dir, self.node_uuid))
+
+
+class NodeTransaction:
+    """Changes to the content of a node, staged until `commit`, that applies all of them at once.
+
+    Get it with `Repository.begin_node_transaction`, and use it as a context manager to commit at the end
+    (or roll back, if an exception is raised)::
+
+        with repo.begin_node_transaction(node_uuid) as transaction:
+            transaction.put_object_from_bytes(b'...', 'outputs/aiida.out')
+            transaction.delete('inputs/old.in')
+
+    Each change is checked against the content of the node when the transaction began, with the changes staged
+    so far. New objects are kept in memory (or in temporary files, if large) until the commit, that writes all
+    of them with a single call to the container (or as loose objects), and then applies the changes again to the
+    folder_meta of the node as it is in the DB at that moment, storing it with a single UPDATE (an INSERT for
+    a new node). Objects are written before the DB is changed: if the commit fails, the DB is unchanged and the
+    objects already written are just left unused in the container.
+    """
+    # Objects staged from a file-like object are kept in memory up to this size, then in a temporary file
+    _SPOOL_MAX_SIZE = 1024 * 1024
+
+    def __init__(self, repository, node_uuid, folder_meta, loose=False, compress=False):  # pylint: disable=too-many-arguments
+        """:param repository: the `Repository` of the node
+        :param folder_meta: the folder_meta of the node (JSON or manifest), or None for a new node
+        :param loose: if True, write the new objects as loose objects, otherwise to the packs
+        :param compress: if True, compress the new objects written to the packs. If an `AdaptiveCompression`,
+            decide for each object
+        """
+        self._repository = repository
+        self._node_uuid = node_uuid
+        self._loose = loose
+        self._compress = compress
+        if folder_meta is None:
+            folder_meta = {'dir': {}}
+        elif is_manifest(folder_meta):
+            folder_meta = decode_manifest(folder_meta)
+        else:
+            # It can be shared with the cache of the repository
+            folder_meta = copy.deepcopy(folder_meta)
+        # Content of the node with the changes staged so far
+        self._staged_folder_meta = folder_meta
+        # List of tuples (operation, pieces, index in `_objects` of the new object, or None)
+        self._changes = []
+        # New objects: either bytes or (spooled) temporary files, and their sizes
+        self._objects = []
+        self._sizes = []
+        self._done = False
+
+    @property
+    def node_uuid(self):
+        return self._node_uuid
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._done:
+            return
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def _check_not_done(self):
+        if self._done:
+            raise ValueError("The transaction of node {} is already finished".format(self._node_uuid))
+
+    def _get_pieces(self, key, allow_root=False):
+        """Return the tuple of the components of a key.
+
+        :raises ValueError: if the key is not a relative path within the node, or the transaction is finished
+        :raises IOError: if the key is the root folder and `allow_root` is False
+        """
+        self._check_not_done()
+        this_dir = _normalize_key(key)
+        if os.path.isabs(this_dir) or this_dir == os.pardir or this_dir.startswith(os.pardir + os.sep):
+            raise ValueError("Invalid key '{}': it must be a relative path within the node".format(key))
+        if not this_dir and not allow_root:
+            raise IOError("{} is the root folder of node {}".format(os.curdir, self._node_uuid))
+        return tuple(this_dir.split(os.sep)) if this_dir else ()
+
+    def _stage_object(self, content, size, key):
+        """Stage a new object as the file at the given key.
+
+        :param content: bytes, or an open temporary file (that is closed if the key is not valid)
+        """
+        try:
+            pieces = self._get_pieces(key)
+            _apply_change(self._staged_folder_meta, self._node_uuid, 'put', pieces, {'obj': None, 'size': size})
+        except Exception:
+            if not isinstance(content, bytes):
+                content.close()
+            raise
+        self._changes.append(('put', pieces, len(self._objects)))
+        self._objects.append(content)
+        self._sizes.append(size)
+
+    def put_object_from_bytes(self, content, key):
+        """Stage the given content as the file at the given key, replacing it if it exists.
+
+        The missing parent directories are created.
+
+        :param content: a bytes-like object
+        :param key: fully qualified identifier for the object within the repository
+        :raises IOError: if the key is a directory, or one of its parents is a file
+        """
+        content = bytes(content)
+        self._stage_object(content, len(content), key)
+
+    def put_object_from_filelike(self, handle, key):
+        """Stage the content of a file-like object as the file at the given key, replacing it if it exists.
+
+        The content is read (from the current position until the end) immediately, so that the handle can be closed
+        afterwards. The missing parent directories are created.
+
+        :param handle: a binary file-like object
+        :param key: fully qualified identifier for the object within the repository
+        :raises IOError: if the key is a directory, or one of its parents is a file
+        """
+        spooled = tempfile.SpooledTemporaryFile(  # pylint: disable=consider-using-with
+            max_size=self._SPOOL_MAX_SIZE,
+            dir=self._repository.container._get_sandbox_folder())  # pylint: disable=protected-access
+        try:
+            shutil.copyfileobj(handle, spooled)
+        except Exception:
+            spooled.close()
+            raise
+        self._stage_object(spooled, spooled.tell(), key)
+
+    def mkdir(self, key):
+        """Stage the creation of a directory and of its missing parents (nothing is done if it exists already).
+
+        :param key: fully qualified identifier for the directory within the repository
+        :raises IOError: if the key, or one of its parents, is a file
+        """
+        pieces = self._get_pieces(key, allow_root=True)
+        _apply_change(self._staged_folder_meta, self._node_uuid, 'mkdir', pieces)
+        self._changes.append(('mkdir', pieces, None))
+
+    def delete(self, key):
+        """Stage the deletion of a file, or of a directory with all its content.
+
+        The objects in the container are not deleted, as they can be used by other files.
+
+        :param key: fully qualified identifier for the object within the repository
+        :raises IOError: if the key does not exist
+        """
+        pieces = self._get_pieces(key)
+        _apply_change(self._staged_folder_meta, self._node_uuid, 'delete', pieces)
+        self._changes.append(('delete', pieces, None))
+
+    def _close_objects(self):
+        for content in self._objects:
+            if not isinstance(content, bytes):
+                content.close()
+        self._objects = []
+
+    def commit(self):
+        """Write the new objects, and then store the new content of the node in the DB.
+
+        :return: the `NodeRepository` of the node, with its new content
+        :raises IOError: if a change is not possible on the content of the node as it is in the DB, e.g. if a file
+            was created where this transaction creates a directory (then the DB is left unchanged)
+        """
+        self._check_not_done()
+        self._done = True
+        repository = self._repository
+        metrics = repository.metrics
+        try:
+            with metrics.timer('write.write_objects'):
+                streams = []
+                for content in self._objects:
+                    if isinstance(content, bytes):
+                        streams.append(io.BytesIO(content))
+                    else:
+                        content.seek(0)
+                        streams.append(content)
+                if not streams:
+                    obj_hashkeys = []
+                elif self._loose:
+                    obj_hashkeys = [repository.container.add_streamed_object(stream) for stream in streams]
+                elif isinstance(self._compress, bool):
+                    obj_hashkeys = repository.container.add_streamed_objects_to_pack(streams, compress=self._compress)
+                else:
+                    names = [None] * len(streams)
+                    for _, pieces, idx in self._changes:
+                        if idx is not None:
+                            names[idx] = pieces[-1]
+                    stats = CompressionStats()
+                    obj_hashkeys = add_streamed_objects_to_pack_parallel(
+                        repository.container, [contextlib.nullcontext(stream) for stream in streams],
+                        compress=self._compress, workers=0, names=names, stats=stats)
+                    stats.report(metrics)
+        finally:
+            self._close_objects()
+        metrics.count('write.objects_written', len(obj_hashkeys))
+        metrics.count('write.bytes_written', sum(self._sizes))
+
+        changes = [(operation, pieces, None if idx is None else {
+            'obj': obj_hashkeys[idx],
+            'size': self._sizes[idx]
+        }) for operation, pieces, idx in self._changes]
+        with metrics.timer('write.commit'):
+            node_repository = repository._commit_node_changes(self._node_uuid, changes)  # pylint: disable=protected-access
+        metrics.count('write.nodes')
+        return node_repository
+
+    def rollback(self):
+        """Discard all the staged changes."""
+        self._done = True
+        self._close_objects()
@@ -0,0 +1,215 @@
+"""Verification of the integrity of the objects referenced by the nodes of a repository, see `Repository.verify`.
+
+For each object, the following checks are done, depending on the mode:
+
+- `sizes`: the object exists in the container, and (for packed objects) the pack file contains the whole object,
+  with the expected length if it is not compressed. Only the metadata of the container are read;
+- `full`: in addition, the content of every object is read and hashed again, and compared with its hash key;
+- `sampled`: like `sizes`, but the content of a random fraction of the objects is also hashed again.
+  Whether an object is sampled depends only on its hash key and on the seed, so that the same seed
+  samples the same objects, whatever the order in which they are checked.
+
+Objects are hashed by a pool of threads, each one reading a contiguous range of the objects sorted by their
+position in the packs, in chunks, so that objects are never loaded whole in memory. Each object is checked
+only once, even if it is referenced by many nodes.
+"""
+import collections
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from disk_objectstore.container import ObjectType
+from disk_objectstore.utils import get_hash
+
+# Valid values of the `mode` parameter
+VERIFY_MODES = ('full', 'sampled', 'sizes')
+
+# Size of the chunks in which objects are read when hashing them
+_CHUNK_SIZE = 1024 * 1024
+
+# A problem with the object of a file of a node
+ObjectProblem = collections.namedtuple('ObjectProblem', ['node_uuid', 'path', 'obj_hashkey', 'problem'])
+
+
+class VerifyReport(
+        collections.namedtuple('VerifyReport',
+                               ['num_nodes', 'num_objects', 'num_hashed', 'bytes_hashed', 'missing_nodes',
+                                'problems'])):
+    """Result of `Repository.verify`.
+
+    - `num_nodes`: number of nodes that were verified;
+    - `num_objects`: number of distinct objects that were checked;
+    - `num_hashed`, `bytes_hashed`: number of objects whose content was hashed again, and their total size;
+    - `missing_nodes`: list of the requested node UUIDs that are not in the repository;
+    - `problems`: list of `ObjectProblem` named tuples, one for each file of a node whose object is missing
+      or corrupt. The `problem` is a string describing what is wrong.
+    """
+    __slots__ = ()
+
+    @property
+    def is_ok(self):
+        """True if no problem was found."""
+        return not self.missing_nodes and not self.problems
+
+
+class ObjectChecker:
+    """Check the objects of a container, remembering which objects were already checked.
+
+    Use it as a context manager, to stop the threads at the end.
+    """
+
+    def __init__(self, container, mode='full', workers=None, sample_fraction=0.01, seed=None):  # pylint: disable=too-many-arguments
+        """:param container: the container to check. If `workers` is not 1, it is used from multiple threads,
+            so it must be thread-local
+        :param mode: one of `VERIFY_MODES`
+        :param workers: number of threads hashing objects. If None, use the default of the `ThreadPoolExecutor`;
+            if 1, hash in the current thread
+        :param sample_fraction: fraction of the objects that are hashed in the `sampled` mode
+        :param seed: random seed used to choose the objects to hash in the `sampled` mode (an integer or a string).
+            If None, different objects are chosen each time
+        """
+        if mode not in VERIFY_MODES:
+            raise ValueError("Unknown verification mode '{}', valid modes are: {}".format(
+                mode, ', '.join(VERIFY_MODES)))
+        self._container = container
+        self._mode = mode
+        # Same default as the `ThreadPoolExecutor`
+        self._workers = workers if workers is not None else min(32, (os.cpu_count() or 1) + 4)
+        self._sample_fraction = sample_fraction
+        self._seed = os.urandom(16) if seed is None else str(seed).encode('utf8')
+        self._executor = ThreadPoolExecutor(max_workers=self._workers) if self._workers > 1 else None
+        # Raw digests of the objects already checked (bytes take less memory than the hexadecimal strings)
+        self._checked = set()
+        # Problems found so far, by hash key
+        self._problems = {}
+        self._pack_sizes = {}
+        self.num_hashed = 0
+        self.bytes_hashed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop the threads."""
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    @property
+    def num_checked(self):
+        """Number of distinct objects checked so far."""
+        return len(self._checked)
+
+    def _get_pack_size(self, pack_id, refresh=False):
+        """Return the size of a pack (0 if it does not exist), cached unless `refresh` is True."""
+        if not refresh and pack_id in self._pack_sizes:
+            return self._pack_sizes[pack_id]
+        pack_path = self._container._get_pack_path_from_pack_id(pack_id)  # pylint: disable=protected-access
+        self._pack_sizes[pack_id] = os.path.getsize(pack_path) if os.path.exists(pack_path) else 0
+        return self._pack_sizes[pack_id]
+
+    def _is_sampled(self, obj_hashkey):
+        """Return True if the content of an object is to be hashed in the `sampled` mode.
+
+        The hash key is hashed again with the seed, so that the choice does not depend on the order of the objects,
+        and objects are chosen uniformly also if the hash keys are not (e.g. with a different hash type).
+        """
+        value = int.from_bytes(hashlib.sha256(self._seed + bytes.fromhex(obj_hashkey)).digest()[:8], 'little')
+        return value < self._sample_fraction * 2**64
+
+    def _check_meta(self, meta):
+        """Return a string with the problem found in the metadata of an object, or None if it is fine."""
+        if meta['type'] == ObjectType.MISSING:
+            return 'missing'
+        if meta['type'] == ObjectType.PACKED:
+            end = meta['pack_offset'] + meta['pack_length']
+            # Objects can be appended to the pack after its size was cached: check its current size before
+            # reporting the object as truncated
+            if end > self._get_pack_size(meta['pack_id']) and end > self._get_pack_size(meta['pack_id'], refresh=True):
+                return 'truncated: pack {} is shorter than the end of the object'.format(meta['pack_id'])
+            if not meta['pack_compressed'] and meta['pack_length'] != meta['size']:
+                return 'wrong length in pack {}: {} bytes instead of {}'.format(
+                    meta['pack_id'], meta['pack_length'], meta['size'])
+        return None
+
+    def _hash_objects(self, obj_hashkeys):
+        """Read and hash the given objects, in the order in which they are stored.
+
+        :return: a tuple (problems, num_bytes), where `problems` is a dictionary with the problems found,
+            by hash key
+        """
+        problems = {}
+        num_bytes = 0
+        with self._container.get_objects_stream_and_meta(obj_hashkeys, skip_if_missing=False) as triplets:
+            for obj_hashkey, stream, meta in triplets:
+                if stream is None:
+                    problems[obj_hashkey] = 'missing'
+                    continue
+                hasher = get_hash(hash_type=self._container.hash_type)()
+                size = 0
+                try:
+                    while True:
+                        chunk = stream.read(_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+                        hasher.update(chunk)
+                except Exception as exc:  # pylint: disable=broad-except
+                    # E.g. corrupt compressed data
+                    problems[obj_hashkey] = 'unreadable: {}'.format(exc)
+                    continue
+                num_bytes += size
+                if size != meta['size']:
+                    problems[obj_hashkey] = 'wrong size: {} bytes instead of {}'.format(size, meta['size'])
+                elif hasher.hexdigest() != obj_hashkey:
+                    problems[obj_hashkey] = 'wrong hash: the content has hash {}'.format(hasher.hexdigest())
+        return problems, num_bytes
+
+    def check(self, obj_hashkeys):
+        """Check the given objects (those that were not already checked).
+
+        :param obj_hashkeys: an iterable of hash keys
+        :return: a dictionary with the problems found with the given objects, by hash key
+            (including those found when they were first checked)
+        """
+        obj_hashkeys = set(obj_hashkeys)
+        to_check = [obj_hashkey for obj_hashkey in obj_hashkeys if bytes.fromhex(obj_hashkey) not in self._checked]
+
+        to_hash = []
+        for obj_hashkey, meta in self._container.get_objects_meta(to_check, skip_if_missing=False):
+            problem = self._check_meta(meta)
+            if problem is not None:
+                self._problems[obj_hashkey] = problem
+            elif self._mode == 'full' or (self._mode == 'sampled' and self._is_sampled(obj_hashkey)):
+                # Sort by position: loose objects at the end
+                to_hash.append(((meta['pack_id'] is None, meta['pack_id'] or 0, meta['pack_offset'] or 0),
+                                obj_hashkey, meta['size']))
+
+        if to_hash:
+            # Split the objects (sorted by position) in ranges of similar total size, one per thread
+            to_hash.sort(key=lambda item: item[0])
+            range_size = sum(size for _, _, size in to_hash) / self._workers
+            ranges = [[]]
+            range_total = 0
+            for _, obj_hashkey, size in to_hash:
+                if range_total >= range_size * len(ranges):
+                    ranges.append([])
+                ranges[-1].append(obj_hashkey)
+                range_total += size
+            if self._executor is None:
+                results = [self._hash_objects(obj_hashkeys_range) for obj_hashkeys_range in ranges]
+            else:
+                results = list(self._executor.map(self._hash_objects, ranges))
+            for problems, num_bytes in results:
+                self._problems.update(problems)
+                self.bytes_hashed += num_bytes
+            self.num_hashed += len(to_hash)
+
+        self._checked.update(bytes.fromhex(obj_hashkey) for obj_hashkey in to_check)
+        return {
+            obj_hashkey: self._problems[obj_hashkey]
+            for obj_hashkey in obj_hashkeys
+            if obj_hashkey in self._problems
+        }
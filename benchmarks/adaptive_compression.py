@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Compare the import of a legacy repository without compression, compressing everything, and with adaptive
+compression (`compress='auto'`, see `aiida_repository.compression`).
+
+A synthetic legacy repository is generated (see `synthetic_repository.py`) with a mix of text-like (compressible)
+and random (incompressible) files, and imported with `create_repo_for_nodes` in a new repository (with a SQLite DB)
+for each mode. For each mode, the wall and CPU time of the import and the size of the packs are printed, and the
+folder_meta of all nodes is checked to be identical, i.e. each file gets the same object. For the adaptive mode,
+the decisions, the CPU time spent deciding and compressing and the bytes saved are also printed.
+"""
+import os
+import shutil
+import sys
+import time
+
+import click
+
+from aiida_repository.metrics import MetricsRegistry
+from aiida_repository.repository import Repository
+
+from synthetic_repository import generate_legacy_repository
+
+
+@click.command()
+@click.option('-w',
+              '--workdir',
+              default='/tmp/aiida-repository-adaptive-compression',
+              help='Folder in which to create all data. Must not exist unless --clear is specified.')
+@click.option('-c', '--clear', is_flag=True, help='Delete the work directory before starting.')
+@click.option('-n', '--num-nodes', type=int, default=500, help='Number of nodes.')
+@click.option('--median-size', type=int, default=16384, help='Median size of the files, in bytes.')
+@click.option('--text-fraction', type=float, default=0.5, help='Fraction of files with compressible content.')
+@click.option('--seed', type=int, default=0, help='Random seed.')
+@click.option('-W',
+              '--write-workers',
+              type=int,
+              default=None,
+              help='Number of threads to read, hash and compress the files (default: serial).')
+@click.help_option('-h', '--help')
+def main(workdir, clear, num_nodes, median_size, text_fraction, seed, write_workers):  # pylint: disable=too-many-arguments,too-many-locals
+    if clear and os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    if os.path.exists(workdir):
+        print("The folder '{}' exists - either delete it, or specify the --clear option".format(workdir))
+        sys.exit(1)
+    os.makedirs(workdir)
+
+    folder_paths = generate_legacy_repository(os.path.join(workdir, 'legacy'),
+                                              num_nodes=num_nodes,
+                                              median_size=median_size,
+                                              text_fraction=text_fraction,
+                                              seed=seed)
+    num_bytes = sum(
+        os.path.getsize(os.path.join(dirpath, filename))
+        for folder_path in folder_paths.values()
+        for dirpath, _, filenames in os.walk(folder_path)
+        for filename in filenames)
+    print("{} nodes, {} bytes, text fraction {}".format(num_nodes, num_bytes, text_fraction))
+
+    reference_folder_metas = None
+    for name, compress in [('none', False), ('all', True), ('auto', 'auto')]:
+        metrics = MetricsRegistry()
+        repo = Repository(db_user=None,
+                          db_name=None,
+                          db_password=None,
+                          folder=os.path.join(workdir, '{}-container'.format(name)),
+                          db_url='sqlite:///{}'.format(os.path.join(workdir, '{}.sqlite'.format(name))),
+                          metrics=metrics)
+        repo.create_schema()
+        start = time.time()
+        start_cpu = time.process_time()
+        repo.create_repo_for_nodes(folder_paths, compress=compress, write_workers=write_workers)
+        tot_time = time.time() - start
+        tot_cpu = time.process_time() - start_cpu
+        packs_size = repo.container.get_total_size()['total_size_packfiles_on_disk']
+        print("{:>5s}: {:.3f} s ({:.3f} s CPU), packs: {} bytes ({:.1f}% of the files)".format(
+            name, tot_time, tot_cpu, packs_size, 100. * packs_size / num_bytes))
+        if compress == 'auto':
+            counters = metrics.get_counters()
+            for key in sorted(counters):
+                if key.startswith('compress.'):
+                    print("       {:30s}: {}".format(key, counters[key]))
+            print("       {:30s}: {:.3f} s".format('compress.cpu', metrics.get_timers()['compress.cpu'].total))
+
+        folder_metas = repo._query_folder_metas(list(folder_paths))  # pylint: disable=protected-access
+        repo.close()
+        if reference_folder_metas is None:
+            reference_folder_metas = folder_metas
+        elif folder_metas != reference_folder_metas:
+            print("ERROR! The folder_meta of the nodes differ from those of the first import")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Benchmark the different methods to write rows to the `db_noderepo` table.
+
+**VERY IMPORTANT NOTE!** The `db_noderepo` table of the database will be emptied,
+use a test database.
+"""
+import hashlib
+import time
+import uuid
+
+import click
+
+from aiida_repository.bulk import INSERT_METHODS, bulk_insert_node_repos
+from aiida_repository.models import DbNodeRepo
+from aiida_repository.repository import Repository
+
+
+def get_folder_meta(num_files):
+    """Return a folder_meta with `num_files` files in a `path` subfolder, with random hash keys."""
+    return {
+        'dir': {
+            'path': {
+                'dir': {
+                    'file{}.txt'.format(idx): {
+                        'obj': hashlib.sha256(uuid.uuid4().bytes).hexdigest()
+                    } for idx in range(num_files)
+                }
+            }
+        }
+    }
+
+
+@click.command()
+@click.option('-p',
+              '--path',
+              default='/tmp/test-container-bulk-insert',
+              help='The path to a test folder in which the container will be created.')
+@click.option('-U', '--db-user', required=True, help='DB user name.')
+@click.option('-D',
+              '--db-name',
+              required=True,
+              help='DB database name (THE db_noderepo TABLE WILL BE EMPTIED! USE A TEST DB).')
+@click.option('-P', '--db-password', required=True, help='DB password.')
+@click.option('-n', '--num-rows', type=int, default=100000, help='Number of rows to insert.')
+@click.option('-f', '--files-per-node', type=int, default=5, help='Number of files in the folder_meta of each row.')
+@click.option('-b', '--batch-size', type=int, default=10000, help='Number of rows committed together.')
+@click.option('-m',
+              '--method',
+              'methods',
+              type=click.Choice(sorted(INSERT_METHODS)),
+              multiple=True,
+              help='Methods to benchmark (can be repeated). Default: all.')
+@click.help_option('-h', '--help')
+def main(path, db_user, db_name, db_password, num_rows, files_per_node, batch_size, methods):  # pylint: disable=too-many-arguments
+    repo = Repository(folder=path, db_user=db_user, db_name=db_name, db_password=db_password)
+    repo.create_schema()
+
+    print("Generating {} rows with {} files each...".format(num_rows, files_per_node))
+    rows = [{
+        'node_uuid': str(uuid.uuid4()),
+        'folder_meta': get_folder_meta(files_per_node)
+    } for _ in range(num_rows)]
+
+    for method in methods or INSERT_METHODS:
+        repo.drop_db()
+        session = repo._get_cached_session()  # pylint: disable=protected-access
+        start = time.time()
+        for idx in range(0, num_rows, batch_size):
+            bulk_insert_node_repos(session, rows[idx:idx + batch_size], method=method)
+            session.commit()
+        tot_time = time.time() - start
+        # Make sure ORM objects do not stay in memory for the next method
+        session.expunge_all()
+        assert session.query(DbNodeRepo).count() == num_rows
+        print("- {:12s}: {:8.3f} s, {:10.0f} rows/s".format(method, tot_time, num_rows / tot_time))
+
+    repo.drop_db()
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+"""Compare the latency of folder_meta lookups with the SQLite and the PostgreSQL metadata backends.
+
+For each backend, the `db_noderepo` table is filled with random rows, and then the following are measured:
+
+- the time to create a `Repository` and get the first node repository (including the connection to the DB);
+- the latency of single lookups (`get_node_repository`) of random nodes;
+- the latency of batch lookups (`get_node_repositories`) of random nodes.
+
+Before that, the lookups of paths in the DB done by a lazy `NodeRepository` are checked against the whole
+folder_meta, for names with non-ASCII characters, quotes and dots.
+
+The folder_meta cache is disabled, so that each lookup queries the DB.
+PostgreSQL is only benchmarked if the DB credentials are specified.
+
+**VERY IMPORTANT NOTE!** The `db_noderepo` table of the PostgreSQL database will be emptied,
+use a test database.
+"""
+import os
+import random
+import shutil
+import sys
+import time
+import uuid
+
+import click
+
+from aiida_repository.bulk import bulk_insert_node_repos
+from aiida_repository.repository import Repository
+
+from bulk_insert import get_folder_meta
+
+
+def get_stats(latencies):
+    """Return a string with the mean, median and 99th percentile of a list of latencies, in ms."""
+    latencies = sorted(latencies)
+    return "mean {:7.3f} ms, p50 {:7.3f} ms, p99 {:7.3f} ms".format(
+        1000 * sum(latencies) / len(latencies), 1000 * latencies[len(latencies) // 2],
+        1000 * latencies[(len(latencies) * 99) // 100])
+
+
+# Paths of the node used to check the lazy lookups, with characters that need quoting or escaping in the JSON paths
+CHECK_PATHS = ['café/naïve.txt', 'café/日本語.dat', 'quo"te\'s/file.v1.txt', 'plain/a.txt']
+
+
+def check_lazy_lookups(repo):
+    """Check that a lazy `NodeRepository` finds the same content as the eager one, exiting if not."""
+    node_uuid = str(uuid.uuid4())
+    with repo.begin_node_transaction(node_uuid) as transaction:
+        for path in CHECK_PATHS:
+            transaction.put_object_from_bytes(path.encode('utf8'), path)
+    repo.invalidate_cache()
+    lazy_repo = repo.get_node_repository(node_uuid, lazy=True)
+    node_repo = repo.get_node_repository(node_uuid)
+    for path in CHECK_PATHS:
+        folder = path.split('/')[0]
+        if (lazy_repo.get_object_content(path) != path.encode('utf8') or
+                sorted(lazy_repo.list_objects(folder)) != sorted(node_repo.list_objects(folder))):
+            print("ERROR! The lazy lookup of '{}' differs from the whole folder_meta".format(path))
+            sys.exit(1)
+    print("  lazy lookups of {} paths: OK".format(len(CHECK_PATHS)))
+
+
+def benchmark_backend(get_repository, num_rows, files_per_node, num_lookups, batch_size):
+    """Fill the DB of a repository with random rows, and print the lookup latencies.
+
+    :param get_repository: a function returning a new `Repository` object
+    """
+    repo = get_repository()
+    repo.create_schema()
+    repo.drop_db()
+    check_lazy_lookups(repo)
+    repo.drop_db()
+    node_uuids = [str(uuid.uuid4()) for _ in range(num_rows)]
+    session = repo._get_cached_session()  # pylint: disable=protected-access
+    for idx in range(0, num_rows, 10000):
+        bulk_insert_node_repos(session, [{
+            'node_uuid': node_uuid,
+            'folder_meta': get_folder_meta(files_per_node)
+        } for node_uuid in node_uuids[idx:idx + 10000]])
+        session.commit()
+    repo.close()
+
+    start = time.time()
+    repo = get_repository()
+    repo.get_node_repository(node_uuids[0])
+    print("  startup (first lookup): {:7.3f} ms".format(1000 * (time.time() - start)))
+
+    latencies = []
+    for node_uuid in random.sample(node_uuids, min(num_lookups, num_rows)):
+        start = time.time()
+        repo.get_node_repository(node_uuid)
+        latencies.append(time.time() - start)
+    print("  single lookup:          {}".format(get_stats(latencies)))
+
+    latencies = []
+    for _ in range(max(num_lookups // batch_size, 1)):
+        batch = random.sample(node_uuids, min(batch_size, num_rows))
+        start = time.time()
+        repo.get_node_repositories(batch)
+        latencies.append(time.time() - start)
+    print("  batch of {:5d} lookups: {}".format(batch_size, get_stats(latencies)))
+
+    repo.drop_db()
+    repo.close()
+
+
+@click.command()
+@click.option('-p',
+              '--path',
+              default='/tmp/test-container-lookup-latency',
+              help='The path to a test folder in which the container and the SQLite DB will be created. '
+              'Must not exist unless --clear is specified.')
+@click.option('-c', '--clear', is_flag=True, help='Delete the test folder before starting.')
+@click.option('-U', '--db-user', help='PostgreSQL user name.')
+@click.option('-D',
+              '--db-name',
+              help='PostgreSQL database name (THE db_noderepo TABLE WILL BE EMPTIED! USE A TEST DB).')
+@click.option('-P', '--db-password', help='PostgreSQL password.')
+@click.option('-n', '--num-rows', type=int, default=100000, help='Number of rows in the table.')
+@click.option('-f', '--files-per-node', type=int, default=5, help='Number of files in the folder_meta of each row.')
+@click.option('-l', '--num-lookups', type=int, default=2000, help='Number of lookups to time.')
+@click.option('-b', '--batch-size', type=int, default=100, help='Number of nodes in each batch lookup.')
+@click.help_option('-h', '--help')
+def main(path, clear, db_user, db_name, db_password, num_rows, files_per_node, num_lookups, batch_size):  # pylint: disable=too-many-arguments
+    if clear and os.path.exists(path):
+        shutil.rmtree(path)
+    if os.path.exists(path):
+        print("The folder '{}' exists - either delete it, or specify the --clear option".format(path))
+        sys.exit(1)
+    os.makedirs(path)
+
+    backends = [('sqlite', lambda: Repository(folder=os.path.join(path, 'container'),
+                                              db_user=None,
+                                              db_name=None,
+                                              db_password=None,
+                                              db_url='sqlite:///{}'.format(os.path.join(path, 'metadata.sqlite'))))]
+    if db_user and db_name:
+        backends.append(('postgresql', lambda: Repository(folder=os.path.join(path, 'container'),
+                                                          db_user=db_user,
+                                                          db_name=db_name,
+                                                          db_password=db_password)))
+
+    for name, get_repository in backends:
+        print("{} ({} rows with {} files each):".format(name, num_rows, files_per_node))
+        benchmark_backend(get_repository, num_rows, files_per_node, num_lookups, batch_size)
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
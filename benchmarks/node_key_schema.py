@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""Compare the size of the index on the node UUIDs, and the latency of lookups, with VARCHAR and native UUID keys.
+
+Two tables with the same columns as `db_noderepo` (but with a VARCHAR(36) and a native UUID `node_uuid`,
+respectively) are created in a PostgreSQL database and filled with the same random UUIDs (the rows are generated
+by the DB server, so that tens of millions of rows can be created quickly). Then, for each table:
+
+- the size of the table and of the index on `node_uuid` are printed;
+- the latency of lookups of batches of random nodes, with `node_uuid IN (...)` as in `_query_folder_metas`,
+  is measured for each batch size.
+
+The two tables are created with names that do not clash with `db_noderepo`, and dropped at the end.
+"""
+import random
+import time
+
+import click
+from sqlalchemy import Column, Integer, MetaData, String, Table, bindparam, select
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.engine.url import make_url
+
+from aiida_repository.backends import PostgresqlBackend
+from aiida_repository.models import NodeUuid
+
+from lookup_latency import get_stats
+
+
+def get_tables(metadata):
+    """Return a dictionary with the two tables to compare, by key type."""
+    return {
+        key_type: Table('bench_node_key_{}'.format(key_type), metadata, Column('id', Integer, primary_key=True),
+                        Column('node_uuid', column_type, index=True), Column('folder_meta', JSONB))
+        for key_type, column_type in [('varchar', String(36)), ('uuid', NodeUuid)]
+    }
+
+
+def fill_tables(engine, tables, num_rows, chunk_size=1000000):
+    """Fill the UUID table with random UUIDs, and copy them to the VARCHAR table."""
+    folder_meta = '{"dir": {"aiida.out": {"obj": "%s"}}}' % ('0' * 64)
+    for start in range(0, num_rows, chunk_size):
+        engine.execute(
+            "INSERT INTO {} (node_uuid, folder_meta) SELECT gen_random_uuid(), '{}'::jsonb "
+            "FROM generate_series(1, {})".format(tables['uuid'].name, folder_meta,
+                                                 min(chunk_size, num_rows - start)))
+        print("  {} rows inserted".format(min(start + chunk_size, num_rows)))
+    engine.execute('INSERT INTO {} (node_uuid, folder_meta) SELECT node_uuid::text, folder_meta FROM {} '
+                   'ORDER BY id'.format(tables['varchar'].name, tables['uuid'].name))
+    # VACUUM cannot run in a transaction
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for table in tables.values():
+            connection.execute('VACUUM ANALYZE {}'.format(table.name))
+
+
+def get_sizes_mb(engine, table):
+    """Return a tuple (table size, size of the index on node_uuid), in MB."""
+    index_name = list(table.indexes)[0].name
+    return tuple(engine.execute("SELECT pg_relation_size('{}') / 1024. / 1024.".format(name)).scalar()
+                 for name in [table.name, index_name])
+
+
+@click.command()
+@click.option('-U', '--db-user', required=True, help='PostgreSQL user name.')
+@click.option('-D', '--db-name', required=True, help='PostgreSQL database name.')
+@click.option('-P', '--db-password', required=True, help='PostgreSQL password.')
+@click.option('--db-host', default='localhost', help='PostgreSQL host.')
+@click.option('-n', '--num-rows', type=int, default=10000000, help='Number of rows in each table.')
+@click.option('-l', '--num-lookups', type=int, default=200, help='Number of lookups to time for each batch size.')
+@click.option('-b',
+              '--batch-sizes',
+              default='1,100,1000',
+              help='Comma-separated list of numbers of nodes in each lookup.')
+@click.help_option('-h', '--help')
+def main(db_user, db_name, db_password, db_host, num_rows, num_lookups, batch_sizes):  # pylint: disable=too-many-arguments,too-many-locals
+    # Same settings as the engines of the repository, see `backends.PostgresqlBackend`
+    engine = PostgresqlBackend().create_engine(
+        make_url('postgresql://{}:{}@{}/{}'.format(db_user, db_password, db_host, db_name)), pool_size=5,
+        max_overflow=10)
+    metadata = MetaData()
+    tables = get_tables(metadata)
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    try:
+        print("Filling the tables with {} rows...".format(num_rows))
+        start = time.time()
+        fill_tables(engine, tables, num_rows)
+        print("  done in {:.1f} s".format(time.time() - start))
+
+        # Random sample of the UUIDs to look up (the same for both tables)
+        sample_size = max(int(batch_size) for batch_size in batch_sizes.split(',')) * 10
+        node_uuids = [res[0] for res in engine.execute('SELECT node_uuid FROM {} ORDER BY random() LIMIT {}'.format(
+            tables['varchar'].name, sample_size))]
+
+        for key_type, table in tables.items():
+            table_size, index_size = get_sizes_mb(engine, table)
+            print("{}: table {:.1f} MB, index on node_uuid {:.1f} MB".format(key_type, table_size, index_size))
+            statement = select([table.c.node_uuid, table.c.folder_meta]).where(
+                table.c.node_uuid.in_(bindparam('node_uuids', expanding=True)))
+            with engine.connect() as connection:
+                for batch_size in batch_sizes.split(','):
+                    batch_size = int(batch_size)
+                    latencies = []
+                    for _ in range(num_lookups):
+                        batch = random.sample(node_uuids, batch_size)
+                        start = time.time()
+                        results = connection.execute(statement, node_uuids=batch).fetchall()
+                        latencies.append(time.time() - start)
+                        assert len(results) == batch_size
+                    print("  batch of {:5d} lookups: {}".format(batch_size, get_stats(latencies)))
+    finally:
+        metadata.drop_all(engine)
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
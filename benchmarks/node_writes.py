@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""Measure the latency of writing nodes with `NodeTransaction`, writing the objects to the packs or as loose objects.
+
+For each mode, `--num-nodes` new nodes are written in a new repository (with a SQLite DB), one transaction per node,
+each with `--num-files` small files generated in memory. The latency of the commits is printed, and for the loose
+mode also the time needed to pack all loose objects afterwards with `pack_loose_objects`.
+"""
+import os
+import shutil
+import sys
+import time
+import uuid
+
+import click
+
+from aiida_repository.repository import Repository
+
+from lookup_latency import get_stats
+
+
+@click.command()
+@click.option('-w',
+              '--workdir',
+              default='/tmp/aiida-repository-node-writes',
+              help='Folder in which to create all data. Must not exist unless --clear is specified.')
+@click.option('-c', '--clear', is_flag=True, help='Delete the work directory before starting.')
+@click.option('-n', '--num-nodes', type=int, default=500, help='Number of nodes written in each mode.')
+@click.option('-f', '--num-files', type=int, default=10, help='Number of files of each node.')
+@click.option('-s', '--file-size', type=int, default=4096, help='Size of each file, in bytes.')
+@click.help_option('-h', '--help')
+def main(workdir, clear, num_nodes, num_files, file_size):
+    if clear and os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    if os.path.exists(workdir):
+        print("The folder '{}' exists - either delete it, or specify the --clear option".format(workdir))
+        sys.exit(1)
+    os.makedirs(workdir)
+
+    for loose in [False, True]:
+        name = 'loose' if loose else 'packed'
+        repo = Repository(db_user=None,
+                          db_name=None,
+                          db_password=None,
+                          folder=os.path.join(workdir, '{}-container'.format(name)),
+                          db_url='sqlite:///{}'.format(os.path.join(workdir, '{}.sqlite'.format(name))))
+        repo.create_schema()
+        latencies = []
+        for _ in range(num_nodes):
+            start = time.time()
+            with repo.begin_node_transaction(str(uuid.uuid4()), loose=loose) as transaction:
+                for idx in range(num_files):
+                    transaction.put_object_from_bytes(os.urandom(file_size), 'outputs/file-{}.dat'.format(idx))
+            latencies.append(time.time() - start)
+        print("{:>6s}: latency per node: {}".format(name, get_stats(latencies)))
+        if loose:
+            start = time.time()
+            repo.pack_loose_objects(clean=True)
+            print("        packing all loose objects afterwards: {:.3f} s".format(time.time() - start))
+        repo.close()
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
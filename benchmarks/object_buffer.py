@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Compare reading a large object with `get_object_content` (a copy in a new `bytes`) and with `get_object_buffer`
+(a read-only `memoryview` of a memory map of the pack).
+
+A node with one large file of random bytes is written to a new repository (with a SQLite DB), uncompressed. For each
+method, the object is retrieved and then hashed (so that the whole content is accessed), with a cold or warm
+page cache, and the time to retrieve it, the total time and the peak of the memory allocated by Python
+(measured with `tracemalloc`, that does not include the memory mapped pages) are printed.
+"""
+import hashlib
+import os
+import shutil
+import sys
+import time
+import tracemalloc
+import uuid
+
+import click
+
+from aiida_repository.repository import Repository
+
+from repack_locality import evict_from_page_cache
+
+
+@click.command()
+@click.option('-w',
+              '--workdir',
+              default='/tmp/aiida-repository-object-buffer',
+              help='Folder in which to create all data. Must not exist unless --clear is specified.')
+@click.option('-c', '--clear', is_flag=True, help='Delete the work directory before starting.')
+@click.option('-s', '--size-mb', type=int, default=512, help='Size of the object, in MB.')
+@click.option('--warm', is_flag=True, help='Do not evict the object from the page cache before reading it.')
+@click.help_option('-h', '--help')
+def main(workdir, clear, size_mb, warm):
+    if clear and os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    if os.path.exists(workdir):
+        print("The folder '{}' exists - either delete it, or specify the --clear option".format(workdir))
+        sys.exit(1)
+    os.makedirs(workdir)
+
+    repo = Repository(db_user=None,
+                      db_name=None,
+                      db_password=None,
+                      folder=os.path.join(workdir, 'container'),
+                      db_url='sqlite:///{}'.format(os.path.join(workdir, 'repository.sqlite')))
+    repo.create_schema()
+    node_uuid = str(uuid.uuid4())
+    with repo.begin_node_transaction(node_uuid) as transaction:
+        with open(os.path.join(workdir, 'data.npy'), 'wb') as handle:
+            for _ in range(size_mb):
+                handle.write(os.urandom(1024 * 1024))
+        with open(os.path.join(workdir, 'data.npy'), 'rb') as handle:
+            transaction.put_object_from_filelike(handle, 'data.npy')
+    node_repo = repo.get_node_repository(node_uuid)
+
+    digests = set()
+    for name in ['get_object_content', 'get_object_buffer']:
+        if not warm:
+            evict_from_page_cache(repo.container)
+        tracemalloc.start()
+        start = time.time()
+        content = getattr(node_repo, name)('data.npy')
+        get_time = time.time() - start
+        digests.add(hashlib.sha256(content).hexdigest())
+        tot_time = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del content
+        print("{:>18s}: retrieved in {:.3f} s, hashed in {:.3f} s total, peak memory allocated {:.1f} MB".format(
+            name, get_time, tot_time, peak / 1024 / 1024))
+    if len(digests) != 1:
+        print("ERROR! The content differs")
+        sys.exit(1)
+    repo.close()
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
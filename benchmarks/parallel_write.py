@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Measure how the import of a legacy repository scales with the number of threads hashing and compressing files.
+
+A synthetic legacy repository is generated (see `synthetic_repository.py`) and imported with
+`create_repo_for_nodes` in a new repository (with a SQLite DB) for each number of workers: first serially
+(`write_workers=None`), then with the parallel pipeline (see `aiida_repository.pipeline`) and 1, 2, 4, ...
+workers up to the maximum. For each run, the throughput of the import is printed, and the folder_meta of all
+nodes is checked to be identical to the one of the serial import, i.e. each file gets the same object.
+"""
+import os
+import shutil
+import sys
+import time
+
+import click
+
+from aiida_repository.repository import Repository
+
+from synthetic_repository import generate_legacy_repository
+
+
+def import_repository(workdir, name, folder_paths, compress, write_workers):
+    """Import the legacy repository in a new repository, and return (time, folder_metas)."""
+    repo = Repository(db_user=None,
+                      db_name=None,
+                      db_password=None,
+                      folder=os.path.join(workdir, '{}-container'.format(name)),
+                      db_url='sqlite:///{}'.format(os.path.join(workdir, '{}.sqlite'.format(name))))
+    repo.create_schema()
+    start = time.time()
+    repo.create_repo_for_nodes(folder_paths, compress=compress, write_workers=write_workers)
+    tot_time = time.time() - start
+    folder_metas = repo._query_folder_metas(list(folder_paths))  # pylint: disable=protected-access
+    repo.close()
+    return tot_time, folder_metas
+
+
+@click.command()
+@click.option('-w',
+              '--workdir',
+              default='/tmp/aiida-repository-parallel-write',
+              help='Folder in which to create all data. Must not exist unless --clear is specified.')
+@click.option('-c', '--clear', is_flag=True, help='Delete the work directory before starting.')
+@click.option('-n', '--num-nodes', type=int, default=1000, help='Number of nodes.')
+@click.option('--median-size', type=int, default=16384, help='Median size of the files, in bytes.')
+@click.option('--seed', type=int, default=0, help='Random seed.')
+@click.option('-z', '--compress', is_flag=True, help='Use compression when packing.')
+@click.option('-m',
+              '--max-workers',
+              type=int,
+              default=os.cpu_count(),
+              help='Maximum number of workers (default: the number of CPUs).')
+@click.help_option('-h', '--help')
+def main(workdir, clear, num_nodes, median_size, seed, compress, max_workers):  # pylint: disable=too-many-arguments
+    if clear and os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    if os.path.exists(workdir):
+        print("The folder '{}' exists - either delete it, or specify the --clear option".format(workdir))
+        sys.exit(1)
+    os.makedirs(workdir)
+
+    folder_paths = generate_legacy_repository(os.path.join(workdir, 'legacy'),
+                                              num_nodes=num_nodes,
+                                              median_size=median_size,
+                                              seed=seed)
+    num_bytes = 0
+    for folder_path in folder_paths.values():
+        for dirpath, _, filenames in os.walk(folder_path):
+            num_bytes += sum(os.path.getsize(os.path.join(dirpath, filename)) for filename in filenames)
+    print("{} nodes, {} bytes, compress={}, {} CPUs".format(num_nodes, num_bytes, compress, os.cpu_count()))
+
+    all_workers = [None]
+    workers = 1
+    while workers < max_workers:
+        all_workers.append(workers)
+        workers *= 2
+    all_workers.append(max_workers)
+
+    reference_folder_metas = None
+    reference_time = None
+    print("{:>10s} {:>10s} {:>10s} {:>10s}".format('workers', 'time (s)', 'MB/s', 'speedup'))
+    for write_workers in all_workers:
+        name = 'serial' if write_workers is None else 'workers-{}'.format(write_workers)
+        tot_time, folder_metas = import_repository(workdir, name, folder_paths, compress, write_workers)
+        if reference_folder_metas is None:
+            reference_folder_metas = folder_metas
+            reference_time = tot_time
+        elif folder_metas != reference_folder_metas:
+            print("ERROR! The folder_meta differ from the ones of the serial import")
+            sys.exit(1)
+        print("{:>10s} {:10.3f} {:10.2f} {:10.2f}".format(
+            name, tot_time, num_bytes / 1024 / 1024 / tot_time, reference_time / tot_time))
+        shutil.rmtree(os.path.join(workdir, '{}-container'.format(name)))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
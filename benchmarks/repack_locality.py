@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""Measure the latency of reading whole nodes before and after `Repository.repack_nodes`.
+
+A synthetic legacy repository is generated (see `synthetic_repository.py`), and its files are added to a new
+repository (with a SQLite DB) as months of incremental writes would do: in rounds, each adding one more file
+to every node (in random order), with one `NodeTransaction` per node and the last round written as loose objects.
+The objects of each node end up scattered over the packs. Then:
+
+- the latency of reading all files of random nodes (with `get_objects_content`) is measured;
+- the repository is repacked, possibly in steps limited by `--max-seconds` (continuing each time from the last
+  node checked);
+- the latency is measured again for the same nodes, and the content is checked to be the same.
+
+Before each read, the pack files and the loose objects are evicted from the page cache of the OS
+(with `posix_fadvise`), so that the reads actually hit the disk (unless `--warm` is specified).
+"""
+import os
+import random
+import shutil
+import sys
+import time
+
+import click
+
+from aiida_repository.repository import Repository
+
+from lookup_latency import get_stats
+from synthetic_repository import generate_legacy_repository
+
+
+def evict_from_page_cache(container):
+    """Ask the OS to drop from its page cache the content of the pack files and of the loose objects."""
+    for folder in [container._get_pack_folder(), container._get_loose_folder()]:  # pylint: disable=protected-access
+        for dirpath, _, filenames in os.walk(folder):
+            for filename in filenames:
+                fd = os.open(os.path.join(dirpath, filename), os.O_RDONLY)
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                finally:
+                    os.close(fd)
+
+
+def get_all_keys(node_repo, start_from=''):
+    """Return the keys of all the files of a node."""
+    keys = []
+    for obj in node_repo.list_objects(start_from):
+        key = os.path.join(start_from, obj.name) if start_from else obj.name
+        if obj.type.name == 'DIRECTORY':
+            keys.extend(get_all_keys(node_repo, key))
+        else:
+            keys.append(key)
+    return keys
+
+
+def read_nodes(repo, node_uuids, warm):
+    """Read all files of the given nodes, and return (latencies, contents)."""
+    latencies = []
+    contents = {}
+    for node_uuid in node_uuids:
+        node_repo = repo.get_node_repository(node_uuid)
+        keys = get_all_keys(node_repo)
+        if not warm:
+            evict_from_page_cache(repo.container)
+        start = time.time()
+        contents[node_uuid] = node_repo.get_objects_content(keys)
+        latencies.append(time.time() - start)
+    return latencies, contents
+
+
+def write_scattered(repo, folder_paths, seed):
+    """Write the files of the nodes in rounds, one file per node in each round, in random order."""
+    files = {}
+    for node_uuid, folder_path in folder_paths.items():
+        files[node_uuid] = sorted(
+            os.path.relpath(os.path.join(dirpath, filename), folder_path)
+            for dirpath, _, filenames in os.walk(folder_path)
+            for filename in filenames)
+    rng = random.Random(seed)
+    num_rounds = max(len(node_files) for node_files in files.values())
+    for idx in range(num_rounds):
+        node_uuids = [node_uuid for node_uuid, node_files in files.items() if idx < len(node_files)]
+        rng.shuffle(node_uuids)
+        for node_uuid in node_uuids:
+            with repo.begin_node_transaction(node_uuid, loose=idx == num_rounds - 1) as transaction:
+                with open(os.path.join(folder_paths[node_uuid], files[node_uuid][idx]), 'rb') as handle:
+                    transaction.put_object_from_filelike(handle, files[node_uuid][idx])
+
+
+@click.command()
+@click.option('-w',
+              '--workdir',
+              default='/tmp/aiida-repository-repack-locality',
+              help='Folder in which to create all data. Must not exist unless --clear is specified.')
+@click.option('-c', '--clear', is_flag=True, help='Delete the work directory before starting.')
+@click.option('-n', '--num-nodes', type=int, default=500, help='Number of nodes.')
+@click.option('--median-size', type=int, default=16384, help='Median size of the files, in bytes.')
+@click.option('--seed', type=int, default=0, help='Random seed.')
+@click.option('-r', '--num-reads', type=int, default=100, help='Number of random nodes read.')
+@click.option('-t',
+              '--max-seconds',
+              type=float,
+              default=None,
+              help='Repack in steps of at most this time (default: a single step).')
+@click.option('--warm', is_flag=True, help='Do not evict the objects from the page cache before reading each node.')
+@click.help_option('-h', '--help')
+def main(workdir, clear, num_nodes, median_size, seed, num_reads, max_seconds, warm):  # pylint: disable=too-many-arguments,too-many-locals
+    if clear and os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    if os.path.exists(workdir):
+        print("The folder '{}' exists - either delete it, or specify the --clear option".format(workdir))
+        sys.exit(1)
+    os.makedirs(workdir)
+
+    folder_paths = generate_legacy_repository(os.path.join(workdir, 'legacy'),
+                                              num_nodes=num_nodes,
+                                              min_files=2,
+                                              median_size=median_size,
+                                              seed=seed)
+    repo = Repository(db_user=None,
+                      db_name=None,
+                      db_password=None,
+                      folder=os.path.join(workdir, 'container'),
+                      db_url='sqlite:///{}'.format(os.path.join(workdir, 'repository.sqlite')))
+    repo.create_schema()
+    start = time.time()
+    write_scattered(repo, folder_paths, seed)
+    print("Nodes written in {:.3f} s: {}".format(time.time() - start, repo.container.count_objects()))
+
+    read_uuids = random.Random(seed).sample(list(folder_paths), min(num_reads, len(folder_paths)))
+    latencies, contents_before = read_nodes(repo, read_uuids, warm)
+    print("Before repacking: {}".format(get_stats(latencies)))
+
+    start = time.time()
+    last_node_uuid = None
+    num_steps = 0
+    while True:
+        report = repo.repack_nodes(node_uuids=repo.iter_node_uuids(start_after=last_node_uuid),
+                                   max_seconds=max_seconds)
+        num_steps += 1
+        print("  step {}: {} nodes checked, {} repacked ({} -> {} fragments), {} objects and {} bytes moved".format(
+            num_steps, report.num_nodes, report.num_repacked, report.fragments_before, report.fragments_after,
+            report.num_objects_moved, report.bytes_moved))
+        if report.is_complete:
+            break
+        last_node_uuid = report.last_node_uuid
+    repo.repack_nodes(node_uuids=[], clean=True)
+    print("Repacked in {:.3f} s ({} steps): {}".format(time.time() - start, num_steps,
+                                                       repo.container.count_objects()))
+
+    latencies, contents_after = read_nodes(repo, read_uuids, warm)
+    print("After repacking:  {}".format(get_stats(latencies)))
+    if contents_after != contents_before:
+        print("ERROR! The content of the nodes changed")
+        sys.exit(1)
+    repo.close()
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
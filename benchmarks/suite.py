@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""Reproducible benchmark suite for the repository.
+
+A synthetic legacy repository is generated (see `synthetic_repository.py`), and then the following
+phases are timed:
+
+- `import`: import of the legacy repository with `create_repo_for_nodes`;
+- `listing`: recursive listing of the content of all nodes;
+- `random_reads`: reading the content of random files of random nodes;
+- `export`: export of all nodes to a new repository with `export_nodes`;
+- `reextract`: extraction of all nodes back to the legacy layout with `export_nodes_to_folder`.
+
+By default, the DB is a SQLite file in the work directory, so no database server is needed.
+The `aiida_repository` package must be installed (e.g. with `pip install -e .[testing]` from the root of the
+repository).
+The results (throughput in files/s and MB/s, the peak memory usage of the process, and the metrics
+reported by the repository during each phase) are written as JSON, to be compared between versions.
+The peak memory usage is cumulative: it is the highest resident set size of the process since it started,
+at the end of each phase, so a phase using less memory than a previous one reports the same value.
+"""
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import time
+
+import click
+
+import aiida_repository
+from aiida_repository.metrics import MetricsRegistry
+from aiida_repository.repository import FileType, Repository
+
+from synthetic_repository import generate_legacy_repository
+
+
+def get_peak_rss_mb():
+    """Return the peak resident set size of this process so far, in MB."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak_rss / 1024 / 1024
+    return peak_rss / 1024
+
+
+def get_phase_results(tot_time, num_files, num_bytes, metrics=None):
+    """Return a dictionary with the results of a phase.
+
+    :param metrics: if specified, the `MetricsRegistry` of the repository, whose content is added
+        to the results and then reset
+    """
+    results = {
+        'time_s': tot_time,
+        'files': num_files,
+        'bytes': num_bytes,
+        'files_per_s': num_files / tot_time if tot_time else None,
+        'mb_per_s': num_bytes / 1024 / 1024 / tot_time if tot_time else None,
+        'cumulative_peak_rss_mb': get_peak_rss_mb(),
+    }
+    if metrics is not None:
+        results['metrics'] = metrics.as_dict()
+        metrics.reset()
+    return results
+
+
+def walk_node_repository(node_repo, start_from=''):
+    """Return the list of the keys of all files in a node repository."""
+    keys = []
+    for obj in node_repo.list_objects(start_from):
+        obj_relpath = os.path.join(start_from, obj.name)
+        if obj.type == FileType.DIRECTORY:
+            keys.extend(walk_node_repository(node_repo, start_from=obj_relpath))
+        else:
+            keys.append(obj_relpath)
+    return keys
+
+
+def get_repository(workdir, name, db_url, metrics=None):
+    """Return a new repository in the work directory, with a SQLite DB unless `db_url` is specified."""
+    repo = Repository(db_user=None,
+                      db_name=None,
+                      db_password=None,
+                      folder=os.path.join(workdir, '{}-container'.format(name)),
+                      db_url=db_url or 'sqlite:///{}'.format(os.path.join(workdir, '{}.sqlite'.format(name))),
+                      metrics=metrics)
+    repo.create_schema()
+    repo.drop_db()
+    return repo
+
+
+@click.command()
+@click.option('-w',
+              '--workdir',
+              default='/tmp/aiida-repository-benchmark',
+              help='Folder in which to create all data. Must not exist unless --clear is specified.')
+@click.option('-c', '--clear', is_flag=True, help='Delete the work directory before starting.')
+@click.option('-o', '--output', default=None, help='JSON file with the results (default: WORKDIR/results.json).')
+@click.option('--db-url',
+              default=None,
+              help='SQLAlchemy URL of the DB of the repository (default: SQLite in the work directory). '
+              'THE db_noderepo TABLE WILL BE EMPTIED!')
+@click.option('--export-db-url',
+              default=None,
+              help='SQLAlchemy URL of the DB of the repository to export to (default: SQLite in the work directory). '
+              'THE db_noderepo TABLE WILL BE EMPTIED!')
+@click.option('-n', '--num-nodes', type=int, default=1000, help='Number of nodes.')
+@click.option('--min-files', type=int, default=0, help='Minimum number of files per node.')
+@click.option('--max-files', type=int, default=20, help='Maximum number of files per node.')
+@click.option('--median-size', type=int, default=2048, help='Median size of the files, in bytes.')
+@click.option('--size-sigma', type=float, default=2., help='Standard deviation of the logarithm of the sizes.')
+@click.option('--max-size', type=int, default=100 * 1024 * 1024, help='Maximum size of a file, in bytes.')
+@click.option('--max-depth', type=int, default=2, help='Maximum depth of subfolders in each node.')
+@click.option('--text-fraction', type=float, default=0.7, help='Fraction of files with compressible content.')
+@click.option('--duplicate-fraction', type=float, default=0.1, help='Fraction of files with repeated content.')
+@click.option('--seed', type=int, default=0, help='Random seed.')
+@click.option('-z', '--compress', is_flag=True, help='Use compression when packing.')
+@click.option('-r', '--random-reads', type=int, default=1000, help='Number of random files to read.')
+@click.help_option('-h', '--help')
+def main(workdir, clear, output, db_url, export_db_url, compress, random_reads, **generator_kwargs):  # pylint: disable=too-many-arguments,too-many-locals,too-many-statements
+    if clear and os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    if os.path.exists(workdir):
+        print("The folder '{}' exists - either delete it, or specify the --clear option".format(workdir))
+        sys.exit(1)
+    os.makedirs(workdir)
+    output = output or os.path.join(workdir, 'results.json')
+
+    results = {}
+
+    print("Generating the synthetic legacy repository...")
+    start = time.time()
+    folder_paths = generate_legacy_repository(os.path.join(workdir, 'legacy'), **generator_kwargs)
+    tot_time = time.time() - start
+    num_files = 0
+    num_bytes = 0
+    for folder_path in folder_paths.values():
+        for dirpath, _, filenames in os.walk(folder_path):
+            num_files += len(filenames)
+            num_bytes += sum(os.path.getsize(os.path.join(dirpath, filename)) for filename in filenames)
+    print("Generated {} nodes, {} files, {} bytes in {:.3f} s".format(len(folder_paths), num_files, num_bytes,
+                                                                       tot_time))
+
+    metrics = MetricsRegistry()
+    repo = get_repository(workdir, 'repository', db_url, metrics=metrics)
+    metrics.reset()
+
+    start = time.time()
+    repo.create_repo_for_nodes(folder_paths, compress=compress)
+    results['import'] = get_phase_results(time.time() - start, num_files, num_bytes, metrics)
+
+    node_uuids = list(folder_paths)
+    start = time.time()
+    all_keys = {}
+    for node_repo in repo.get_node_repositories(node_uuids):
+        all_keys[node_repo.node_uuid] = walk_node_repository(node_repo)
+    num_listed = sum(len(keys) for keys in all_keys.values())
+    results['listing'] = get_phase_results(time.time() - start, num_listed, 0, metrics)
+
+    rng = random.Random(generator_kwargs['seed'])
+    nodes_with_files = [node_uuid for node_uuid, keys in all_keys.items() if keys]
+    read_bytes = 0
+    latencies = []
+    if nodes_with_files:
+        for _ in range(random_reads):
+            node_uuid = rng.choice(nodes_with_files)
+            key = rng.choice(all_keys[node_uuid])
+            start = time.time()
+            read_bytes += len(repo.get_node_repository(node_uuid).get_object_content(key))
+            latencies.append(time.time() - start)
+    results['random_reads'] = get_phase_results(sum(latencies), len(latencies), read_bytes, metrics)
+    latencies.sort()
+    results['random_reads']['latency_p50_s'] = latencies[len(latencies) // 2] if latencies else None
+    results['random_reads']['latency_p99_s'] = latencies[(len(latencies) * 99) // 100] if latencies else None
+
+    export_repo = get_repository(workdir, 'export', export_db_url)
+    metrics.reset()
+    start = time.time()
+    repo.export_nodes(export_repo, node_uuids, compress=compress)
+    results['export'] = get_phase_results(time.time() - start, num_files, num_bytes, metrics)
+
+    start = time.time()
+    repo.export_nodes_to_folder(node_uuids, os.path.join(workdir, 'reextracted'))
+    results['reextract'] = get_phase_results(time.time() - start, num_files, num_bytes, metrics)
+
+    report = {
+        'aiida_repository_version': aiida_repository.__version__,
+        'date': datetime.datetime.now().isoformat(),
+        'platform': {
+            'python': platform.python_version(),
+            'system': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+        },
+        'parameters': dict(generator_kwargs,
+                           compress=compress,
+                           random_reads=random_reads,
+                           db_dialect=repo._get_engine().dialect.name),  # pylint: disable=protected-access
+        'results': results,
+    }
+    with open(output, 'w') as fhandle:
+        json.dump(report, fhandle, indent=2)
+
+    print()
+    print("{:14s} {:>10s} {:>12s} {:>10s} {:>24s}".format('phase', 'time (s)', 'files/s', 'MB/s',
+                                                          'cumulative peak RSS MB'))
+    for phase, phase_results in results.items():
+        print("{:14s} {:10.3f} {:12.1f} {:10.2f} {:24.1f}".format(phase, phase_results['time_s'],
+                                                                 phase_results['files_per_s'] or 0,
+                                                                 phase_results['mb_per_s'] or 0,
+                                                                 phase_results['cumulative_peak_rss_mb']))
+    print("Results written to '{}'".format(output))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
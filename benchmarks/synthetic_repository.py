@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Generate a synthetic AiiDA legacy repository, with the `node/xx/yy/zzzz...` layout.
+
+Each node folder contains a `path` subfolder (as in AiiDA) with a random tree of files.
+The number of files, their sizes, the depth of the tree and the type of content
+are drawn from configurable distributions, with a fixed random seed, so that the same
+repository can be regenerated identically.
+"""
+import os
+import random
+import uuid
+
+import click
+
+# Lines used to generate compressible, text-like content
+_TEXT_LINES = [
+    b'  total energy              =     -1234.56789012 Ry\n',
+    b'     k(    1) = (   0.0000000   0.0000000   0.0000000), wk =   0.0312500\n',
+    b'&CONTROL\n  calculation = \'scf\'\n  pseudo_dir = \'./pseudo/\'\n/\n',
+    b'ATOMIC_POSITIONS crystal\nSi 0.00 0.00 0.00\nSi 0.25 0.25 0.25\n',
+    b'     iteration #  1     ecut=    30.00 Ry     beta= 0.70\n',
+]
+
+
+def _get_content(rng, size, text_fraction):
+    """Return `size` bytes of either text-like (compressible) or random (incompressible) content."""
+    if rng.random() < text_fraction:
+        chunks = []
+        length = 0
+        while length < size:
+            line = rng.choice(_TEXT_LINES)
+            chunks.append(line)
+            length += len(line)
+        return b''.join(chunks)[:size]
+    return rng.getrandbits(8 * size).to_bytes(size, 'little') if size else b''
+
+
+def generate_legacy_repository(  # pylint: disable=too-many-arguments,too-many-locals
+        folder, num_nodes, min_files=0, max_files=20, median_size=2048, size_sigma=2., max_size=100 * 1024 * 1024,
+        max_depth=2, text_fraction=0.7, duplicate_fraction=0.1, seed=0):
+    """Generate a synthetic legacy repository.
+
+    :param folder: the repository folder; node folders are created in `folder/node`, which must not exist
+    :param num_nodes: number of nodes
+    :param min_files: minimum number of files per node
+    :param max_files: maximum number of files per node (the number is drawn uniformly)
+    :param median_size: median size of the files, in bytes (sizes have a log-normal distribution)
+    :param size_sigma: standard deviation of the logarithm of the file sizes
+    :param max_size: maximum size of a file, in bytes
+    :param max_depth: maximum depth of subfolders within the `path` folder of each node
+    :param text_fraction: fraction of files with text-like (compressible) content, the others are random bytes
+    :param duplicate_fraction: fraction of files whose content is the same as that of a file of a previous node
+    :param seed: the random seed
+    :return: a dictionary where keys are node UUIDs and values the path to the node folder
+    """
+    rng = random.Random(seed)
+    node_folder = os.path.join(folder, 'node')
+    os.makedirs(node_folder)
+
+    folder_paths = {}
+    # A few contents to reuse, as in real repositories many files (e.g. submission scripts) are identical
+    known_contents = []
+    for _ in range(num_nodes):
+        node_uuid = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        repo_node_folder = os.path.join(node_folder, node_uuid[:2], node_uuid[2:4], node_uuid[4:])
+        base_folder = os.path.join(repo_node_folder, 'path')
+        os.makedirs(base_folder)
+        folder_paths[node_uuid] = repo_node_folder
+
+        for file_idx in range(rng.randint(min_files, max_files)):
+            file_folder = base_folder
+            for _ in range(rng.randint(0, max_depth)):
+                file_folder = os.path.join(file_folder, 'subfolder{}'.format(rng.randint(0, 2)))
+            os.makedirs(file_folder, exist_ok=True)
+
+            if known_contents and rng.random() < duplicate_fraction:
+                content = rng.choice(known_contents)
+            else:
+                size = min(int(rng.lognormvariate(0, size_sigma) * median_size), max_size)
+                content = _get_content(rng, size, text_fraction)
+                if len(known_contents) < 100 and size < 64 * 1024:
+                    known_contents.append(content)
+
+            with open(os.path.join(file_folder, 'file{}.dat'.format(file_idx)), 'wb') as fhandle:
+                fhandle.write(content)
+
+    return folder_paths
+
+
+@click.command()
+@click.argument('folder')
+@click.option('-n', '--num-nodes', type=int, default=1000, help='Number of nodes.')
+@click.option('--min-files', type=int, default=0, help='Minimum number of files per node.')
+@click.option('--max-files', type=int, default=20, help='Maximum number of files per node.')
+@click.option('--median-size', type=int, default=2048, help='Median size of the files, in bytes.')
+@click.option('--size-sigma', type=float, default=2., help='Standard deviation of the logarithm of the sizes.')
+@click.option('--max-size', type=int, default=100 * 1024 * 1024, help='Maximum size of a file, in bytes.')
+@click.option('--max-depth', type=int, default=2, help='Maximum depth of subfolders in each node.')
+@click.option('--text-fraction', type=float, default=0.7, help='Fraction of files with compressible content.')
+@click.option('--duplicate-fraction', type=float, default=0.1, help='Fraction of files with repeated content.')
+@click.option('--seed', type=int, default=0, help='Random seed.')
+@click.help_option('-h', '--help')
+def main(folder, **kwargs):
+    """Generate a synthetic legacy repository in FOLDER."""
+    folder_paths = generate_legacy_repository(folder, **kwargs)
+    print("Generated {} nodes in '{}'".format(len(folder_paths), os.path.join(folder, 'node')))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
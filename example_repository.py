@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 import click
-import io
 import os
 import random
 import shutil
@@ -8,26 +7,11 @@ import subprocess
 import sys
 import time
 
-from aiida_repository.repository import Repository, FileType
+from aiida_repository.metrics import MetricsRegistry
+from aiida_repository.repository import Repository
 from disk_objectstore import Container
 
 
-def create_folder(base, node_repo, start_from=""):
-    for obj in node_repo.list_objects(start_from):
-        obj_relpath = os.path.join(start_from, obj.name)
-        if obj.type == FileType.DIRECTORY:
-            os.mkdir(os.path.join(base, obj_relpath))
-            create_folder(base, node_repo, start_from=obj_relpath)
-        elif obj.type == FileType.FILE:
-            with node_repo.open(obj_relpath) as source_fhandle:
-                # One could do streamed here
-                with open(os.path.join(base, obj_relpath),
-                          'wb') as dest_fhandle:
-                    dest_fhandle.write(source_fhandle.read())
-        else:
-            raise RuntimeError("Unknown object type {}".format(obj.type))
-
-
 def export_from_pack(
     extract_to,
     source_repo,
@@ -93,118 +77,16 @@ def export_from_pack(
     return output_container, old_new_obj_hashkey_mapping
 
 
-def export_from_pack_grouped(
-    extract_to,
-    source_repo,
-    node_uuids_groups,  # pylint: disable=too-many-locals,too-many-arguments
-    print_space_statistics=False,
-    compress=False,
-    max_memory_usage=1000 * 1024 * 1024,
-    pack_size_target=4 * 1024 * 1024 * 1024):
-    """Export the uuids, provided in groups, to the extract_to folder, directly into packs.
-
-    This is a way to estimate the speed in re-exporting.
-    max_memory_usage is the number in bytes of the max allocation to make in memory
-    """
-    export_container_extract_to = os.path.join(extract_to, 'export-container')
-
-    output_container = Container(folder=export_container_extract_to)
-    output_container.init_container(pack_size_target=pack_size_target)
-
-    write_time = 0.
-
-    start = time.time()
-    for idx, node_uuids_chunk in enumerate(node_uuids_groups, start=1):
-        obj_hashkeys = []
-        for repo_node in source_repo.get_node_repositories(node_uuids_chunk):
-            obj_hashkeys.extend(repo_node.get_all_obj_hashkeys())
-        print("{} objects to write in phase {}".format(len(obj_hashkeys), idx))
+def print_metrics(metrics):
+    """Print the timers and counters collected in a `MetricsRegistry`, and reset it."""
+    for name, stats in sorted(metrics.get_timers().items()):
+        print("- {:30s}: {:.3f} s ({} times, max {:.3f} s)".format(name, stats.total, stats.count, stats.max))
+    for name, value in sorted(metrics.get_counters().items()):
+        print("- {:30s}: {}".format(name, value))
+    metrics.reset()
 
-        with source_repo.container.get_objects_stream_and_meta(
-                obj_hashkeys) as triplets:
-            old_obj_hashkeys = []
-            new_obj_hashkeys = []
-            content_cache = {}
-            cache_size = 0
-            for old_obj_hashkey, stream, meta in triplets:
-                # If the object itself is too big, just write it directly
-                # via streams, bypassing completely the cache
-                if meta['size'] > max_memory_usage:
-                    print(
-                        "DEBUG: DIRECT WRITE OF OBJECT (size={}, old-hashkey: {})"
-                        .format(meta['size'], old_obj_hashkey))
-                    old_obj_hashkeys.append(old_obj_hashkey)
-                    write_start = time.time()
-                    new_obj_hashkeys.append(
-                        output_container.add_streamed_objects_to_pack(
-                            [stream], compress=compress)[0])
-                    write_time += time.time() - write_start
-                # I were to read the content, I would be filling too much memory - I
-                # flush the cache first
-                elif cache_size + meta['size'] > max_memory_usage:
-                    # Flush the cotnent of the cache
-                    print(
-                        "DEBUG: FLUSHING CACHE (current: {}, new: {}) while old-hashkey: {}"
-                        .format(cache_size, meta['size'], old_obj_hashkey))
-                    temp_old_hashkeys = []
-                    stream_list = []
-                    for old_cached_hashkey, cached_stream in content_cache.items(
-                    ):
-                        temp_old_hashkeys.append(old_cached_hashkey)
-                        stream_list.append(cached_stream)
-                    write_start = time.time()
-                    temp_new_hashkeys = output_container.add_streamed_objects_to_pack(
-                        stream_list, compress=compress)
-                    write_time += time.time() - write_start
-                    old_obj_hashkeys += temp_old_hashkeys
-                    new_obj_hashkeys += temp_new_hashkeys
-                    content_cache = {}
-                    cache_size = 0
-                    # I add this to the cache for the next round
-                    content_cache[old_obj_hashkey] = io.BytesIO(stream.read())
-                    cache_size += meta['size']
-                # I can add this object to the memory cache, it is not too big.
-                # I write it as a stream.
-                else:
-                    content_cache[old_obj_hashkey] = io.BytesIO(stream.read())
-                    cache_size += meta['size']
-
-            # The for loop is finished. Most probably I still have content in the
-            # cache, just flush it
-            print("DEBUG: FINAL CACHE FLUSH (size: {})".format(cache_size))
-            temp_old_hashkeys = []
-            stream_list = []
-            for old_cached_hashkey, cached_stream in content_cache.items():
-                temp_old_hashkeys.append(old_cached_hashkey)
-                stream_list.append(cached_stream)
-            write_start = time.time()
-            temp_new_hashkeys = output_container.add_streamed_objects_to_pack(
-                stream_list, compress=compress)
-            write_time += time.time() - write_start
-            old_obj_hashkeys += temp_old_hashkeys
-            new_obj_hashkeys += temp_new_hashkeys
-            content_cache = {}
-            cache_size = 0
 
-            old_new_obj_hashkey_mapping = dict(
-                zip(old_obj_hashkeys, new_obj_hashkeys))
-
-            # Print some size statistics
-            if print_space_statistics:
-                size_info = output_container.get_total_size()
-                print("Output object store size info after phase {}:".format(
-                    idx))
-                for key in sorted(size_info.keys()):
-                    print("- {:30s}: {}".format(key, size_info[key]))
-    tot_time = time.time() - start
-    print(
-        "Time to store all objects (from packed to packed) in 2 steps: {:.3f} s (of which write-time: {:.3f} s)"
-        .format(tot_time, write_time))
-
-    return output_container, old_new_obj_hashkey_mapping
-
-
-def import_from_legacy_repo(repo, node_folder, compress):
+def import_from_legacy_repo(repo, node_folder, compress, **kwargs):
 
     print("*" * 74)
     print("* IMPORTING FROM LEGACY REPO")
@@ -232,8 +114,10 @@ def import_from_legacy_repo(repo, node_folder, compress):
                 #    raise OSError("Path folder does not exist: {}".format(path_node_folder))
                 folder_paths[node_uuid] = repo_node_folder
 
-    # Create the new repo format (TIMING INSIDE THE FUNCTION)
-    repo.create_repo_for_nodes(folder_paths=folder_paths, compress=compress)
+    # Create the new repo format
+    repo.create_repo_for_nodes(folder_paths=folder_paths, compress=compress, **kwargs)
+    print("Import metrics:")
+    print_metrics(repo.metrics)
 
     return folder_paths
 
@@ -275,11 +159,44 @@ def import_from_legacy_repo(repo, node_folder, compress):
               '--compress',
               is_flag=True,
               help='Use compression when packing.')
+@click.option('--auto-compress',
+              is_flag=True,
+              help='When importing, decide for each object whether to compress it, from its name and content '
+              '(overrides -z).')
 @click.option('-s',
               '--pack-size-target',
               type=int,
               default=4 * 1024 * 1024 * 1024,
               help='Target size for packs.')
+@click.option('-w',
+              '--scan-workers',
+              type=int,
+              default=None,
+              help='Number of threads to scan the legacy repository (default: automatic).')
+@click.option('-W',
+              '--write-workers',
+              type=int,
+              default=None,
+              help='Number of threads to read, hash and compress the files when importing (default: serial).')
+@click.option('--batch-max-files',
+              type=int,
+              default=None,
+              help='Import the legacy repository in batches of at most this number of files.')
+@click.option('--batch-max-bytes',
+              type=int,
+              default=None,
+              help='Import the legacy repository in batches of at most this number of bytes.')
+@click.option('--resume',
+              is_flag=True,
+              help='Resume an interrupted import, skipping nodes already imported (do not use with -c).')
+@click.option('--incremental',
+              is_flag=True,
+              help='Import again a legacy repository that was already imported, skipping the nodes whose folder '
+              'did not change and updating the others (do not use with -c).')
+@click.option('--verify-mode',
+              type=click.Choice(['full', 'sampled', 'sizes']),
+              default='full',
+              help='How to verify the integrity of the repository after the import.')
 @click.option(
     '-o',
     '--only',
@@ -300,14 +217,24 @@ def main(
     extract_to,
     clear_extract_to,
     compress,
+    auto_compress,
     pack_size_target,
+    scan_workers,
+    write_workers,
+    batch_max_files,
+    batch_max_bytes,
+    resume,
+    incremental,
+    verify_mode,
     only):
 
     repo = Repository(folder=path,
                       db_user=db_user,
                       db_name=db_name,
                       db_password=db_password,
-                      pack_size_target=pack_size_target)
+                      pack_size_target=pack_size_target,
+                      metrics=MetricsRegistry())
+    repo.create_schema()
     print("Using a pack_size_target of {} ({} MB)".format(
         pack_size_target, (pack_size_target // 1024) // 1024))
     if clear_extract_to:
@@ -333,7 +260,27 @@ def main(
         assert 'node' in os.listdir(
             repository_folder
         ), "No 'node' folder in repository_folder, is this an AiiDA repository?"
-        import_from_legacy_repo(repo, node_folder, compress=compress)
+        import_from_legacy_repo(repo,
+                                node_folder,
+                                compress='auto' if auto_compress else compress,
+                                scan_workers=scan_workers,
+                                write_workers=write_workers,
+                                batch_max_files=batch_max_files,
+                                batch_max_bytes=batch_max_bytes,
+                                resume=resume,
+                                incremental=incremental)
+
+        # Check that all objects of all nodes are there and are not corrupt
+        start = time.time()
+        report = repo.verify(mode=verify_mode)
+        print("Verification ({}) of {} nodes, {} objects ({} hashed, {} bytes): {:.3f} s".format(
+            verify_mode, report.num_nodes, report.num_objects, report.num_hashed, report.bytes_hashed,
+            time.time() - start))
+        if not report.is_ok:
+            print("ERROR! PROBLEMS FOUND IN THE REPOSITORY:")
+            for problem in report.problems:
+                print("- node {}, file '{}' (object {}): {}".format(*problem))
+            sys.exit(1)
 
         # Print some size statistics
         size_info = repo.container.get_total_size()
@@ -344,6 +291,9 @@ def main(
         print("Object store objects info:")
         for key in sorted(count.keys()):
             print("- {:30s}: {}".format(key, count[key]))
+        print("Largest nodes:")
+        for node_uuid, file_count, total_size in repo.get_largest_nodes(limit=5):
+            print("- {}: {} files, {} bytes".format(node_uuid, file_count, total_size))
 
     if only is None or only == 'export-new':
 
@@ -366,67 +316,54 @@ def main(
             "* REEXPORTING FROM NEW-STYLE REPO DIRECTLY TO NEW-STYLE PACKED REPO, IN A FEW CHUNKS"
         )
 
-        #output_objectstore, old_new_mapping = export_from_pack(extract_to, repo, [node_uuids1, node_uuids2], compress=compress, pack_size_target=pack-size_target)
-        output_objectstore, old_new_mapping = export_from_pack_grouped(
-            extract_to,
-            repo, [node_uuids1, node_uuids2],
-            compress=compress,
-            pack_size_target=pack_size_target)
-
-        with repo.container.get_objects_stream_and_meta(
-                old_new_mapping.keys()) as triplets:
-            for old_hashkey, _, old_meta in triplets:
-                # TODO: Not the fastest method, we should add get_object_size()
-                new_size = len(
-                    output_objectstore.get_object_content(
-                        old_new_mapping[old_hashkey]))
-                assert new_size == old_meta['size'], "{} ({}) vs {} ({})".format(
-                    new_size, old_new_mapping[old_hashkey], old_meta['size'],
-                    old_hashkey)
+        export_repo = Repository(folder=os.path.join(extract_to, 'export-container'),
+                                 db_user=None,
+                                 db_name=None,
+                                 db_password=None,
+                                 db_url='sqlite:///{}'.format(os.path.join(extract_to, 'export.sqlite')),
+                                 pack_size_target=pack_size_target)
+        export_repo.create_schema()
+        start = time.time()
+        for node_uuids_chunk in [node_uuids1, node_uuids2]:
+            repo.export_nodes(export_repo, node_uuids_chunk, compress=compress)
+        tot_time = time.time() - start
+        print("Time to export all nodes (from packed to packed) in 2 steps: {:.3f} s".format(tot_time))
+        print("Export metrics:")
+        print_metrics(repo.metrics)
+
+        # Compare the sizes of the nodes in the two repositories, from the metadata of the containers,
+        # without reading the objects
+        for node_repo, export_node_repo in zip(repo.iter_node_repositories(node_uuids),
+                                               export_repo.iter_node_repositories(node_uuids)):
+            assert node_repo.get_total_size() == export_node_repo.get_total_size(), "{}: {} vs {}".format(
+                node_repo.node_uuid, node_repo.get_total_size(), export_node_repo.get_total_size())
 
         # Print space statistics for exported
-        size_info = output_objectstore.get_total_size()
+        size_info = export_repo.container.get_total_size()
         print("OUTPUT object store size info:")
         for key in sorted(size_info.keys()):
             print("- {:30s}: {}".format(key, size_info[key]))
-        count = output_objectstore.count_objects()
+        count = export_repo.container.count_objects()
         print("OUTPUT object store objects info:")
         for key in sorted(count.keys()):
             print("- {:30s}: {}".format(key, count[key]))
+        export_repo.close()
 
     if only is None or only == 'export-new-to-legacy':
-        start = time.time()
-        node_uuids = list(repo.get_all_node_uuids())
-        tot_time = time.time() - start
-        print(
-            "Time to get back all node UUIDs ({} received) from postgres: {:.3f} s"
-            .format(len(node_uuids), tot_time))
-
-        # Let's try now to extract again
-        random.shuffle(node_uuids)
-        print("Extracting (shuffled) again in '{}'...".format(extract_to))
-        start = time.time()
-        node_repos = repo.get_node_repositories(node_uuids)
-        tot_time = time.time() - start
-        print(
-            "Time to get back all folder metas for {} shuffled nodes from postgres: {:.3f} s"
-            .format(len(node_uuids), tot_time))
+        # Let's try now to extract again, streaming the node UUIDs from the DB
+        # (without keeping all of them in memory)
+        print("Extracting again in '{}'...".format(extract_to))
 
         # Recreate the legacy repository format
         legacy_extract_to = os.path.join(extract_to, 'legacy')
         os.mkdir(legacy_extract_to)
         start = time.time()
-        for node_repo in node_repos:
-            repo_node_folder = os.path.join(legacy_extract_to,
-                                            node_repo.node_uuid[:2],
-                                            node_repo.node_uuid[2:4],
-                                            node_repo.node_uuid[4:])
-            os.makedirs(repo_node_folder)
-            create_folder(base=repo_node_folder, node_repo=node_repo)
+        repo.export_nodes_to_folder(repo.iter_node_uuids(), legacy_extract_to)
         tot_time = time.time() - start
         print(
             "Time to recreate the repository from new-style to legacy in '{}': {:.3f} s"
             .format(legacy_extract_to, tot_time))
+        print_metrics(repo.metrics)
 
         # Check that the two folders are identical
         try:
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+"""Add the sizes of the files, and the file count and total size of the nodes, to the nodes of a repository
+imported by a previous version.
+
+The sizes are read from the metadata of the container (the objects are not read). The migration commits every
+`--chunk-size` nodes: it can be interrupted and run again, and the repository can be used while it runs.
+"""
+import time
+
+import click
+
+from aiida_repository.repository import Repository
+
+
+@click.command()
+@click.option('-p', '--path', required=True, help='The path to the folder of the container of the repository.')
+@click.option('-U', '--db-user', help='DB user name.')
+@click.option('-D', '--db-name', help='DB database name.')
+@click.option('-P', '--db-password', help='DB password.')
+@click.option('--db-url', help='SQLAlchemy URL of the DB (e.g. for SQLite), instead of -U, -D and -P.')
+@click.option('-c', '--chunk-size', type=int, default=1000, help='Number of nodes updated in each transaction.')
+@click.help_option('-h', '--help')
+def main(path, db_user, db_name, db_password, db_url, chunk_size):  # pylint: disable=too-many-arguments
+    if db_url is None and not (db_user and db_name):
+        raise click.UsageError('Specify either --db-url, or the DB user name and database name')
+    repo = Repository(folder=path, db_user=db_user, db_name=db_name, db_password=db_password, db_url=db_url)
+    # Add the `file_count` and `total_size` columns, if the DB was created by a previous version
+    repo.create_schema()
+
+    start = time.time()
+    num_updated = repo.add_missing_sizes(chunk_size=chunk_size)
+    print("Added the sizes to {} nodes in {:.3f} s".format(num_updated, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""Convert the folder_meta of all nodes of a repository to the JSON or to the compact (manifest) format.
+
+The migration commits every `--chunk-size` nodes: it can be interrupted and run again,
+and the repository can be used while it runs, since both formats can always be read.
+"""
+import time
+
+import click
+
+from aiida_repository.repository import Repository
+
+
+@click.command()
+@click.option('-p', '--path', required=True, help='The path to the folder of the container of the repository.')
+@click.option('-U', '--db-user', help='DB user name.')
+@click.option('-D', '--db-name', help='DB database name.')
+@click.option('-P', '--db-password', help='DB password.')
+@click.option('--db-url', help='SQLAlchemy URL of the DB (e.g. for SQLite), instead of -U, -D and -P.')
+@click.option('-f',
+              '--folder-meta-format',
+              type=click.Choice(Repository.FOLDER_META_FORMATS),
+              default='compact',
+              help='The format to convert to.')
+@click.option('-c', '--chunk-size', type=int, default=1000, help='Number of nodes converted in each transaction.')
+@click.help_option('-h', '--help')
+def main(path, db_user, db_name, db_password, db_url, folder_meta_format, chunk_size):  # pylint: disable=too-many-arguments
+    if db_url is None and not (db_user and db_name):
+        raise click.UsageError('Specify either --db-url, or the DB user name and database name')
+    repo = Repository(folder=path, db_user=db_user, db_name=db_name, db_password=db_password, db_url=db_url)
+    # Add the columns needed by the compact format, if the DB was created by a previous version
+    repo.create_schema()
+
+    start = time.time()
+    num_converted = repo.migrate_folder_meta(folder_meta_format, chunk_size=chunk_size)
+    tot_time = time.time() - start
+    print("Converted the folder_meta of {} nodes to the '{}' format in {:.3f} s".format(
+        num_converted, folder_meta_format, tot_time))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""Convert the node UUIDs of a repository created by a previous version to the native UUID type of PostgreSQL.
+
+The whole `db_noderepo` table is rewritten in a single transaction, during which the repository cannot be used.
+Optionally, a foreign key to the table of the nodes (e.g. `db_dbnode` of AiiDA) is also added.
+"""
+import time
+
+import click
+
+from aiida_repository.repository import Repository
+
+
+@click.command()
+@click.option('-p', '--path', required=True, help='The path to the folder of the container of the repository.')
+@click.option('-U', '--db-user', required=True, help='DB user name.')
+@click.option('-D', '--db-name', required=True, help='DB database name.')
+@click.option('-P', '--db-password', required=True, help='DB password.')
+@click.option('--node-table', default=None, help='If specified, add a foreign key to the UUID column of this table.')
+@click.option('--node-column', default='uuid', help='The UUID column of the table of the nodes.')
+@click.help_option('-h', '--help')
+def main(path, db_user, db_name, db_password, node_table, node_column):  # pylint: disable=too-many-arguments
+    repo = Repository(folder=path, db_user=db_user, db_name=db_name, db_password=db_password)
+    repo.create_schema()
+
+    start = time.time()
+    if repo.migrate_node_uuid_type():
+        print("Converted the node UUIDs to the native UUID type in {:.3f} s".format(time.time() - start))
+    else:
+        print("The node UUIDs already use the native UUID type")
+    if node_table is not None:
+        if repo.add_node_foreign_key(node_table=node_table, node_column=node_column):
+            print("Added the foreign key to {}.{}".format(node_table, node_column))
+        else:
+            print("The foreign key to {} already exists".format(node_table))
+
+
+if __name__ == '__main__':
+    main()  # pylint: disable=no-value-for-parameter
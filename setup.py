@@ -35,14 +35,19 @@ setup(
     author='Giovanni Pizzi',
     version=version,
     install_requires=[
-        'sqlalchemy',
+        # Parts of the 1.x API removed in 2.0 are still used (e.g. in the benchmarks); tested with 1.3
+        'sqlalchemy<2',
         'psycopg2-binary',
-        'disk-objectstore>=0.4'
+        # Internals of the container are used (see e.g. `aiida_repository/pipeline.py`): only 0.4.x is supported
+        'disk-objectstore>=0.4,<0.5'
     ],
     extras_require={
         "testing": [
             'click'
         ],
+        "async": [
+            'asyncpg'
+        ],
     },
     packages=find_packages(),
     # Needed to include some static files declared in MANIFEST.in